@@ -0,0 +1,68 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Benchmark the startup of a training run: parsing the normalized CSV files against
+mapping their feature store exports into memory.
+
+Usage: python benchmarks/bench_feature_store.py [years]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import config
+from data_normalizer import FEATURE_COLUMNS
+from feature_store import export_features, load_features
+from storage import read_df
+from windowing import make_sequences
+
+def write_years(folder, years):
+    """
+    Write one normalized CSV file of random hourly features per year.
+    """
+    os.makedirs(os.path.join(folder, 'NO1'), exist_ok=True)
+    file_paths = []
+    for year in range(2020, 2020 + years):
+        period_start = pd.date_range(f'{year}-01-01', f'{year}-12-31 23:00', freq='h', tz='+01:00')
+        df = pd.DataFrame(np.random.default_rng(year).random((len(period_start), len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+        df['period_start'] = period_start
+        file_path = os.path.join(folder, 'NO1', f'NO1_{year}.csv')
+        df.to_csv(file_path, index=False)
+        file_paths.append(file_path)
+    return file_paths
+
+def first_batches(load, file_paths):
+    """
+    Return the time until the windows of every file are ready and the first chunk is copied out.
+    """
+    start = time.perf_counter()
+    for file_path in file_paths:
+        inputs, targets = make_sequences(load(file_path), horizon=24)
+        np.ascontiguousarray(inputs[:256]), np.ascontiguousarray(targets[:256])
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as folder:
+        config.FEATURE_STORE_DIR = os.path.join(folder, 'features') + '/'
+        file_paths = write_years(os.path.join(folder, 'normalized'), years)
+
+        csv_time = first_batches(lambda file_path: read_df(file_path, columns=FEATURE_COLUMNS).values, file_paths)
+        start = time.perf_counter()
+        for file_path in file_paths:
+            export_features(file_path)
+        export_time = time.perf_counter() - start
+        mmap_time = first_batches(lambda file_path: load_features(file_path, export=False), file_paths)
+
+    print(f"{years} years of hourly data")
+    print(f"csv parse:        {csv_time:.3f} s")
+    print(f"one-off export:   {export_time:.3f} s")
+    print(f"feature store:    {mmap_time:.4f} s ({csv_time / mmap_time:.0f}x faster startup)")
@@ -0,0 +1,70 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Benchmark next-day forecasts for all five zones: the original loop of 24
+model.predict calls per zone against one batched inference.forecast call.
+
+Usage: python benchmarks/bench_inference.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from keras.models import load_model
+from model import create_model
+from inference import forecast
+
+def loop_forecast(model_path, window):
+    """
+    The original predict_next_24_hours, which loads the model on every call.
+    """
+    model = load_model(model_path)
+    predictions = []
+    current_input = window[None].copy()
+    for _ in range(24):
+        next_hour_prediction = model.predict(current_input, verbose=0)
+        predictions.append(next_hour_prediction[0, 0])
+        current_input = np.roll(current_input, -1, axis=1)
+        current_input[0, -1, 0] = next_hour_prediction[0, 0]
+    return np.array(predictions)
+
+def best_time(function, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == "__main__":
+    windows = np.random.default_rng(0).random((5, 24, 7)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, 'model.keras')
+        create_model(input_shape=(24, 7)).save(model_path)
+        direct_model_path = os.path.join(tmp_dir, 'direct_model.keras')
+        create_model(input_shape=(24, 7), num_outputs=24).save(direct_model_path)
+
+        loop_time, loop_forecasts = best_time(lambda: np.stack([loop_forecast(model_path, window) for window in windows]), repeat=1)
+
+        # The first call loads the model and compiles the forecast function
+        start = time.perf_counter()
+        forecast(model_path, windows)
+        warmup_time = time.perf_counter() - start
+        batched_time, batched_forecasts = best_time(lambda: forecast(model_path, windows))
+        forecast(direct_model_path, windows)
+        direct_time, _ = best_time(lambda: forecast(direct_model_path, windows))
+
+        np.testing.assert_allclose(batched_forecasts, loop_forecasts, rtol=1e-4, atol=1e-5)
+
+        print(f"Original loop, 5 zones:             {loop_time:.3f} s")
+        print(f"Batched autoregressive (first call): {warmup_time:.3f} s")
+        print(f"Batched autoregressive:              {batched_time * 1000:.1f} ms")
+        print(f"Direct 24-output head:               {direct_time * 1000:.1f} ms")
@@ -0,0 +1,50 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Benchmark the streaming XML parser against the original ElementTree parser.
+
+Usage: python benchmarks/bench_parse_xml.py [years]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from data_preprocessor import parse_xml_to_df
+from legacy_parser import parse_xml_to_df_legacy
+from schema import apply_schema
+from synthetic import write_day_ahead_xml
+
+def time_parser(parser, xml_file_path, repeat=3):
+    """
+    Return the best wall time of `repeat` runs and the parsed DataFrame.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = parser(xml_file_path)
+        best = min(best, time.perf_counter() - start)
+    return best, df
+
+if __name__ == "__main__":
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        end_date = (pd.Timestamp('20190101') + pd.DateOffset(years=years) - pd.Timedelta(days=1)).strftime('%Y%m%d')
+        xml_file = write_day_ahead_xml(tmp_dir, 'NO1', '20190101', end_date)
+
+        legacy_time, legacy_df = time_parser(parse_xml_to_df_legacy, xml_file)
+        stream_time, stream_df = time_parser(parse_xml_to_df, xml_file)
+
+        # The synthetic data is hourly, so the legacy parser's fixed one-hour period_end agrees
+        pd.testing.assert_frame_equal(stream_df, apply_schema(legacy_df))
+
+        print(f"Rows: {len(stream_df)}")
+        print(f"parse_xml_to_df_legacy: {legacy_time:.3f} s")
+        print(f"parse_xml_to_df:        {stream_time:.3f} s ({legacy_time / stream_time:.1f}x faster)")
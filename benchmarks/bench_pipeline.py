@@ -0,0 +1,72 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Benchmark the staged pipeline (process_files, clean_file, normalize_area) against
+the fused pipeline.run_pipeline on synthetic raw files.
+
+Usage: python benchmarks/bench_pipeline.py [years] [storage format]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import config
+from data_preprocessor import process_files, filter_xml_files_by_year
+from data_cleaner import clean_file
+from data_normalizer import normalize_area
+from pipeline import run_pipeline
+from storage import list_stage_files, read_df
+from synthetic import write_day_ahead_xml
+
+AREA_CODE = 'NO1'
+
+def use_data_dir(data_dir):
+    config.DATA_PROCESSED_DIR = os.path.join(data_dir, '')
+    config.DATA_PREPROCESSED_DIR = os.path.join(data_dir, 'preprocessed', '')
+    config.DATA_CLEANED_DIR = os.path.join(data_dir, 'cleaned', '')
+    config.DATA_NORMALIZED_DIR = os.path.join(data_dir, 'normalized', '')
+    config.SCALER_REGISTRY_PATH = os.path.join(data_dir, 'scalers.json')
+
+def run_staged(xml_files):
+    process_files(xml_files)
+    cleaned_folder = os.path.join(config.DATA_CLEANED_DIR, AREA_CODE)
+    os.makedirs(cleaned_folder, exist_ok=True)
+    for file_path in list_stage_files(os.path.join(config.DATA_PREPROCESSED_DIR, AREA_CODE)):
+        clean_file(file_path, cleaned_folder)
+    normalize_area(AREA_CODE)
+
+if __name__ == "__main__":
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    config.STORAGE_FORMAT = sys.argv[2] if len(sys.argv) > 2 else 'csv'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.DATA_RAW_DIR = os.path.join(tmp_dir, 'raw', '')
+        # One raw file per month, like the fetcher writes for a long backfill
+        for month_start in pd.date_range('2019-01-01', periods=12 * years, freq='MS'):
+            month_end = month_start + pd.offsets.MonthEnd(0)
+            write_day_ahead_xml(os.path.join(config.DATA_RAW_DIR, AREA_CODE), AREA_CODE,
+                                month_start.strftime('%Y%m%d'), month_end.strftime('%Y%m%d'))
+        xml_files = filter_xml_files_by_year(AREA_CODE, 2019, 2019 + years - 1)
+
+        timings, frames = {}, {}
+        for name, runner in [('staged', run_staged), ('fused', run_pipeline)]:
+            use_data_dir(os.path.join(tmp_dir, name))
+            start = time.perf_counter()
+            runner(xml_files)
+            timings[name] = time.perf_counter() - start
+            files = list_stage_files(os.path.join(config.DATA_NORMALIZED_DIR, AREA_CODE))
+            frames[name] = [read_df(file_path) for file_path in files]
+
+        for staged_df, fused_df in zip(frames['staged'], frames['fused']):
+            pd.testing.assert_frame_equal(fused_df, staged_df)
+
+        print(f"{years} year(s) of {AREA_CODE}, {config.STORAGE_FORMAT} storage")
+        print(f"staged: {timings['staged']:.3f} s")
+        print(f"fused:  {timings['fused']:.3f} s ({timings['staged'] / timings['fused']:.1f}x faster)")
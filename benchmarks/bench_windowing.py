@@ -0,0 +1,57 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Benchmark the sliding-window sequence builder against the original loop.
+
+Usage: python benchmarks/bench_windowing.py [years] [horizon]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from windowing import make_sequences
+
+def loop_sequences(data, look_back=24, horizon=1):
+    """
+    The original train.prepare_sequences loop, extended to several target hours.
+    """
+    input_sequences, target_prices = [], []
+    for i in range(len(data) - look_back - horizon + 1):
+        input_sequences.append(data[i:(i + look_back), 1:].astype(np.float32))
+        target_prices.append(data[i + look_back:i + look_back + horizon, 0].astype(float))
+    return np.array(input_sequences), np.array(target_prices)
+
+def measure(builder, data, horizon):
+    """
+    Return the wall time, the peak memory allocated and the result of building the windows.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(data, horizon=horizon)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+if __name__ == "__main__":
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    horizon = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+    data = np.random.default_rng(0).random((years * 8760, 8))
+
+    loop_time, loop_memory, (loop_inputs, loop_targets) = measure(loop_sequences, data, horizon)
+    window_time, window_memory, (inputs, targets) = measure(make_sequences, data, horizon)
+
+    np.testing.assert_array_equal(inputs, loop_inputs)
+    np.testing.assert_allclose(targets.reshape(loop_targets.shape), loop_targets, rtol=1e-6)
+
+    print(f"Windows: {len(inputs)} x {inputs.shape[1:]}, horizon {horizon}")
+    print(f"loop:           {loop_time:.3f} s, {loop_memory / 2**20:.1f} MiB")
+    print(f"make_sequences: {window_time:.4f} s, {window_memory / 2**20:.1f} MiB "
+          f"({loop_memory / window_memory:.0f}x less memory)")
@@ -0,0 +1,118 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+The original ElementTree parser of the day-ahead XML files, unchanged.
+
+It is the reference for the parser equivalence test and bench_parse_xml.py. It
+returns the frame without the column schema and ends every row one hour after
+its start, whatever the resolution of its period.
+"""
+
+import os
+from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
+import pandas as pd
+import pytz
+
+namespace_cache = {}  # Cache for storing namespaces
+
+def extract_namespace(xml_file_path):
+    for _, elem in ET.iterparse(xml_file_path, events=("start",)):
+        # Get the namespace from the first element
+        namespace = elem.tag.split('}')[0].strip('{')
+        return namespace
+
+def get_namespace(area_code, xml_file_path):
+    if area_code not in namespace_cache:
+        namespace_uri = extract_namespace(xml_file_path)
+        namespace_cache[area_code] = {'ns': namespace_uri}  # Store as a dictionary
+    return namespace_cache[area_code]
+
+def parse_xml_to_df_legacy(xml_file_path):
+    """
+    Parse the XML file containing electricity price data and convert it to a pandas DataFrame.
+
+    Parameters:
+    xml_file_path (str): The path to the XML file containing the data.
+
+    Returns:
+    DataFrame: The converted data as a pandas DataFrame.
+    """
+
+    area_code = os.path.basename(xml_file_path).split('_')[0]
+    # Assuming get_namespace is a function defined elsewhere in your code
+    ns = get_namespace(area_code, xml_file_path)
+
+    # Extracting start and end dates from the file name
+    file_name_parts = os.path.basename(xml_file_path).split('_')
+    file_start_date = ''.join(file_name_parts[1:4])  # Joins year, month, day
+    file_end_date = ''.join(file_name_parts[5:8])   # Joins year, month, day
+
+    tree = ET.parse(xml_file_path)
+    root = tree.getroot()
+
+    data_records = []
+    
+    # Define UTC and UTC+1 timezones
+    utc_plus_1 = pytz.FixedOffset(60)  # 60 minutes offset for UTC+1
+
+    # Convert input dates to offset-aware UTC+1
+    start_date = datetime.strptime(file_start_date, '%Y%m%d')
+    end_date = datetime.strptime(file_end_date, '%Y%m%d') + timedelta(days=1) - timedelta(seconds=1)
+
+    start_date_utc1 = utc_plus_1.localize(start_date)
+    end_date_utc1 = utc_plus_1.localize(end_date)
+
+    for timeseries in root.findall('.//ns:TimeSeries', ns):
+        business_type = timeseries.find('ns:businessType', ns).text
+        in_domain = timeseries.find('ns:in_Domain.mRID', ns).text
+        out_domain = timeseries.find('ns:out_Domain.mRID', ns).text
+        currency = timeseries.find('ns:currency_Unit.name', ns).text
+
+        for period in timeseries.findall('.//ns:Period', ns):
+            period_start_str = period.find('.//ns:timeInterval/ns:start', ns).text
+            
+            # Convert the string to a datetime object
+            period_start = datetime.fromisoformat(period_start_str)
+
+            # Localize to UTC if tzinfo is None
+            if period_start.tzinfo is None:
+                period_start = pytz.utc.localize(period_start)
+
+            for point in period.findall('.//ns:Point', ns):
+                position = int(point.find('ns:position', ns).text)
+                price_amount = float(point.find('ns:price.amount', ns).text)
+
+                hour_adjustment = timedelta(hours=position - 1)
+
+                # Convert the measurement start time to UTC+1
+                measurement_start_time_utc1 = period_start + hour_adjustment
+                measurement_start_time_utc1 = measurement_start_time_utc1.astimezone(pytz.FixedOffset(60))
+
+                # Check if measurement_start_time is within the specified date range
+                if not (measurement_start_time_utc1 >= start_date_utc1 and measurement_start_time_utc1 <= end_date_utc1):
+                    continue
+
+                # Set end time
+                measurement_end_time_utc1 = measurement_start_time_utc1 + timedelta(hours=1)
+
+                data_records.append({
+                    'price': price_amount,
+                    'business_type': business_type,
+                    'in_domain': in_domain,
+                    'out_domain': out_domain,
+                    'currency': currency,
+                    'period_start': measurement_start_time_utc1.isoformat(),
+                    'period_end': measurement_end_time_utc1.isoformat()
+                })
+
+    df = pd.DataFrame(data_records)
+
+    # Only convert if 'period_start' column exists
+    if 'period_start' in df.columns:
+        df['period_start'] = pd.to_datetime(df['period_start'])
+        df['period_end'] = pd.to_datetime(df['period_end'])
+
+    return df
@@ -0,0 +1,317 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+"""
+Time every pipeline stage on synthetic ENTSO-E data and compare against a stored baseline.
+
+For every data size (years of data, at hourly or 15-minute resolution) synthetic
+day-ahead documents are written for all zones, one per month like a backfill, and
+each stage is run on them. A stage is timed as the best of --repeat runs, and its
+peak Python memory is measured in one more run under tracemalloc. The startup time
+and peak RSS of the command line entry points are measured in fresh interpreters,
+along with the heavy libraries each one imports. The results are
+written to JSON and compared against the baseline, and any stage that got slower or
+needs more memory than the baseline allows for is reported as a regression.
+
+Usage:
+python benchmarks/run_benchmarks.py --years 1,3 --resolutions 60,15
+python benchmarks/run_benchmarks.py --save-baseline   # Accept the current results as the baseline
+
+Exits with status 1 if a regression was found.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import config
+import data_loader
+from data_cleaner import clean_data
+from data_normalizer import normalize_data, FEATURE_COLUMNS
+from data_preprocessor import parse_xml_to_df, process_files, filter_xml_files_by_year
+from scaler_registry import update_scaler
+from storage import read_df, stage_file_path
+from synthetic import write_day_ahead_xml, AREA_DOMAINS
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(BENCHMARK_DIR, 'results', 'latest.json')
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+FIRST_YEAR = 2019
+
+# Modules imported at the start of a batch run of each kind, see main.py
+STARTUP_IMPORTS = {
+    'cli': ['main'],
+    'fetch': ['main', 'backfill'],
+    'clean': ['main', 'data_cleaner'],
+    'normalize': ['main', 'data_normalizer'],
+    'train': ['main', 'train'],
+}
+# Libraries that take long to import, and the jobs that need them
+HEAVY_MODULES = ['tensorflow', 'keras', 'sklearn', 'matplotlib', 'entsoe', 'requests']
+
+def measure(function, repeat, setup=None):
+    """
+    Run a function repeat times for its best wall time and once more under tracemalloc for its peak memory.
+
+    Parameters:
+    function (callable): The function to time.
+    repeat (int): Number of timed runs.
+    setup (callable, optional): Called before every run, outside the timing, e.g. to
+        remove what the previous run wrote so that every run does the same work.
+
+    Returns:
+    tuple: (best seconds, peak MiB, result of the last run).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak / 2**20, result
+
+def write_raw_data(raw_dir, area_codes, years, resolution_minutes):
+    """
+    Write one synthetic document per zone and month.
+    """
+    config.DATA_RAW_DIR = os.path.join(raw_dir, '')
+    for seed, area_code in enumerate(area_codes):
+        for month_start in pd.date_range(f'{FIRST_YEAR}-01-01', periods=12 * years, freq='MS'):
+            month_end = month_start + pd.offsets.MonthEnd(0)
+            write_day_ahead_xml(os.path.join(raw_dir, area_code), area_code, month_start.strftime('%Y%m%d'),
+                                month_end.strftime('%Y%m%d'), resolution_minutes=resolution_minutes, seed=seed)
+
+def use_data_dir(data_dir):
+    config.DATA_PROCESSED_DIR = os.path.join(data_dir, '')
+    config.DATA_PREPROCESSED_DIR = os.path.join(data_dir, 'preprocessed', '')
+    config.DATA_CLEANED_DIR = os.path.join(data_dir, 'cleaned', '')
+    config.DATA_NORMALIZED_DIR = os.path.join(data_dir, 'normalized', '')
+    config.FEATURE_STORE_DIR = os.path.join(data_dir, 'features', '')
+    config.SCALER_REGISTRY_PATH = os.path.join(data_dir, 'scalers.json')
+
+def benchmark_size(area_codes, years, resolution_minutes, repeat):
+    """
+    Run every stage on one data size.
+
+    Returns:
+    dict: {'seconds', 'peak_mib', 'rows'} of every stage, or {'skipped': reason}.
+    """
+    results = {}
+
+    def run(stage, function, rows=None, setup=None):
+        seconds, peak_mib, result = measure(function, repeat, setup)
+        results[stage] = {'seconds': round(seconds, 6), 'peak_mib': round(peak_mib, 3),
+                          'rows': rows(result) if rows else None}
+        print(f"  {stage:<22} {seconds:9.4f} s {peak_mib:9.1f} MiB")
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_raw_data(os.path.join(tmp_dir, 'raw'), area_codes, years, resolution_minutes)
+        use_data_dir(os.path.join(tmp_dir, 'processed'))
+        area_code, last_year = area_codes[0], FIRST_YEAR + years - 1
+        zone_files = filter_xml_files_by_year(area_code, FIRST_YEAR, last_year)
+        all_files = [xml_file for code in area_codes for xml_file in filter_xml_files_by_year(code, FIRST_YEAR, last_year)]
+
+        run('parse_xml_to_df', lambda: [parse_xml_to_df(xml_file) for xml_file in zone_files],
+            rows=lambda frames: sum(len(df) for df in frames))
+        # Every run starts from an empty preprocessed stage, instead of merging into the files of the run before
+        run('process_files', lambda: process_files(all_files),
+            setup=lambda: shutil.rmtree(config.DATA_PREPROCESSED_DIR, ignore_errors=True))
+
+        # The other stages work on the data of the first zone
+        preprocessed = pd.concat([read_df(stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year))
+                                  for year in range(FIRST_YEAR, last_year + 1)], ignore_index=True)
+        cleaned = run('clean_data', lambda: clean_data(preprocessed), rows=len)
+        scaler = update_scaler(area_code, [cleaned], refit=True)
+        # normalize_data changes the frame it is given, so every run gets a copy
+        normalized = run('normalize_data', lambda: normalize_data(cleaned.copy(), scaler), rows=len)
+
+        file_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, last_year)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        normalized[normalized['period_start'].dt.year == last_year].to_csv(file_path, index=False)
+
+        def load_uncached():
+            data_loader.clear_cache()
+            return data_loader.load_data(last_year, area_code, 'normalized', columns=FEATURE_COLUMNS)
+        run('load_data', load_uncached, rows=len)
+        run('load_data_cached', lambda: data_loader.load_data(last_year, area_code, 'normalized', columns=FEATURE_COLUMNS), rows=len)
+
+        from train import prepare_sequences
+        data = normalized[FEATURE_COLUMNS].values
+        run('prepare_sequences', lambda: [np.ascontiguousarray(array) for array in prepare_sequences(data, horizon=24)],
+            rows=lambda arrays: len(arrays[0]))
+
+        try:
+            from predict_and_visualize import predict_next_24_hours, reshape_data_for_prediction
+        except ImportError as e:
+            results['predict_next_24_hours'] = {'skipped': str(e)}
+            print(f"  {'predict_next_24_hours':<22} skipped: {e}")
+        else:
+            from model import create_model
+            model = create_model(input_shape=(24, len(FEATURE_COLUMNS) - 1))
+            windows = reshape_data_for_prediction(data[-48:])
+            predict_next_24_hours(model, windows, area_code)  # Compile the forecast function once, like a server warm-up
+            run('predict_next_24_hours', lambda: predict_next_24_hours(model, windows, area_code), rows=len)
+
+    return results
+
+# Run in a fresh interpreter by measure_startup: import the modules of a job, then
+# report the heavy libraries they loaded and the peak RSS. The high-water mark is read
+# from /proc where available, since ru_maxrss also counts the parent's memory on Linux.
+STARTUP_SCRIPT = """
+import sys
+sys.path.insert(0, {src_dir!r})
+import {modules}
+try:
+    with open('/proc/self/status') as file:
+        peak_rss = next(int(line.split()[1]) * 1024 for line in file if line.startswith('VmHWM:'))
+except OSError:
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+print(peak_rss, *[name for name in {heavy_modules!r} if name in sys.modules])
+"""
+
+def measure_startup(modules, repeat):
+    """
+    Import modules in fresh interpreters, like a command line entry point starting up.
+
+    Returns:
+    dict: {'seconds', 'peak_mib', 'heavy_modules'}: the best wall time of repeat
+        interpreters including the interpreter's own startup, their peak RSS and the
+        HEAVY_MODULES they imported.
+    """
+    script = STARTUP_SCRIPT.format(src_dir=SRC_DIR, modules=', '.join(modules), heavy_modules=HEAVY_MODULES)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        best = min(best, time.perf_counter() - start)
+    peak_rss, *heavy_modules = output.split()
+    return {'seconds': round(best, 6), 'peak_mib': round(int(peak_rss) / 2**20, 3), 'heavy_modules': heavy_modules}
+
+def benchmark_startup(repeat):
+    """
+    Measure the startup of every kind of batch run, see STARTUP_IMPORTS.
+    """
+    results = {}
+    for job, modules in STARTUP_IMPORTS.items():
+        result = measure_startup(modules, repeat)
+        results[job] = result
+        print(f"  {job:<22} {result['seconds']:9.4f} s {result['peak_mib']:9.1f} MiB  "
+              f"{', '.join(result['heavy_modules']) or 'no heavy imports'}")
+    return results
+
+def run_suite(area_codes, years_list, resolutions, repeat):
+    """
+    Run every stage on every data size.
+
+    Returns:
+    dict: The run's metadata, and the results keyed by '<stage>[<years>y,<resolution>min]'.
+    """
+    print("Startup")
+    results = {f"startup[{job}]": result for job, result in benchmark_startup(repeat).items()}
+    for years in years_list:
+        for resolution_minutes in resolutions:
+            print(f"{years} year(s), {len(area_codes)} zone(s), {resolution_minutes}-minute resolution")
+            for stage, result in benchmark_size(area_codes, years, resolution_minutes, repeat).items():
+                results[f"{stage}[{years}y,{resolution_minutes}min]"] = result
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+        'settings': {'zones': area_codes, 'years': years_list, 'resolutions': resolutions, 'repeat': repeat,
+                     'storage_format': config.STORAGE_FORMAT},
+        'results': results,
+    }
+
+def compare(run, baseline, time_tolerance, memory_tolerance, min_seconds=0.005):
+    """
+    Compare a run against a baseline.
+
+    A stage regressed if it is more than time_tolerance slower, or needs more than
+    memory_tolerance more peak memory, than in the baseline. Slowdowns of less than
+    min_seconds are timer noise and never count. Stages missing from either side
+    are not compared.
+
+    Returns:
+    list: Descriptions of the regressions.
+    """
+    regressions = []
+    for key, result in sorted(run['results'].items()):
+        reference = baseline['results'].get(key)
+        if reference is None or 'skipped' in result or 'skipped' in reference:
+            continue
+        if result['seconds'] > reference['seconds'] * (1 + time_tolerance) + min_seconds:
+            regressions.append(f"{key}: {result['seconds']:.4f} s vs {reference['seconds']:.4f} s in the baseline")
+        if result['peak_mib'] > reference['peak_mib'] * (1 + memory_tolerance):
+            regressions.append(f"{key}: {result['peak_mib']:.1f} MiB vs {reference['peak_mib']:.1f} MiB in the baseline")
+    return regressions
+
+def write_json(data, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic ENTSO-E data.")
+    parser.add_argument('--years', default='1', help="Comma-separated years of data per size, 1 to 10 (default: 1)")
+    parser.add_argument('--resolutions', default='60,15', help="Comma-separated resolutions in minutes (default: 60,15)")
+    parser.add_argument('--zones', type=int, default=len(AREA_DOMAINS), help="Number of zones, NO1 first (default: 5)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage, the best counts (default: 3)")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="JSON file for the results")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="JSON file of the baseline to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline")
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help="Allowed slowdown (default: 0.25 = 25%%)")
+    parser.add_argument('--memory-tolerance', type=float, default=0.10, help="Allowed memory growth (default: 0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    years_list = [int(years) for years in args.years.split(',')]
+    resolutions = [int(resolution) for resolution in args.resolutions.split(',')]
+    area_codes = sorted(AREA_DOMAINS)[:args.zones]
+
+    run = run_suite(area_codes, years_list, resolutions, args.repeat)
+    write_json(run, args.output)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        write_json(run, args.baseline)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one.")
+        return 0
+
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)
+    regressions = compare(run, baseline, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import numpy as np
+import pandas as pd
+
+NAMESPACE = 'urn:iec62325.351:tc57wg16:451-3:publicationdocument:7:0'
+
+AREA_DOMAINS = {
+    "NO1": "10YNO-1--------2",
+    "NO2": "10YNO-2--------T",
+    "NO3": "10YNO-3--------J",
+    "NO4": "10YNO-4--------9",
+    "NO5": "10Y1001A1001A48H"
+}
+
+def day_ahead_file_name(area_code, start_date, end_date):
+    """
+    Build the raw file name used by data_fetcher for a date range.
+    """
+    return f"{area_code}_{start_date.strftime('%Y_%m_%d')}_to_{end_date.strftime('%Y_%m_%d')}_day_ahead_prices.xml"
+
+def write_day_ahead_xml(folder, area_code, start_date, end_date, resolution_minutes=60, seed=0):
+    """
+    Write a synthetic ENTSO-E day-ahead price document covering start_date to end_date.
+
+    The document has one TimeSeries per delivery day, with the day boundaries
+    taken in Europe/Oslo time like the real data (so DST days have 23 or 25 hours).
+
+    Parameters:
+    folder (str): Directory to write the file to.
+    area_code (str): Area code, e.g. 'NO1'.
+    start_date (str): First delivery day, 'YYYYMMDD'.
+    end_date (str): Last delivery day, 'YYYYMMDD'.
+    resolution_minutes (int): Resolution of the points, 60 or 15.
+    seed (int): Seed for the generated prices.
+
+    Returns:
+    str: Path to the written file.
+    """
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    domain = AREA_DOMAINS[area_code]
+    rng = np.random.default_rng(seed)
+    step = pd.Timedelta(minutes=resolution_minutes)
+
+    days = pd.date_range(start, end + pd.Timedelta(days=1), freq='D', tz='Europe/Oslo').tz_convert('UTC')
+    utc_format = '%Y-%m-%dT%H:%MZ'
+
+    os.makedirs(folder, exist_ok=True)
+    file_path = os.path.join(folder, day_ahead_file_name(area_code, start, end))
+
+    with open(file_path, 'w') as f:
+        f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<Publication_MarketDocument xmlns="{NAMESPACE}">\n')
+        f.write('  <mRID>synthetic</mRID>\n  <type>A44</type>\n')
+        f.write(f'  <period.timeInterval>\n    <start>{days[0].strftime(utc_format)}</start>\n'
+                f'    <end>{days[-1].strftime(utc_format)}</end>\n  </period.timeInterval>\n')
+
+        for number, (day_start, day_end) in enumerate(zip(days[:-1], days[1:]), start=1):
+            num_points = int((day_end - day_start) / step)
+            prices = np.round(50 + 30 * rng.standard_normal(num_points), 2)
+
+            f.write(f'  <TimeSeries>\n    <mRID>{number}</mRID>\n    <businessType>A62</businessType>\n'
+                    f'    <in_Domain.mRID codingScheme="A01">{domain}</in_Domain.mRID>\n'
+                    f'    <out_Domain.mRID codingScheme="A01">{domain}</out_Domain.mRID>\n'
+                    '    <currency_Unit.name>EUR</currency_Unit.name>\n'
+                    '    <price_Measure_Unit.name>MWH</price_Measure_Unit.name>\n'
+                    '    <curveType>A01</curveType>\n    <Period>\n'
+                    f'      <timeInterval>\n        <start>{day_start.strftime(utc_format)}</start>\n'
+                    f'        <end>{day_end.strftime(utc_format)}</end>\n      </timeInterval>\n'
+                    f'      <resolution>PT{resolution_minutes}M</resolution>\n')
+            f.writelines(
+                f'      <Point>\n        <position>{position}</position>\n'
+                f'        <price.amount>{price}</price.amount>\n      </Point>\n'
+                for position, price in enumerate(prices, start=1)
+            )
+            f.write('    </Period>\n  </TimeSeries>\n')
+
+        f.write('</Publication_MarketDocument>\n')
+
+    return file_path
@@ -0,0 +1,250 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import glob
+import json
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import config
+from data_fetcher import fetch_jobs, describe_error, MAX_DAYS_PER_REQUEST, UTC_PLUS_1
+from data_preprocessor import parse_xml_to_df
+from storage import list_stage_files, read_df
+
+def merge_intervals(starts, ends):
+    """
+    Merge overlapping or touching [start, end) intervals.
+
+    Parameters:
+    starts (np.array): Interval starts as int64 nanoseconds.
+    ends (np.array): Interval ends as int64 nanoseconds.
+
+    Returns:
+    tuple: (starts, ends) of the merged, sorted intervals.
+    """
+    if len(starts) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    order = np.argsort(starts, kind='stable')
+    starts = np.asarray(starts)[order]
+    ends = np.asarray(ends)[order]
+
+    # An interval starts a new group when it begins after everything before it has ended
+    running_end = np.maximum.accumulate(ends)
+    group_starts = np.flatnonzero(np.r_[True, starts[1:] > running_end[:-1]])
+    return starts[group_starts], np.maximum.reduceat(ends, group_starts)
+
+def get_raw_coverage(area_code):
+    """
+    Get the time covered by the rows of the raw files of an area code.
+
+    The files are parsed rather than trusting the date range in their names, which
+    also claims the days a file was fetched for before their prices were published.
+    Files that cannot be parsed cover nothing, so their range is fetched again.
+
+    Returns:
+    tuple: (starts, ends) of [start, end) intervals as int64 nanoseconds.
+    """
+    starts, ends = [], []
+    for xml_file in glob.glob(os.path.join(config.DATA_RAW_DIR, area_code, '*.xml')):
+        try:
+            df = parse_xml_to_df(xml_file)
+        except (ET.ParseError, ValueError, TypeError, AttributeError) as e:
+            print(f"Could not read {xml_file}, its range is fetched again: {e}")
+            continue
+        starts.append(df['period_start'].dt.tz_convert('UTC').values.astype(np.int64))
+        ends.append(df['period_end'].dt.tz_convert('UTC').values.astype(np.int64))
+    if not starts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return merge_intervals(np.concatenate(starts), np.concatenate(ends))
+
+def get_preprocessed_coverage(area_code):
+    """
+    Get the time covered by the rows of the preprocessed files of an area code.
+
+    Only the period_start and period_end columns are read, so holes inside a
+    yearly file are found as well.
+
+    Returns:
+    tuple: (starts, ends) of [start, end) intervals as int64 nanoseconds.
+    """
+    starts, ends = [], []
+    for file_path in list_stage_files(os.path.join(config.DATA_PREPROCESSED_DIR, area_code)):
+        df = read_df(file_path, columns=['period_start', 'period_end'])
+        starts.append(df['period_start'].dt.tz_convert('UTC').values.astype(np.int64))
+        ends.append(df['period_end'].dt.tz_convert('UTC').values.astype(np.int64))
+    if not starts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return merge_intervals(np.concatenate(starts), np.concatenate(ends))
+
+def find_missing_ranges(start, end, covered_starts, covered_ends):
+    """
+    Find the parts of [start, end) that are not covered by any of the given intervals.
+
+    Parameters:
+    start (Timestamp): Start of the requested range.
+    end (Timestamp): End of the requested range, excluded.
+    covered_starts (np.array): Covered interval starts as int64 nanoseconds.
+    covered_ends (np.array): Covered interval ends as int64 nanoseconds.
+
+    Returns:
+    list: (start, end) Timestamps in UTC+1 of the missing ranges.
+    """
+    covered_starts, covered_ends = merge_intervals(covered_starts, covered_ends)
+
+    missing = []
+    current = start.value
+    for covered_start, covered_end in zip(covered_starts, covered_ends):
+        if covered_end <= current:
+            continue
+        if covered_start >= end.value:
+            break
+        if covered_start > current:
+            missing.append((current, covered_start))
+        current = max(current, covered_end)
+    if current < end.value:
+        missing.append((current, end.value))
+
+    return [(pd.Timestamp(gap_start, tz='UTC').tz_convert(UTC_PLUS_1), pd.Timestamp(gap_end, tz='UTC').tz_convert(UTC_PLUS_1))
+            for gap_start, gap_end in missing]
+
+def missing_ranges_to_windows(missing_ranges, max_days_per_request=MAX_DAYS_PER_REQUEST):
+    """
+    Turn missing time ranges into day windows for the fetcher.
+
+    Every day touched by a missing range is fetched. Windows that overlap or touch
+    are combined and then split so that none is longer than max_days_per_request.
+
+    Returns:
+    list: (window start, window end) naive Timestamps of the first and last day of each window.
+    """
+    day_ranges = []
+    for gap_start, gap_end in missing_ranges:
+        first_day = gap_start.tz_localize(None).floor('D')
+        last_day = (gap_end - pd.Timedelta(1)).tz_localize(None).floor('D')
+        if day_ranges and first_day <= day_ranges[-1][1] + pd.Timedelta(days=1):
+            day_ranges[-1] = (day_ranges[-1][0], max(day_ranges[-1][1], last_day))
+        else:
+            day_ranges.append((first_day, last_day))
+
+    windows = []
+    for first_day, last_day in day_ranges:
+        current = first_day
+        while current <= last_day:
+            window_end = min(current + pd.Timedelta(days=max_days_per_request - 1), last_day)
+            windows.append((current, window_end))
+            current = window_end + pd.Timedelta(days=1)
+    return windows
+
+def get_job_key(job):
+    area_code_name, window_start, window_end = job
+    return f"{area_code_name}_{window_start.strftime('%Y%m%d')}_{window_end.strftime('%Y%m%d')}"
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return {'jobs': {}}
+    with open(checkpoint_path, 'r') as file:
+        return json.load(file)
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    checkpoint['updated'] = datetime.now(timezone.utc).isoformat()
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(checkpoint, file, indent=2, sort_keys=True)
+    os.replace(temp_path, checkpoint_path)
+
+def is_finished(job, entry):
+    """
+    Check if the checkpoint entry of a job means that it does not need to be fetched again.
+
+    Done jobs are finished. A window without data is only taken as final once it was
+    checked config.BACKFILL_EMPTY_FINAL_DAYS days after its last day, since the prices
+    of recent days may not have been published yet at the time of the check.
+    """
+    if entry['status'] == 'done':
+        return True
+    if entry['status'] != 'empty' or not entry.get('checked'):
+        return False
+    final_from = job[2].tz_localize(UTC_PLUS_1) + pd.Timedelta(days=1 + config.BACKFILL_EMPTY_FINAL_DAYS)
+    return pd.Timestamp(entry['checked']) >= final_from
+
+def plan_backfill(start_date, end_date, area_code_names, checkpoint=None):
+    """
+    Plan the fetch jobs needed to cover a date range for several area codes.
+
+    Time already covered by the rows of a raw or preprocessed file is skipped, and
+    so are windows that the checkpoint records as finished (see is_finished).
+
+    Parameters:
+    start_date (str): First day (YYYYMMDD).
+    end_date (str): Last day (YYYYMMDD), included.
+    area_code_names (list): Area codes, e.g. ['NO1', 'NO2'].
+    checkpoint (dict, optional): Checkpoint of an earlier run.
+
+    Returns:
+    list: (area code, window start, window end) jobs.
+    """
+    start = pd.Timestamp(start_date).tz_localize(UTC_PLUS_1)
+    end = pd.Timestamp(end_date).tz_localize(UTC_PLUS_1) + pd.Timedelta(days=1)
+    entries = (checkpoint or {'jobs': {}})['jobs']
+
+    jobs = []
+    for area_code_name in area_code_names:
+        raw_starts, raw_ends = get_raw_coverage(area_code_name)
+        preprocessed_starts, preprocessed_ends = get_preprocessed_coverage(area_code_name)
+        missing_ranges = find_missing_ranges(start, end, np.concatenate([raw_starts, preprocessed_starts]),
+                                             np.concatenate([raw_ends, preprocessed_ends]))
+
+        for window_start, window_end in missing_ranges_to_windows(missing_ranges):
+            job = (area_code_name, window_start, window_end)
+            entry = entries.get(get_job_key(job))
+            if entry is None or not is_finished(job, entry):
+                jobs.append(job)
+    return jobs
+
+def run_backfill(start_date, end_date, area_code_names, checkpoint_path=None, **fetch_kwargs):
+    """
+    Fetch the missing data of a date range for several area codes, resuming from a checkpoint.
+
+    The outcome of every job is written to the checkpoint as soon as it finishes, so
+    an interrupted run continues with the windows that are still missing.
+
+    Parameters:
+    start_date (str): First day (YYYYMMDD).
+    end_date (str): Last day (YYYYMMDD), included.
+    area_code_names (list): Area codes, e.g. ['NO1', 'NO2'].
+    checkpoint_path (str, optional): Checkpoint file, config.BACKFILL_CHECKPOINT_PATH by default.
+    fetch_kwargs: Passed on to data_fetcher.fetch_jobs.
+
+    Returns:
+    tuple: (results, failures), see data_fetcher.fetch_jobs.
+    """
+    checkpoint_path = checkpoint_path or config.BACKFILL_CHECKPOINT_PATH
+    os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    jobs = plan_backfill(start_date, end_date, area_code_names, checkpoint)
+    print(f"Backfill needs {len(jobs)} request(s) for {', '.join(area_code_names)}.")
+
+    def record(job, file_path, error):
+        if error is not None:
+            status = {'status': 'failed', 'error': describe_error(error)}
+        elif file_path is None:
+            status = {'status': 'empty', 'checked': datetime.now(timezone.utc).isoformat()}
+        else:
+            status = {'status': 'done', 'file': os.path.basename(file_path)}
+        checkpoint['jobs'][get_job_key(job)] = status
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    return fetch_jobs(jobs, on_complete=record, **fetch_kwargs)
+
+if __name__ == "__main__":
+    area_code_names = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
+    start_date = input("Enter the start date (YYYYMMDD): ")
+    end_date = input("Enter the end date (YYYYMMDD): ")
+
+    results, failures = run_backfill(start_date, end_date, area_code_names)
+    print(f"Backfill finished: {len(results)} window(s) fetched, {len(failures)} failed.")
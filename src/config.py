@@ -13,8 +13,64 @@ DATA_PROCESSED_DIR = BASE_DATA_DIR + 'processed/'
 DATA_PREPROCESSED_DIR = DATA_PROCESSED_DIR + 'preprocessed/'
 DATA_CLEANED_DIR = DATA_PROCESSED_DIR + 'cleaned/'
 DATA_NORMALIZED_DIR = DATA_PROCESSED_DIR + 'normalized/'
+FEATURE_STORE_DIR = DATA_PROCESSED_DIR + 'features/'  # float32 arrays of the normalized features, see feature_store
+
+# Storage format for the processed stages: 'csv', 'parquet' or 'feather'
+STORAGE_FORMAT = 'csv'
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_SIZE = 24 * 31  # About one month of hourly data, so date filters can skip row groups
+CHUNK_SIZE = 50000  # Rows held in memory at a time when the clean and normalize stages stream a file
+WRITE_INTERMEDIATE_STAGES = False  # Whether pipeline.run_pipeline also writes the preprocessed and cleaned stages
+USE_FEATURE_STORE = True  # Whether training maps the feature store arrays instead of parsing the normalized files
+DATA_CACHE_MAX_BYTES = 512 * 1024 ** 2  # Memory held by the frames data_loader keeps in its in-process cache
+
+# ENTSO-E Transparency Platform API used by the concurrent fetcher
+ENTSOE_API_URL = 'https://web-api.tp.entsoe.eu/api'
+FETCH_WORKERS = 4  # Number of (zone, window) requests in flight
+FETCH_REQUESTS_PER_MINUTE = 300  # The API allows 400 requests per minute per user
+FETCH_MAX_RETRIES = 5
+FETCH_BACKOFF_SECONDS = 2  # Initial retry delay, doubled on every retry
+BACKFILL_CHECKPOINT_PATH = DATA_RAW_DIR + 'backfill_checkpoint.json'
+BACKFILL_EMPTY_FINAL_DAYS = 2  # Days after its last day from which a window without data is not fetched again
 
 # Other configurations
 MODEL_SAVE_PATH = 'outputs/models/'
 TRAINING_EPOCHS = 100  #It seems like this might need to be updated later on, increasing the number of EPOCH's
-BATCH_SIZE = 32
\ No newline at end of file
+BATCH_SIZE = 32
+SCALER_REGISTRY_PATH = MODEL_SAVE_PATH + 'scalers.json'  # Fitted scalers of every area code, saved next to the models
+SHUFFLE_BUFFER_SIZE = 10000  # Training windows held in the shuffle buffer of the input pipeline
+WINDOW_CHUNK_SIZE = 256  # Windows copied out of a yearly file at a time when streaming training data
+INTERLEAVE_CYCLE_LENGTH = 4  # Yearly files read at a time when streaming training data, mixed further by the shuffle buffer
+VALIDATION_YEAR = 2022
+
+# Hyperparameter sweeps (see sweep.py)
+SWEEP_WORKERS = None  # Trials trained at the same time, None fills the CPU cores with SWEEP_THREADS_PER_WORKER threads each
+SWEEP_THREADS_PER_WORKER = 2
+SWEEP_PATIENCE = 5  # Epochs without a better validation MAE before a trial stops early
+SWEEP_RESULTS_PATH = 'outputs/sweeps/results.csv'
+
+# Forecast server (see forecast_server.py)
+FORECAST_SERVER_HOST = '127.0.0.1'
+FORECAST_SERVER_PORT = 8765
+FORECAST_MODEL_PATH = MODEL_SAVE_PATH + 'trained_model1.keras'
+FORECAST_MODEL_PATHS = {}  # Area code -> model path, for area codes that do not use FORECAST_MODEL_PATH
+FORECAST_BATCH_WAIT_MS = 5  # How long concurrent requests are collected into one batch
+FORECAST_MAX_BATCH_SIZE = 64
+
+# Cleaning (see data_cleaner.py)
+CLEAN_RESOLUTION_MINUTES = 60  # Resolution of the cleaned stage: 60, or 15 to keep the 15-minute MTU
+GAP_FILL_POLICY = 'ffill'  # How missing prices are filled: 'ffill', 'interpolate' (linear in time) or 'drop' (left out)
+GAP_FILL_LIMIT = None  # Longest gap in slots that is filled, longer gaps are left out. None fills every gap
+GAP_REPORT_DIR = 'outputs/reports/gaps/'  # Directory of the gap reports of the cleaned zone-years
+
+# Run reports (see instrumentation.py)
+RUN_REPORT_PATH = None  # JSON-lines file every stage run is appended to, e.g. 'outputs/reports/run_report.jsonl'
+PROMETHEUS_REPORT_PATH = None  # Prometheus text file the totals of a batch run are written to
+PROFILE_STAGES = []  # Stages run under cProfile, e.g. ['parse', 'clean'], or ['*'] for all
+PROFILE_DIR = 'outputs/profiles/'  # Directory of the cProfile statistics of the profiled stages
+
+# Number of worker processes used to parse raw XML files in parallel, None uses all CPU cores
+PREPROCESS_WORKERS = None
+
+# Number of zones processed at the same time by a batch run of main.py, None uses one process per zone
+PIPELINE_WORKERS = None
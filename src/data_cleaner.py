@@ -3,44 +3,315 @@
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
 import pandas as pd
+import numpy as np
 import os
-import glob
 import config
-from data_processing_tracker import update_file_metadata, check_processing_stage
-from utils import save_df_to_csv
+from data_processing_tracker import update_file_metadata, check_processing_stage, get_high_water_mark, describe_df, merge_descriptions
+from data_loader import load_rows_after
+from instrumentation import track_stage
+from schema import apply_schema, CATEGORY_COLUMNS
+from storage import read_tail, write_df, iter_chunks, ChunkWriter, list_stage_files, stage_file_path, stage_file_area_year, UTC_PLUS_1
 
-def clean_data(df):
+FILL_POLICIES = ['ffill', 'interpolate', 'drop']
+GAP_REPORT_COLUMNS = ['gap_start', 'gap_end', 'slots', 'filled']
+
+def get_resolution(resolution_minutes=None):
+    return pd.Timedelta(minutes=resolution_minutes or config.CLEAN_RESOLUTION_MINUTES)
+
+def to_nanoseconds(timestamps):
+    """
+    Convert a timestamp column to int64 nanoseconds since the epoch (UTC). Naive times are UTC+1.
+    """
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is None:
+        timestamps = timestamps.dt.tz_localize(UTC_PLUS_1)
+    return timestamps.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def find_gaps(missing):
+    """
+    Find the runs of missing slots.
+
+    Returns:
+    tuple: Arrays of the first slot and the length of every run.
+    """
+    edges = np.diff(np.concatenate(([0], missing.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    return starts, np.flatnonzero(edges == -1) - starts
+
+def reindex_to_slots(df, resolution=None, fill_policy=None, fill_limit=None, gap_report=None):
+    """
+    Put the rows of a DataFrame onto a complete range of time slots and fill the gaps.
+
+    Every row is assigned to the slots it covers, in one vectorized step: rows longer
+    than a slot (hourly prices at a 15-minute resolution) are repeated for every slot,
+    and the prices of rows shorter than a slot (15-minute prices at an hourly
+    resolution) are averaged per slot. The slots then span the first to the last row
+    without holes, so missing hours and DST artefacts become rows whose price is filled
+    by the fill policy. Gaps longer than fill_limit slots, and gaps that cannot be
+    filled, are left out.
+
+    Parameters:
+    df (DataFrame): Rows with price and period_start, and optionally period_end and the TimeSeries fields.
+    resolution (Timedelta, optional): Slot length, config.CLEAN_RESOLUTION_MINUTES by default.
+    fill_policy (str, optional): One of FILL_POLICIES, config.GAP_FILL_POLICY by default.
+    fill_limit (int, optional): Longest gap in slots that is filled, config.GAP_FILL_LIMIT by default.
+    gap_report (list, optional): Gets a dict (see GAP_REPORT_COLUMNS) appended for every run of missing prices.
+
+    Returns:
+    DataFrame: One row per slot, sorted by period_start, with period_end at the end of the slot.
+    """
+    resolution = resolution or get_resolution()
+    fill_policy = fill_policy or config.GAP_FILL_POLICY
+    fill_limit = config.GAP_FILL_LIMIT if fill_limit is None else fill_limit
+    if fill_policy not in FILL_POLICIES:
+        raise ValueError(f"Unknown fill policy {fill_policy}, expected one of {', '.join(FILL_POLICIES)}")
+    if df.empty:
+        return df
+
+    step = resolution.value
+    columns = list(df.columns)
+    start_ns = to_nanoseconds(df['period_start'])
+    end_ns = to_nanoseconds(df['period_end']) if 'period_end' in columns else start_ns + step
+    df = df.drop(columns=[column for column in ('period_start', 'period_end') if column in columns])
+
+    # Repeat the rows that cover several slots, once per slot
+    repeats = np.maximum((end_ns - start_ns) // step, 1)
+    if (repeats > 1).any():
+        positions = np.repeat(np.arange(len(df)), repeats)
+        offsets = np.arange(len(positions)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        df = df.iloc[positions]
+        start_ns = start_ns[positions] + offsets * step
+    slots = start_ns - start_ns % step
+
+    # Average the rows that share a slot
+    order = np.argsort(slots, kind='stable')
+    slots = slots[order]
+    df = df.iloc[order].set_axis(slots)
+    if (np.diff(slots) == 0).any():
+        df = df.groupby(level=0, observed=True).agg(
+            {column: 'mean' if column == 'price' else 'first' for column in df.columns})
+
+    df = df.reindex(np.arange(slots[0], slots[-1] + step, step))
+    missing = df['price'].isna().to_numpy()
+    if missing.any():
+        gap_starts, gap_lengths = find_gaps(missing)
+        fillable = np.full(len(gap_starts), fill_policy != 'drop')
+        if fill_limit is not None:
+            fillable &= gap_lengths <= fill_limit
+
+        if fill_policy == 'interpolate':
+            prices = df['price'].interpolate(method='linear', limit_direction='forward')
+        else:
+            prices = df['price'].ffill()
+        fill = np.zeros(len(df), dtype=bool)
+        fill[missing] = np.repeat(fillable, gap_lengths)
+        df['price'] = df['price'].where(~fill, prices)
+        filled = ~df['price'].isna().to_numpy()[gap_starts]
+
+        if gap_report is not None:
+            gap_start = pd.to_datetime(df.index[gap_starts], utc=True).tz_convert(UTC_PLUS_1)
+            for start, length, was_filled in zip(gap_start, gap_lengths, filled):
+                gap_report.append({'gap_start': start.isoformat(), 'gap_end': (start + length * resolution).isoformat(),
+                                   'slots': int(length), 'filled': bool(was_filled)})
+        # Slots that were not filled are left out
+        df = df[df['price'].notna()]
+
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].ffill().bfill()
+
+    period_start = pd.to_datetime(df.index.to_numpy(), utc=True).tz_convert(UTC_PLUS_1)
+    df = df.reset_index(drop=True)
+    df['period_start'] = period_start
+    if 'period_end' in columns:
+        df['period_end'] = period_start + resolution
+    return apply_schema(df[columns])
+
+def clean_data(df, resolution=None, fill_policy=None, fill_limit=None, gap_report=None):
+    """
+    Clean the rows of one area code: drop duplicates, correct the data types, and put
+    the rows onto a complete range of time slots with the gaps filled (see reindex_to_slots).
+
+    Parameters:
+    df (DataFrame): The preprocessed rows.
+    resolution, fill_policy, fill_limit, gap_report: See reindex_to_slots.
+
+    Returns:
+    DataFrame: The cleaned rows, one per slot.
+    """
     # Remove duplicate rows
     df = df.drop_duplicates()
 
-    # Handle missing values
-    df['price'].ffill(inplace=True)
-
     # Correcting data types
     df['period_start'] = pd.to_datetime(df['period_start'])
     df['period_end'] = pd.to_datetime(df['period_end'])
-    df['price'] = df['price'].astype(float)
+    apply_schema(df)
 
-    # Filter unnecessary data (if any)
-    # df.drop(['unnecessary_column'], axis=1, inplace=True)
+    # Handle missing hours and missing values
+    return reindex_to_slots(df, resolution, fill_policy, fill_limit, gap_report)
 
-    return df
+def clean_chunk(df, previous_rows=None, gap_report=None):
+    """
+    Clean a chunk of rows that directly follows already cleaned rows.
 
-def clean_file(file_path, area_code_folder):
-    if check_processing_stage(file_path, 'preprocessed'):
-        df = pd.read_csv(file_path)
-        cleaned_df = clean_data(df)
+    The chunk is cleaned together with the previous rows, so that the gap filling
+    continues from them and a duplicate of the last previous row is dropped. The
+    files are sorted by period_start, so duplicates are next to each other.
+
+    Parameters:
+    df (DataFrame): The rows to clean.
+    previous_rows (DataFrame, optional): The last cleaned rows before the chunk.
+    gap_report (list, optional): See reindex_to_slots.
 
+    Returns:
+    DataFrame: The cleaned rows after the previous rows only.
+    """
+    if previous_rows is not None and not previous_rows.empty:
+        cleaned = clean_data(pd.concat([previous_rows, df], ignore_index=True), gap_report=gap_report)
+        return cleaned[cleaned['period_start'] > previous_rows['period_start'].iloc[-1]]
+    return clean_data(df.copy(), gap_report=gap_report)
+
+def iter_slot_chunks(file_path, chunk_size, resolution=None):
+    """
+    Read a data file in chunks of rows that end at slot boundaries.
+
+    The rows of the last slot of a chunk are held back for the next one, so that rows
+    averaged into one slot (see reindex_to_slots) are never split across chunks.
+
+    Yields:
+    DataFrame: The next chunk.
+    """
+    step = (resolution or get_resolution()).value
+    pending = None
+    for chunk in iter_chunks(file_path, chunk_size):
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        if chunk.empty:
+            continue
+        slots = to_nanoseconds(chunk['period_start']) // step
+        last = slots == slots.max()
+        pending = chunk[last]
+        if not last.all():
+            yield chunk[~last]
+    if pending is not None and not pending.empty:
+        yield pending
+
+def get_gap_report_path(area_code, year):
+    return os.path.join(config.GAP_REPORT_DIR, area_code, f"{area_code}_{year}_gaps.csv")
+
+def write_gap_report(gap_report, area_code, year, append=False):
+    """
+    Write the gaps found while cleaning a zone-year to its gap report, a CSV file with GAP_REPORT_COLUMNS.
+
+    Returns:
+    str: Path of the report.
+    """
+    report_path = get_gap_report_path(area_code, year)
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    exists = append and os.path.exists(report_path)
+    pd.DataFrame(gap_report, columns=GAP_REPORT_COLUMNS).to_csv(report_path, mode='a' if exists else 'w',
+                                                                  header=not exists, index=False)
+    return report_path
+
+def summarize_gaps(gap_report):
+    """
+    Count the missing slots of a gap report, for the manifest.
+    """
+    return {'missing_slots': sum(gap['slots'] for gap in gap_report),
+            'unfilled_slots': sum(gap['slots'] for gap in gap_report if not gap['filled'])}
+
+def clean_file(file_path, area_code_folder, chunk_size=None):
+    """
+    Clean a preprocessed file and save it in the cleaned stage.
+
+    The file is read, cleaned and written one chunk of rows at a time, so memory
+    use does not grow with the file size. The gap filling carries across chunks, and
+    the gaps found are written to the gap report of the zone-year (see write_gap_report).
+
+    Parameters:
+    file_path (str): Path to the preprocessed file.
+    area_code_folder (str): Cleaned folder of the area code.
+    chunk_size (int, optional): Rows per chunk, config.CHUNK_SIZE by default.
+    """
+    if check_processing_stage(file_path, 'preprocessed'):
         # Save the cleaned data in the corresponding area code subfolder
         cleaned_file_path = os.path.join(area_code_folder, os.path.basename(file_path))
-        save_df_to_csv(cleaned_df, cleaned_file_path, overwrite=True)
+        description = None
+        previous_rows = None
+        gap_report = []
+        area_code, year = stage_file_area_year(file_path)
+        with track_stage('clean', area_code, year) as record:
+            record.read(file_path)
+            with ChunkWriter(cleaned_file_path) as writer:
+                for chunk in iter_slot_chunks(file_path, chunk_size or config.CHUNK_SIZE):
+                    cleaned_chunk = clean_chunk(chunk, previous_rows, gap_report)
+                    writer.write(cleaned_chunk)
+                    record.add_rows(len(chunk), len(cleaned_chunk))
+                    description = merge_descriptions(description, describe_df(cleaned_chunk))
+                    if not cleaned_chunk.empty:
+                        previous_rows = cleaned_chunk.tail(1)
+            record.wrote(cleaned_file_path)
 
         # Update metadata
-        update_file_metadata(cleaned_file_path, 'cleaned')
+        write_gap_report(gap_report, area_code, year)
+        update_file_metadata(cleaned_file_path, 'cleaned', description=description, source_files=[file_path],
+                             extra=summarize_gaps(gap_report))
         print(f"File {file_path} has been cleaned and saved in the cleaned directory.")
     else:
         print(f"File {file_path} has not been preprocessed. Skipping.")
 
+def clean_incremental(area_code, new_data=None):
+    """
+    Clean the preprocessed rows newer than the cleaned stage's high-water mark and
+    append them to the cleaned files.
+
+    The forward fill carries over from the last cleaned row, which is read from the
+    end of its file rather than by loading the whole year.
+
+    Parameters:
+    area_code (str): The area code.
+    new_data (dict, optional): New preprocessed rows keyed by year, e.g. from
+        process_files_incremental. If omitted, they are read from the preprocessed stage.
+
+    Returns:
+    dict: DataFrames of the appended cleaned rows keyed by year.
+    """
+    cleaned_folder = os.path.join(config.DATA_CLEANED_DIR, area_code)
+    os.makedirs(cleaned_folder, exist_ok=True)
+    high_water_mark = get_high_water_mark(cleaned_folder)
+
+    if new_data is None:
+        new_data = load_rows_after('preprocessed', area_code, high_water_mark)
+
+    previous_rows = None
+    last_file_path = None if high_water_mark is None else stage_file_path(config.DATA_CLEANED_DIR, area_code, high_water_mark.year)
+    # The manifest can record a file that is gone, or one in another storage format
+    if last_file_path is not None and os.path.exists(last_file_path):
+        previous_rows = read_tail(last_file_path)
+
+    cleaned_rows = {}
+    for year, df in sorted(new_data.items()):
+        if high_water_mark is not None:
+            df = df[pd.to_datetime(df['period_start']) > high_water_mark]
+        if df.empty:
+            continue
+
+        # Clean together with the last cleaned row so the gap filling continues from it
+        gap_report = []
+        cleaned_df = clean_chunk(df, previous_rows, gap_report)
+        write_gap_report(gap_report, area_code, year, append=True)
+
+        cleaned_file_path = stage_file_path(config.DATA_CLEANED_DIR, area_code, year)
+        write_df(cleaned_df, cleaned_file_path, append=True)
+        update_file_metadata(cleaned_file_path, 'cleaned', df=cleaned_df,
+                             source_files=[stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year)], appended=True)
+        print(f"Appended {len(cleaned_df)} cleaned rows to {cleaned_file_path}")
+
+        cleaned_rows[year] = cleaned_df
+        previous_rows = cleaned_df.tail(1)
+
+    return cleaned_rows
+
 if __name__ == "__main__":
     area_code = input("Enter the area code for data cleaning (e.g., 'NO1'): ").strip().upper()
     area_code_folder = os.path.join(config.DATA_PREPROCESSED_DIR, area_code)
@@ -55,6 +326,6 @@ if __name__ == "__main__":
     os.makedirs(cleaned_area_code_folder, exist_ok=True)
 
     # Iterate through each file in the specified area code subfolder
-    preprocessed_files = glob.glob(os.path.join(area_code_folder, '*.csv'))
+    preprocessed_files = list_stage_files(area_code_folder)
     for file_path in preprocessed_files:
         clean_file(file_path, cleaned_area_code_folder)
\ No newline at end of file
@@ -3,18 +3,23 @@
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
 import os
-from entsoe import EntsoeRawClient
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta, timezone
 import pandas as pd
 from dotenv import load_dotenv
 import time
+import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
 import config
+from instrumentation import track_stage
 
-# Load environment variables from .env
-load_dotenv()
-
-# Get the API key from the environment variable
-api_key = os.getenv("ENTSOE_API_KEY")
+# The API key and the entsoe client are set up on first use, see get_api_key and get_client
+api_key = None
+client = None
+client_lock = threading.Lock()
 
 # Norwegian bidding zones as a tuple
 area_codes = {
@@ -25,7 +30,62 @@ area_codes = {
     "NO5": "10Y1001A1001A48H"   # NO5 Western Norway
 }
 
-client = EntsoeRawClient(api_key=api_key)
+# Day boundaries of the raw files are in UTC+1, like in data_preprocessor
+UTC_PLUS_1 = timezone(timedelta(hours=1))
+
+# HTTP status codes worth retrying: rate limited or a temporary server error
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+MAX_DAYS_PER_REQUEST = 370
+
+def get_api_key():
+    """
+    Get the ENTSO-E API key from the ENTSOE_API_KEY environment variable, loading .env on first use.
+    """
+    global api_key
+    if api_key is None:
+        load_dotenv()
+        api_key = os.getenv("ENTSOE_API_KEY") or None
+        if api_key is None:
+            raise ValueError("ENTSOE_API_KEY is not set, add it to the environment or to .env")
+    return api_key
+
+def get_client():
+    """
+    Get the shared entsoe client, created on first use so that importing this module stays cheap.
+    """
+    global client
+    with client_lock:
+        if client is None:
+            from entsoe import EntsoeRawClient
+            client = EntsoeRawClient(api_key=get_api_key())
+    return client
+
+def split_date_range(start_date, end_date, max_days_per_request=MAX_DAYS_PER_REQUEST):
+    """
+    Split a date range into windows that fit in a single API request.
+
+    The windows are whole days and do not overlap, like backfill.missing_ranges_to_windows.
+
+    Returns:
+    list: (window_start, window_end) Timestamps, with window_end the last day of the window.
+    """
+    start = pd.Timestamp(start_date).floor('D')
+    end = pd.Timestamp(end_date).floor('D')
+
+    windows = []
+    current = start
+    while current <= end:
+        interval_end = min(current + pd.Timedelta(days=max_days_per_request - 1), end)
+        windows.append((current, interval_end))
+
+        # The next window starts the day after interval_end
+        current = interval_end + pd.Timedelta(days=1)
+    return windows
+
+def get_raw_file_path(area_code_name, window_start, window_end):
+    filename = f"{area_code_name}_{window_start.strftime('%Y_%m_%d')}_to_{window_end.strftime('%Y_%m_%d')}_day_ahead_prices.xml"
+    return os.path.join(config.DATA_RAW_DIR, area_code_name, filename)
 
 def fetch_data(start_date, end_date, area_code_name):
     country_code = area_codes.get(area_code_name)
@@ -33,25 +93,16 @@ def fetch_data(start_date, end_date, area_code_name):
         print(f"Invalid area code name: {area_code_name}")
         return
 
-    # Adjust start and end times to Timestamp
-    start = pd.Timestamp(start_date)
-    end = pd.Timestamp(end_date)
-    
-    max_days_per_request = 370
-    current = start
-
     # Create subfolder for area code if it doesn't exist
     area_code_folder = os.path.join(config.DATA_RAW_DIR, area_code_name)
     os.makedirs(area_code_folder, exist_ok=True)
 
-    while current < end:
-        interval_end = min(current + pd.DateOffset(days=max_days_per_request - 1), end)
+    for current, interval_end in split_date_range(start_date, end_date):
         print(f"Fetching data for {area_code_name}: {current} to {interval_end}...")
 
         try:
-            xml_string = client.query_day_ahead_prices(country_code, current, interval_end)
-            filename = f"{area_code_name}_{current.strftime('%Y_%m_%d')}_to_{interval_end.strftime('%Y_%m_%d')}_day_ahead_prices.xml"
-            output_file_path = os.path.join(area_code_folder, filename)
+            xml_string = get_client().query_day_ahead_prices(country_code, current, interval_end)
+            output_file_path = get_raw_file_path(area_code_name, current, interval_end)
 
             with open(output_file_path, 'w') as f:
                 f.write(xml_string)
@@ -61,9 +112,6 @@ def fetch_data(start_date, end_date, area_code_name):
         except Exception as e:
             print(f"Failed to fetch data: {e}")
 
-        # Set current to the day after interval_end
-        current = interval_end + pd.DateOffset(minutes=1)
-
 def fetch_data_with_retries(start_date, end_date, area_code_name, max_retries=5, delay=10):
     attempts = 0
     while attempts < max_retries:
@@ -77,6 +125,197 @@ def fetch_data_with_retries(start_date, end_date, area_code_name, max_retries=5,
 
     print("Max retries reached. Exiting.")
 
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces calls evenly to at most requests_per_minute.
+    """
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        """
+        Block until the caller may send the next request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class RetryableFetchError(Exception):
+    """
+    A request failed in a way that may succeed when retried.
+    """
+
+def describe_error(error):
+    """
+    Describe a fetch error with the API key, which is part of the request URL, redacted.
+    """
+    message = str(error)
+    return message.replace(api_key, '***') if api_key else message
+
+def create_session(pool_size):
+    """
+    Create an HTTP session whose connection pool can serve pool_size concurrent requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_window(session, rate_limiter, area_code_name, window_start, window_end, base_url=None,
+                 max_retries=None, backoff_seconds=None, timeout=60):
+    """
+    Fetch the day-ahead prices of one area code and window and stream them to disk.
+
+    The response is written to a temporary file and renamed when complete, so an
+    interrupted download never leaves a partial XML file behind. Rate limiting,
+    server errors and connection errors are retried with exponential backoff.
+
+    Parameters:
+    session (requests.Session): Shared HTTP session.
+    rate_limiter (RateLimiter): Shared rate limiter.
+    area_code_name (str): Area code, e.g. 'NO1'.
+    window_start (Timestamp): First day of the window.
+    window_end (Timestamp): Last day of the window, included.
+    base_url (str, optional): API URL, config.ENTSOE_API_URL by default.
+    max_retries (int, optional): Retries after the first attempt, config.FETCH_MAX_RETRIES by default.
+    backoff_seconds (float, optional): Initial retry delay, config.FETCH_BACKOFF_SECONDS by default.
+    timeout (float): Timeout of a single request in seconds.
+
+    Returns:
+    str or None: Path to the saved file, or None if the API has no data for the window.
+    """
+    base_url = base_url or config.ENTSOE_API_URL
+    max_retries = config.FETCH_MAX_RETRIES if max_retries is None else max_retries
+    backoff_seconds = config.FETCH_BACKOFF_SECONDS if backoff_seconds is None else backoff_seconds
+
+    country_code = area_codes[area_code_name]
+    period_start = pd.Timestamp(window_start).tz_localize(UTC_PLUS_1).tz_convert('UTC')
+    period_end = (pd.Timestamp(window_end) + pd.Timedelta(days=1)).tz_localize(UTC_PLUS_1).tz_convert('UTC')
+    params = {
+        'securityToken': get_api_key(),
+        'documentType': 'A44',
+        'in_Domain': country_code,
+        'out_Domain': country_code,
+        'periodStart': period_start.strftime('%Y%m%d%H%M'),
+        'periodEnd': period_end.strftime('%Y%m%d%H%M'),
+    }
+
+    output_file_path = get_raw_file_path(area_code_name, window_start, window_end)
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    temp_file_path = output_file_path + '.part'
+
+    with track_stage('fetch', area_code_name, pd.Timestamp(window_start).year) as record:
+        for attempt in range(max_retries + 1):
+            rate_limiter.wait()
+            try:
+                with session.get(base_url, params=params, stream=True, timeout=timeout) as response:
+                    if response.status_code in RETRY_STATUS_CODES:
+                        raise RetryableFetchError(f"HTTP {response.status_code}")
+
+                    with open(temp_file_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            f.write(chunk)
+
+                with open(temp_file_path, 'rb') as f:
+                    head = f.read(4096)
+                if b'Acknowledgement_MarketDocument' in head and b'No matching data' in head:
+                    # The API answers with an acknowledgement instead of prices when it has no data
+                    os.remove(temp_file_path)
+                    return None
+                if not response.ok:
+                    os.remove(temp_file_path)
+                    response.raise_for_status()
+
+                os.replace(temp_file_path, output_file_path)
+                record.wrote(output_file_path)
+                return output_file_path
+
+            except (RetryableFetchError, ConnectionError, Timeout) as e:
+                if attempt == max_retries:
+                    raise
+                delay = backoff_seconds * 2 ** attempt * (1 + random.random())
+                print(f"Fetching {area_code_name} {window_start.date()} to {window_end.date()} failed ({describe_error(e)}). "
+                      f"Retry {attempt + 1}/{max_retries} in {delay:.1f} seconds...")
+                time.sleep(delay)
+
+def fetch_data_concurrent(start_date, end_date, area_code_names, max_workers=None, requests_per_minute=None, base_url=None,
+                          max_retries=None, backoff_seconds=None):
+    """
+    Fetch day-ahead prices for several area codes, running the (area code, window) jobs concurrently.
+
+    Parameters:
+    start_date (str): Start date (YYYYMMDD).
+    end_date (str): End date (YYYYMMDD), included.
+    area_code_names (list): Area codes, e.g. ['NO1', 'NO2'].
+    Other parameters: see fetch_jobs.
+
+    Returns:
+    tuple: (results, failures), see fetch_jobs.
+    """
+    jobs = [
+        (area_code_name, window_start, window_end)
+        for area_code_name in area_code_names
+        for window_start, window_end in split_date_range(start_date, end_date)
+    ]
+    return fetch_jobs(jobs, max_workers=max_workers, requests_per_minute=requests_per_minute, base_url=base_url,
+                      max_retries=max_retries, backoff_seconds=backoff_seconds)
+
+def fetch_jobs(jobs, max_workers=None, requests_per_minute=None, base_url=None, max_retries=None, backoff_seconds=None,
+               on_complete=None):
+    """
+    Run (area code, window start, window end) fetch jobs concurrently.
+
+    All jobs share one pooled HTTP session and one rate limiter. Each job is retried on
+    its own, so a failing window does not restart or stop the others.
+
+    Parameters:
+    jobs (list): (area code, window start, window end) tuples, see fetch_window.
+    max_workers (int, optional): Concurrent requests, config.FETCH_WORKERS by default.
+    requests_per_minute (float, optional): Request limit, config.FETCH_REQUESTS_PER_MINUTE by default.
+    base_url (str, optional): API URL, config.ENTSOE_API_URL by default.
+    max_retries (int, optional): Retries per job, config.FETCH_MAX_RETRIES by default.
+    backoff_seconds (float, optional): Initial retry delay, config.FETCH_BACKOFF_SECONDS by default.
+    on_complete (callable, optional): Called as on_complete(job, file_path, error) in the calling
+        thread as soon as each job finishes.
+
+    Returns:
+    tuple: (results, failures). results maps each finished job to its file path, or None
+        if there was no data. failures maps failed jobs to their error.
+    """
+    max_workers = max_workers or config.FETCH_WORKERS
+    rate_limiter = RateLimiter(requests_per_minute or config.FETCH_REQUESTS_PER_MINUTE)
+
+    for area_code_name, _, _ in jobs:
+        if area_code_name not in area_codes:
+            raise ValueError(f"Invalid area code name: {area_code_name}")
+
+    results, failures = {}, {}
+    with create_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_window, session, rate_limiter, *job, base_url=base_url,
+                            max_retries=max_retries, backoff_seconds=backoff_seconds): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results[job] = future.result()
+                print(f"Fetched {job[0]} {job[1].date()} to {job[2].date()}: {results[job] or 'no data'}")
+            except Exception as e:
+                failures[job] = e
+                print(f"Failed to fetch {job[0]} {job[1].date()} to {job[2].date()}: {describe_error(e)}")
+
+            if on_complete is not None:
+                on_complete(job, results.get(job), failures.get(job))
+
+    return results, failures
+
 if __name__ == "__main__":
     """
     A single request can only contain 370 doucments per request due to the limitations on API.
@@ -1,44 +1,265 @@
 import pandas as pd
 import os
+import threading
+from collections import OrderedDict
 import config
+from storage import read_df, read_time_slice, stage_file_path, stage_file_area_year, list_stage_files, UTC_PLUS_1
+from data_processing_tracker import get_file_metadata
 
-def load_data(year, area_code, stage='normalized', specific_date=None, return_array=False):
+class FrameCache:
     """
-    Load CSV files from a specific year and area code within a processing stage.
+    Least recently used cache of loaded frames, bounded by their memory size.
+
+    Every entry remembers the signature (inode, mtime, size) of the file it was read
+    from. A file rewritten by a pipeline stage, whether replaced or appended to, gets
+    a new signature, so its stale entries are dropped on the next lookup.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = config.DATA_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.entries = OrderedDict()  # Key -> (file signature, frame, size in bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                # The file changed, so every entry read from it is stale
+                for stale_key in [stale_key for stale_key in self.entries if stale_key[0] == key[0]]:
+                    self.discard(stale_key)
+            self.misses += 1
+            return None
+
+    def put(self, key, signature, df):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self.discard(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (signature, df, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate(self, file_path=None):
+        """
+        Drop the entries of a file, or all entries if no file is given.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if file_path is None or key[0] == file_path]:
+                self.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+frame_cache = FrameCache()
+
+def get_file_signature(file_path):
+    """
+    Get the (inode, mtime, size) of a file, which changes whenever the file is rewritten.
+    """
+    stat = os.stat(file_path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def cache_stats():
+    """
+    Get the hit and miss counts, entry count and memory size of the frame cache.
+    """
+    return frame_cache.stats()
+
+def clear_cache(file_path=None):
+    """
+    Drop the cached frames of a file, or of all files.
+    """
+    frame_cache.invalidate(file_path)
+
+def load_file(file_path, columns=None, start=None, end=None, use_cache=True):
+    """
+    Read a stage file, or the rows of a time range in it, through the frame cache.
+
+    Repeated reads of the same file, columns and range in one process parse the file
+    only once, until the file changes on disk. A copy is returned, so callers may
+    modify it without touching the cache.
+
+    Parameters:
+    file_path (str): Path to the file.
+    columns (list, optional): Columns to load. All columns if omitted.
+    start, end (Timestamp, optional): Only load rows with start <= period_start < end (see storage.read_time_slice).
+    use_cache (bool): If False, read the file without the cache.
+
+    Returns:
+    DataFrame: The rows.
+    """
+    def read():
+        if start is None and end is None:
+            return read_df(file_path, columns=columns)
+        return read_time_slice(file_path, start, end, columns=columns)
+
+    if not use_cache:
+        return read()
+
+    key = (file_path, None if columns is None else tuple(columns), start, end)
+    signature = get_file_signature(file_path)
+    df = frame_cache.get(key, signature)
+    if df is None:
+        df = read()
+        frame_cache.put(key, signature, df)
+    return df.copy()
+
+def load_data(year, area_code, stage='normalized', specific_date=None, return_array=False, columns=None):
+    """
+    Load the data file of a specific year and area code within a processing stage.
     Optionally filter data to a specific date and return as a DataFrame or NumPy array.
 
+    Only the requested columns are read. A specific date is looked up by period_start
+    (see storage.read_time_slice), so only the rows of that day are read. Loaded data
+    is kept in the frame cache (see load_file), so loading it again is a memory copy.
+
     Parameters:
     year (int): Year of the data to be loaded.
     area_code (str): The area code for the data.
     stage (str): Processing stage folder ('preprocessed', 'cleaned', 'normalized').
     specific_date (str, optional): Specific date to filter data in 'YYYYMMDD' format.
     return_array (bool): If True, return data as a NumPy array, otherwise as a DataFrame.
+    columns (list, optional): Columns to load. All columns if omitted.
 
     Returns:
     DataFrame or numpy.ndarray: Data as a DataFrame or a NumPy array.
     """
-    folder_path = os.path.join(config.DATA_PROCESSED_DIR, stage, area_code)
-    file_path = os.path.join(folder_path, f"{area_code}_{year}.csv")
+    file_path = stage_file_path(os.path.join(config.DATA_PROCESSED_DIR, stage), area_code, year)
 
     if os.path.exists(file_path):
-        df = pd.read_csv(file_path)
-
         if specific_date:
             specific_date_dt = pd.to_datetime(specific_date, format='%Y%m%d')
-            day, month, year = specific_date_dt.day, specific_date_dt.month, specific_date_dt.year
-
-            # Filter DataFrame based on day, month, and year
-            df = df[(df['day_of_month'] == day) & (df['month'] == month) & (df['year'] == year)]
+            day_start = to_range_timestamp(specific_date_dt)
+            try:
+                df = load_file(file_path, columns, day_start, day_start + pd.Timedelta(days=1))
+            except (KeyError, ValueError):
+                # Written before the stage kept period_start, filter data based on day, month, and year
+                filters = [
+                    ('day_of_month', '==', specific_date_dt.day),
+                    ('month', '==', specific_date_dt.month),
+                    ('year', '==', specific_date_dt.year),
+                ]
+                df = read_df(file_path, columns=columns, filters=filters)
+        else:
+            df = load_file(file_path, columns)
 
-            if df.empty:
-                # Return None if no data is found for the specific date
-                return None
+        if specific_date and df.empty:
+            # Return None if no data is found for the specific date
+            return None
 
         return df.values if return_array else df
     else:
         print(f"No data found for year {year} and area code {area_code} in {stage} stage.")
         return None
 
+def load_rows_after(stage, area_code, high_water_mark):
+    """
+    Load the rows of a processing stage that start after a high-water mark.
+
+    Files whose recorded time range ends at or before the mark are not read.
+
+    Parameters:
+    stage (str): Processing stage folder ('preprocessed', 'cleaned', 'normalized').
+    area_code (str): The area code for the data.
+    high_water_mark (Timestamp or None): Only rows with a later period_start are returned. None returns all rows.
+
+    Returns:
+    dict: DataFrames of the new rows keyed by year.
+    """
+    new_rows = {}
+    for file_path in list_stage_files(os.path.join(config.DATA_PROCESSED_DIR, stage, area_code)):
+        entry = get_file_metadata(file_path)
+        if entry is None or not entry.get('end'):
+            continue
+        if high_water_mark is not None and pd.Timestamp(entry['end']) <= high_water_mark:
+            continue
+
+        filters = None if high_water_mark is None else [('period_start', '>', high_water_mark)]
+        year = stage_file_area_year(file_path)[1]
+        new_rows[year] = read_df(file_path, filters=filters)
+
+    return new_rows
+
+def to_range_timestamp(timestamp):
+    """
+    Parse a range boundary (Timestamp, datetime, 'YYYYMMDD' or ISO string). Naive times are UTC+1.
+    """
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize(UTC_PLUS_1) if timestamp.tzinfo is None else timestamp
+
+def get_range_files(stage, area_code, start, end):
+    """
+    List the yearly files of an area code in a stage that can hold rows in [start, end).
+
+    Files of other years, and files whose time range in the manifest lies outside the
+    range, are pruned without being opened.
+
+    Returns:
+    list: Paths of the files, in time order.
+    """
+    file_paths = []
+    for file_path in list_stage_files(os.path.join(config.DATA_PROCESSED_DIR, stage, area_code)):
+        year = stage_file_area_year(file_path)[1]
+        # A year file can start an hour before New Year in UTC+1 (see data_preprocessor), so allow one year of slack
+        if year < start.year - 1 or year > end.year + 1:
+            continue
+
+        entry = get_file_metadata(file_path)
+        if entry is not None and entry.get('start') and entry.get('end'):
+            if pd.Timestamp(entry['end']) < start or pd.Timestamp(entry['start']) >= end:
+                continue
+        file_paths.append(file_path)
+    return file_paths
+
+def load_range(area_code, start, end, columns=None, stage='normalized'):
+    """
+    Load the rows with start <= period_start < end, across year files and area codes.
+
+    Only the year files that overlap the range are opened, and within them only the
+    rows in the range are read (see storage.read_time_slice), so a 24-hour window
+    around New Year costs two small reads instead of two full years.
+
+    Parameters:
+    area_code (str or list): Area code, or list of area codes.
+    start (Timestamp or str): First period_start to include, e.g. '20231231' or a Timestamp. Naive times are UTC+1.
+    end (Timestamp or str): First period_start to leave out.
+    columns (list, optional): Columns to load. All columns if omitted.
+    stage (str): Processing stage folder ('preprocessed', 'cleaned', 'normalized').
+
+    Returns:
+    DataFrame: The rows in time order. With a list of area codes an 'area_code' column is added in front.
+    """
+    area_codes = [area_code] if isinstance(area_code, str) else list(area_code)
+    start, end = to_range_timestamp(start), to_range_timestamp(end)
+
+    frames = []
+    for code in area_codes:
+        for file_path in get_range_files(stage, code, start, end):
+            df = read_time_slice(file_path, start, end, columns=columns)
+            if not isinstance(area_code, str):
+                df.insert(0, 'area_code', code)
+            frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=(['area_code'] if not isinstance(area_code, str) else []) + list(columns or []))
+    return pd.concat(frames, ignore_index=True)
+
 # Example usage
 if __name__ == "__main__":
     year = 2020
@@ -4,79 +4,199 @@
 
 import pandas as pd
 import os
-import glob
-from sklearn.preprocessing import MinMaxScaler
 import config
 import numpy as np
+from instrumentation import track_stage
+from schema import apply_schema
+from storage import write_df, iter_chunks, ChunkWriter, list_stage_files, stage_file_path, stage_file_area_year
+from data_processing_tracker import update_file_metadata, get_high_water_mark, get_file_metadata, describe_df, merge_descriptions
+from data_loader import load_rows_after
+from scaler_registry import get_scaler, get_scaler_entry, update_scaler, fit_scaler_from_files
+
+# Model features of the normalized stage, in column order. The normalized files
+# also keep 'period_start' after these so the stage can be queried and appended to by time.
+FEATURE_COLUMNS = ['price', 'hour_sin', 'hour_cos', 'day_of_week_sin', 'day_of_week_cos', 'day_of_month', 'month', 'year']
 
 def extract_time_features(df):
     # Convert 'period_start' to datetime if it's not already
     df['period_start'] = pd.to_datetime(df['period_start'])
 
-    # Extract time features
-    df['hour'] = df['period_start'].dt.hour
-    df['day_of_week'] = df['period_start'].dt.dayofweek
-    df['day_of_month'] = df['period_start'].dt.day
-    df['month'] = df['period_start'].dt.month
-    df['year'] = df['period_start'].dt.year
+    # Extract time features, as the small ints of the schema
+    df['hour'] = df['period_start'].dt.hour.astype(np.int8)
+    df['day_of_week'] = df['period_start'].dt.dayofweek.astype(np.int8)
+    df['day_of_month'] = df['period_start'].dt.day.astype(np.int8)
+    df['month'] = df['period_start'].dt.month.astype(np.int8)
+    df['year'] = df['period_start'].dt.year.astype(np.int16)
 
-    # Cyclical encoding for hour and day_of_week
-    df['hour_sin'] = np.sin(df['hour'] * (2 * np.pi / 24))
-    df['hour_cos'] = np.cos(df['hour'] * (2 * np.pi / 24))
-    df['day_of_week_sin'] = np.sin(df['day_of_week'] * (2 * np.pi / 7))
-    df['day_of_week_cos'] = np.cos(df['day_of_week'] * (2 * np.pi / 7))
+    # Cyclical encoding for hour and day_of_week, in float32
+    df['hour_sin'] = np.sin(df['hour'] * np.float32(2 * np.pi / 24))
+    df['hour_cos'] = np.cos(df['hour'] * np.float32(2 * np.pi / 24))
+    df['day_of_week_sin'] = np.sin(df['day_of_week'] * np.float32(2 * np.pi / 7))
+    df['day_of_week_cos'] = np.cos(df['day_of_week'] * np.float32(2 * np.pi / 7))
 
     # Optionally, drop the 'period_end' column if it's redundant
-    df.drop(['period_start', 'period_end'], axis=1, inplace=True)
+    df.drop(['period_end'], axis=1, inplace=True)
 
     return df
 
-def normalize_data(df):
+def normalize_data(df, scaler=None):
     # Extract and encode time features first
     df = extract_time_features(df)
 
     # Now select the columns to keep for normalization
-    columns_to_keep = ['price', 'hour_sin', 'hour_cos', 'day_of_week_sin', 'day_of_week_cos', 'day_of_month', 'month', 'year']
+    columns_to_keep = FEATURE_COLUMNS + ['period_start']
 
     # Create a copy of the DataFrame to keep only necessary columns
     df_filtered = df[columns_to_keep].copy()
 
-    # Initialize a scaler
-    scaler = MinMaxScaler()
+    # Initialize a scaler, unless a fitted one is given
+    if scaler is None:
+        from sklearn.preprocessing import MinMaxScaler  # sklearn takes most of a second to import
+        scaler = MinMaxScaler().fit(df_filtered[['price']])
 
     # Normalize the 'price' column
-    df_filtered['price'] = scaler.fit_transform(df_filtered[['price']])
+    df_filtered['price'] = scaler.transform(df_filtered[['price']])
 
     # Optionally, if other columns need normalization, normalize them here
 
-    return df_filtered
-
-def normalize_file(file_path, area_code_folder):
-    # Load dataset
-    df = pd.read_csv(file_path)
-
-    # Apply normalization
-    normalized_df = normalize_data(df)
+    return apply_schema(df_filtered)
+
+def get_area_scaler(area_code):
+    """
+    Get the registered price scaler of an area code, fitting it over all cleaned
+    files of the area code if none is registered yet.
+
+    Returns:
+    tuple: (scaler, registry entry), or (None, None) if there is no data to fit on.
+    """
+    scaler = get_scaler(area_code)
+    if scaler is None:
+        cleaned_files = list_stage_files(os.path.join(config.DATA_CLEANED_DIR, area_code))
+        scaler = fit_scaler_from_files(area_code, cleaned_files)
+    return scaler, get_scaler_entry(area_code)
+
+def normalize_file(file_path, area_code_folder, scaler=None, chunk_size=None):
+    """
+    Normalize a cleaned file with the price scaler of its area code and save it in the normalized stage.
+
+    The file is read, normalized and written one chunk of rows at a time, so the
+    temporary time feature columns only exist for one chunk.
+
+    Parameters:
+    file_path (str): Path to the cleaned file.
+    area_code_folder (str): Normalized folder of the area code.
+    scaler (MinMaxScaler, optional): The scaler to use. The registered scaler of the area code by default.
+    chunk_size (int, optional): Rows per chunk, config.CHUNK_SIZE by default.
+    """
+    area_code = os.path.basename(os.path.normpath(area_code_folder))
+
+    # Apply normalization, with the same scaler for every year of the area code
+    if scaler is None:
+        scaler, _ = get_area_scaler(area_code)
+    scaler_entry = get_scaler_entry(area_code)
 
     # Save the normalized data in the corresponding area code subfolder
     normalized_file_path = os.path.join(area_code_folder, os.path.basename(file_path))
-    normalized_df.to_csv(normalized_file_path, index=False)
+    description = None
+    with track_stage('normalize', *stage_file_area_year(file_path)) as record:
+        record.read(file_path)
+        with ChunkWriter(normalized_file_path) as writer:
+            for chunk in iter_chunks(file_path, chunk_size or config.CHUNK_SIZE):
+                rows_in = len(chunk)
+                normalized_chunk = normalize_data(chunk, scaler)
+                writer.write(normalized_chunk)
+                record.add_rows(rows_in, len(normalized_chunk))
+                description = merge_descriptions(description, describe_df(normalized_chunk))
+        record.wrote(normalized_file_path)
+
+    update_file_metadata(normalized_file_path, 'normalized', description=description, source_files=[file_path],
+                         extra={'scaler_fitted': scaler_entry['fitted'] if scaler_entry else None})
     print(f"File {file_path} has been normalized and saved as {normalized_file_path}")
 
-if __name__ == "__main__":
-    area_code = input("Enter the area code for data normalization (e.g., 'NO1'): ").strip().upper()
-    area_code_folder = os.path.join(config.DATA_CLEANED_DIR, area_code)
+def normalize_area(area_code):
+    """
+    Refit the price scaler of an area code over all its cleaned files and normalize them.
 
-    # Check if the specified area code folder exists
-    if not os.path.exists(area_code_folder):
-        print(f"No cleaned data found for area code {area_code}. Exiting.")
-        exit()
+    The scaler is fitted with partial_fit one file at a time and saved in the scaler
+    registry (see scaler_registry), so every year is scaled the same way and
+    predictions can be mapped back to prices.
 
-    # Create corresponding area code subfolder in normalized data directory
-    normalized_area_code_folder = os.path.join(config.DATA_NORMALIZED_DIR, area_code)
-    os.makedirs(normalized_area_code_folder, exist_ok=True)
+    Returns:
+    int: Number of normalized files.
+    """
+    cleaned_files = list_stage_files(os.path.join(config.DATA_CLEANED_DIR, area_code))
+    if not cleaned_files:
+        print(f"No cleaned data found for area code {area_code}.")
+        return 0
 
-    # Iterate through each file in the specified area code subfolder
-    cleaned_files = glob.glob(os.path.join(area_code_folder, '*.csv'))
+    normalized_folder = os.path.join(config.DATA_NORMALIZED_DIR, area_code)
+    os.makedirs(normalized_folder, exist_ok=True)
+
+    scaler = fit_scaler_from_files(area_code, cleaned_files)
     for file_path in cleaned_files:
-        normalize_file(file_path, normalized_area_code_folder)
\ No newline at end of file
+        normalize_file(file_path, normalized_folder, scaler)
+    return len(cleaned_files)
+
+def normalize_incremental(area_code, new_data=None):
+    """
+    Normalize the cleaned rows newer than the normalized stage's high-water mark and
+    append them to the normalized files.
+
+    The new rows are scaled with the registered price scaler of the area code, so
+    nothing is refitted and the existing rows are not rewritten. Prices outside the
+    fitted range are scaled outside [0, 1] until normalize_area refits the scaler.
+    A yearly file that was scaled with another scaler, or that does not have a time
+    range yet, is normalized in full once.
+
+    Parameters:
+    area_code (str): The area code.
+    new_data (dict, optional): New cleaned rows keyed by year, e.g. from
+        clean_incremental. If omitted, they are read from the cleaned stage.
+
+    Returns:
+    dict: DataFrames of the appended normalized rows keyed by year.
+    """
+    normalized_folder = os.path.join(config.DATA_NORMALIZED_DIR, area_code)
+    os.makedirs(normalized_folder, exist_ok=True)
+    high_water_mark = get_high_water_mark(normalized_folder)
+
+    if new_data is None:
+        new_data = load_rows_after('cleaned', area_code, high_water_mark)
+
+    scaler, scaler_entry = get_area_scaler(area_code)
+    if scaler is None:
+        # First data of the area code, fit the scaler on the new rows
+        scaler = update_scaler(area_code, new_data.values())
+        scaler_entry = get_scaler_entry(area_code)
+        if scaler is None:
+            return {}
+
+    normalized_rows = {}
+    for year, df in sorted(new_data.items()):
+        cleaned_file_path = stage_file_path(config.DATA_CLEANED_DIR, area_code, year)
+        normalized_file_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, year)
+        entry = get_file_metadata(normalized_file_path) if os.path.exists(normalized_file_path) else None
+
+        if entry is not None and not (entry.get('end') and entry.get('scaler_fitted') == scaler_entry['fitted']):
+            # Written before the normalized stage kept its timestamps, or scaled with another scaler
+            normalize_file(cleaned_file_path, normalized_folder, scaler)
+            continue
+
+        if high_water_mark is not None:
+            df = df[pd.to_datetime(df['period_start']) > high_water_mark]
+        if df.empty:
+            continue
+
+        normalized_df = normalize_data(df.copy(), scaler)
+        write_df(normalized_df, normalized_file_path, append=True)
+        update_file_metadata(normalized_file_path, 'normalized', df=normalized_df, source_files=[cleaned_file_path],
+                             appended=True, extra={'scaler_fitted': scaler_entry['fitted']})
+        print(f"Appended {len(normalized_df)} normalized rows to {normalized_file_path}")
+
+        normalized_rows[year] = normalized_df
+
+    return normalized_rows
+
+if __name__ == "__main__":
+    area_code = input("Enter the area code for data normalization (e.g., 'NO1'): ").strip().upper()
+    normalize_area(area_code)
@@ -4,27 +4,30 @@
 
 import config
 import os
-from datetime import datetime, timedelta
+from array import array
+from datetime import datetime, timedelta, timezone
 import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
 import glob
 import random
-from data_processing_tracker import update_file_metadata
-import pytz
-
-namespace_cache = {}  # Cache for storing namespaces
-
-def extract_namespace(xml_file_path):
-    for _, elem in ET.iterparse(xml_file_path, events=("start",)):
-        # Get the namespace from the first element
-        namespace = elem.tag.split('}')[0].strip('{')
-        return namespace
-
-def get_namespace(area_code, xml_file_path):
-    if area_code not in namespace_cache:
-        namespace_uri = extract_namespace(xml_file_path)
-        namespace_cache[area_code] = {'ns': namespace_uri}  # Store as a dictionary
-    return namespace_cache[area_code]
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from data_processing_tracker import update_file_metadata, get_high_water_mark
+from instrumentation import track_stage
+from schema import apply_schema
+from storage import read_df, write_df, stage_file_path
+
+UTC_PLUS_1 = timezone(timedelta(hours=1))
+DEFAULT_RESOLUTION = pd.Timedelta(hours=1)
+
+# TimeSeries child elements copied onto every row, mapped to their column names
+TIMESERIES_FIELDS = {
+    'businessType': 'business_type',
+    'in_Domain.mRID': 'in_domain',
+    'out_Domain.mRID': 'out_domain',
+    'currency_Unit.name': 'currency',
+}
 
 def check_area_code_folder(area_code):
     """
@@ -43,124 +46,283 @@ def parse_xml_to_df(xml_file_path):
     """
     Parse the XML file containing electricity price data and convert it to a pandas DataFrame.
 
+    The document is streamed with iterparse and every Period is freed as soon as
+    it has been read. Positions and prices are collected into typed arrays and the
+    timestamps of a Period are computed in one vectorized step as
+    period_start + (position - 1) * resolution.
+
     Parameters:
     xml_file_path (str): The path to the XML file containing the data.
 
     Returns:
     DataFrame: The converted data as a pandas DataFrame.
     """
+    file_start, file_end = get_file_date_range(xml_file_path)
+
+    periods = []  # (start times in ns, prices, resolution in ns, TimeSeries fields)
+    series_fields = {}
+    in_period = False
+    period_start = None
+    resolution = None
+    positions = array('q')
+    prices = array('d')
+
+    context = ET.iterparse(xml_file_path, events=('start', 'end'))
+    _, root = next(context)
+
+    for event, elem in context:
+        tag = elem.tag.rpartition('}')[2]
+
+        if event == 'start':
+            if tag == 'Period':
+                in_period = True
+                period_start = None
+                resolution = None
+                positions = array('q')
+                prices = array('d')
+            continue
+
+        if tag == 'position':
+            positions.append(int(elem.text))
+        elif tag == 'price.amount':
+            prices.append(float(elem.text))
+        elif tag == 'start' and in_period:
+            period_start = pd.Timestamp(elem.text)
+        elif tag == 'resolution':
+            resolution = pd.Timedelta(elem.text)
+        elif tag in TIMESERIES_FIELDS:
+            series_fields[TIMESERIES_FIELDS[tag]] = elem.text
+        elif tag == 'Period':
+            in_period = False
+            if period_start.tzinfo is None:
+                period_start = period_start.tz_localize('UTC')
+            step = (resolution if resolution is not None else DEFAULT_RESOLUTION).value
+            start_ns = period_start.value + (np.frombuffer(positions, dtype=np.int64) - 1) * step
+            periods.append((start_ns, np.frombuffer(prices, dtype=np.float64), step, dict(series_fields)))
+            elem.clear()
+        elif tag == 'TimeSeries':
+            series_fields = {}
+            # Drop the finished TimeSeries (and its freed Periods) from the tree
+            root.clear()
+
+    return _periods_to_df(periods, file_start, file_end)
+
+def _periods_to_df(periods, file_start, file_end):
+    """
+    Combine the parsed Periods into one DataFrame, keeping only the points that
+    start within the date range covered by the file.
+    """
+    if not periods:
+        return apply_schema(pd.DataFrame({
+            'price': pd.Series(dtype='float64'),
+            **{column: pd.Series(dtype='object') for column in TIMESERIES_FIELDS.values()},
+            'period_start': pd.Series(dtype=pd.DatetimeTZDtype('ns', UTC_PLUS_1)),
+            'period_end': pd.Series(dtype=pd.DatetimeTZDtype('ns', UTC_PLUS_1)),
+        }))
+
+    counts = np.array([len(start_ns) for start_ns, _, _, _ in periods])
+    start_ns = np.concatenate([period[0] for period in periods])
+    end_ns = start_ns + np.repeat([period[2] for period in periods], counts)
+
+    mask = (start_ns >= file_start.value) & (start_ns <= file_end.value)
+
+    data = {'price': np.concatenate([period[1] for period in periods])[mask].astype(np.float32)}
+    for column in TIMESERIES_FIELDS.values():
+        # Categorical straight from the code of every Period, without a string per row
+        values = [period[3].get(column) for period in periods]
+        categories = sorted({value for value in values if value is not None})
+        codes = np.array([-1 if value is None else categories.index(value) for value in values])
+        data[column] = pd.Categorical.from_codes(np.repeat(codes, counts)[mask], categories=categories)
+    data['period_start'] = pd.to_datetime(start_ns[mask], utc=True).tz_convert(UTC_PLUS_1)
+    data['period_end'] = pd.to_datetime(end_ns[mask], utc=True).tz_convert(UTC_PLUS_1)
+
+    return apply_schema(pd.DataFrame(data))
+
+def get_file_date_range(xml_file_path):
+    """
+    Get the date range covered by a raw XML file from its file name.
 
-    area_code = os.path.basename(xml_file_path).split('_')[0]
-    # Assuming get_namespace is a function defined elsewhere in your code
-    ns = get_namespace(area_code, xml_file_path)
+    Parameters:
+    xml_file_path (str): The path to the XML file, named '{area}_{YYYY_MM_DD}_to_{YYYY_MM_DD}_...'.
 
-    # Extracting start and end dates from the file name
+    Returns:
+    tuple: (start, end) Timestamps in UTC+1, from the first to the last second of the range.
+    """
     file_name_parts = os.path.basename(xml_file_path).split('_')
     file_start_date = ''.join(file_name_parts[1:4])  # Joins year, month, day
     file_end_date = ''.join(file_name_parts[5:8])   # Joins year, month, day
 
-    tree = ET.parse(xml_file_path)
-    root = tree.getroot()
-
-    data_records = []
-    
-    # Define UTC and UTC+1 timezones
-    utc_plus_1 = pytz.FixedOffset(60)  # 60 minutes offset for UTC+1
-
-    # Convert input dates to offset-aware UTC+1
-    start_date = datetime.strptime(file_start_date, '%Y%m%d')
-    end_date = datetime.strptime(file_end_date, '%Y%m%d') + timedelta(days=1) - timedelta(seconds=1)
+    start = pd.Timestamp(datetime.strptime(file_start_date, '%Y%m%d'), tz=UTC_PLUS_1)
+    end = pd.Timestamp(datetime.strptime(file_end_date, '%Y%m%d') + timedelta(days=1) - timedelta(seconds=1), tz=UTC_PLUS_1)
+    return start, end
 
-    start_date_utc1 = utc_plus_1.localize(start_date)
-    end_date_utc1 = utc_plus_1.localize(end_date)
-
-    for timeseries in root.findall('.//ns:TimeSeries', ns):
-        business_type = timeseries.find('ns:businessType', ns).text
-        in_domain = timeseries.find('ns:in_Domain.mRID', ns).text
-        out_domain = timeseries.find('ns:out_Domain.mRID', ns).text
-        currency = timeseries.find('ns:currency_Unit.name', ns).text
+def parse_file_with_area_code(xml_file):
+    """
+    Parse one raw XML file and return it together with its area code.
+    Module level so it can be sent to the worker processes of process_files.
+    """
+    area_code = os.path.basename(xml_file).split('_')[0]
+    with track_stage('parse', area_code) as record:
+        record.read(xml_file)
+        df = parse_xml_to_df(xml_file)
+        record.add_rows(rows_out=len(df))
+    return area_code, df
 
-        for period in timeseries.findall('.//ns:Period', ns):
-            period_start_str = period.find('.//ns:timeInterval/ns:start', ns).text
-            
-            # Convert the string to a datetime object
-            period_start = datetime.fromisoformat(period_start_str)
+def process_files(file_list, workers=1):
+    """
+    Parse raw XML files and merge them into the yearly preprocessed files.
 
-            # Localize to UTC if tzinfo is None
-            if period_start.tzinfo is None:
-                period_start = pytz.utc.localize(period_start)
+    The parsed frames are grouped by (area code, year) in memory so that every
+    preprocessed file is read, deduplicated, sorted and written exactly once,
+    no matter how many raw files contribute to it. Files from several area codes
+    can be processed in one call.
 
-            for point in period.findall('.//ns:Point', ns):
-                position = int(point.find('ns:position', ns).text)
-                price_amount = float(point.find('ns:price.amount', ns).text)
+    Parameters:
+    file_list (list): Paths to the raw XML files.
+    workers (int, optional): Number of processes used for parsing. 1 parses in the
+        current process, None uses all CPU cores.
+    """
+    partitions = defaultdict(list)
+    sources = defaultdict(list)
 
-                hour_adjustment = timedelta(hours=position - 1)
+    collect_partitions(file_list, parse_files(file_list, workers), partitions, sources)
 
-                # Convert the measurement start time to UTC+1
-                measurement_start_time_utc1 = period_start + hour_adjustment
-                measurement_start_time_utc1 = measurement_start_time_utc1.astimezone(pytz.FixedOffset(60))
+    for (area_code, year), frames in sorted(partitions.items()):
+        merge_partition(area_code, year, frames, sources[(area_code, year)])
 
-                # Check if measurement_start_time is within the specified date range
-                if not (measurement_start_time_utc1 >= start_date_utc1 and measurement_start_time_utc1 <= end_date_utc1):
-                    continue
+def process_files_incremental(file_list, workers=1):
+    """
+    Append the rows newer than each area code's high-water mark to the preprocessed files.
 
-                # Set end time
-                measurement_end_time_utc1 = measurement_start_time_utc1 + timedelta(hours=1)
+    The high-water mark is the latest period_start in the manifest of the area code's
+    preprocessed folder. Raw files that end before it are not parsed, and only the
+    newer rows are appended, so for CSV storage a daily update costs O(new hours)
+    instead of rewriting the yearly file.
 
-                data_records.append({
-                    'price': price_amount,
-                    'business_type': business_type,
-                    'in_domain': in_domain,
-                    'out_domain': out_domain,
-                    'currency': currency,
-                    'period_start': measurement_start_time_utc1.isoformat(),
-                    'period_end': measurement_end_time_utc1.isoformat()
-                })
+    Parameters:
+    file_list (list): Paths to the raw XML files.
+    workers (int, optional): Number of processes used for parsing, see process_files.
 
-    df = pd.DataFrame(data_records)
+    Returns:
+    dict: DataFrames of the appended rows keyed by (area code, year).
+    """
+    high_water_marks = {}
+    new_files = []
+    for xml_file in file_list:
+        area_code = os.path.basename(xml_file).split('_')[0]
+        if area_code not in high_water_marks:
+            high_water_marks[area_code] = get_high_water_mark(os.path.join(config.DATA_PREPROCESSED_DIR, area_code))
+        high_water_mark = high_water_marks[area_code]
+        if high_water_mark is None or get_file_date_range(xml_file)[1] > high_water_mark:
+            new_files.append(xml_file)
+
+    partitions = defaultdict(list)
+    sources = defaultdict(list)
+
+    parsed_files = (
+        (area_code, df if high_water_marks[area_code] is None else df[df['period_start'] > high_water_marks[area_code]])
+        for area_code, df in parse_files(new_files, workers)
+    )
+    collect_partitions(new_files, parsed_files, partitions, sources)
+
+    new_rows = {}
+    for (area_code, year), frames in sorted(partitions.items()):
+        new_df = pd.concat(frames)
+        new_df.drop_duplicates(subset=['period_start'], inplace=True)
+        new_df.sort_values(by='period_start', inplace=True)
+
+        preprocessed_file_path = stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year)
+        os.makedirs(os.path.dirname(preprocessed_file_path), exist_ok=True)
+        write_df(new_df, preprocessed_file_path, append=True)
+        update_file_metadata(preprocessed_file_path, 'preprocessed', df=new_df,
+                             source_files=sources[(area_code, year)], appended=True)
+        print(f"Appended {len(new_df)} rows to {preprocessed_file_path}")
+
+        new_rows[(area_code, year)] = new_df
+
+    return new_rows
+
+def parse_files(file_list, workers=1):
+    """
+    Parse raw XML files, yielding (area code, DataFrame) pairs in the order of file_list.
 
-    # Only convert if 'period_start' column exists
-    if 'period_start' in df.columns:
-        df['period_start'] = pd.to_datetime(df['period_start'])
-        df['period_end'] = pd.to_datetime(df['period_end'])
+    Parameters:
+    file_list (list): Paths to the raw XML files.
+    workers (int, optional): Number of processes used for parsing. 1 parses in the
+        current process, None uses all CPU cores.
+    """
+    if workers == 1:
+        yield from map(parse_file_with_area_code, file_list)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map keeps the input order, so earlier files still take precedence on duplicates
+            yield from executor.map(parse_file_with_area_code, file_list)
 
-    return df
+def collect_partitions(file_list, parsed_files, partitions, sources):
+    """
+    Split parsed (area code, DataFrame) pairs into per (area code, year) lists of
+    frames, and record which raw files contributed to each partition.
+    """
+    for xml_file, (area_code, df) in zip(file_list, parsed_files):
+        if df.empty:
+            continue
+        for year, year_df in df.groupby(df['period_start'].dt.year):
+            partitions[(area_code, year)].append(year_df)
+            sources[(area_code, year)].append(xml_file)
 
-def process_files(file_list):
-    for xml_file in file_list:
-        df = parse_xml_to_df(xml_file)
+def combine_partition(area_code, year, frames):
+    """
+    Combine new frames with the existing preprocessed rows of one area code and year.
 
-        for year, year_df in df.groupby(df['period_start'].dt.year):
-            area_code = os.path.basename(xml_file).split('_')[0]
-            area_code_folder = os.path.join(config.DATA_PREPROCESSED_DIR, area_code)
-            os.makedirs(area_code_folder, exist_ok=True)
+    Existing rows take precedence over new rows with the same period_start.
 
-            file_name = f"{area_code}_{year}.csv"
-            preprocessed_file_path = os.path.join(area_code_folder, file_name)
+    Parameters:
+    area_code (str): The area code.
+    year (int): The year of the partition.
+    frames (list): New DataFrames for the partition, in order of precedence.
 
-            if os.path.exists(preprocessed_file_path):
-                existing_df = pd.read_csv(preprocessed_file_path)
+    Returns:
+    DataFrame: The deduplicated rows, sorted by period_start.
+    """
+    preprocessed_file_path = stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year)
+    if os.path.exists(preprocessed_file_path):
+        frames = [read_df(preprocessed_file_path)] + frames
 
-                # Convert 'period_start' to datetime for both DataFrames
-                existing_df['period_start'] = pd.to_datetime(existing_df['period_start'])
-                year_df['period_start'] = pd.to_datetime(year_df['period_start'])
+    # Combine the data. Categoricals with different categories are concatenated as objects, so the schema is applied again
+    combined_df = apply_schema(pd.concat(frames))
 
-                # Combine the data
-                combined_df = pd.concat([existing_df, year_df])
+    # Drop duplicates and sort the data by period_start
+    combined_df.drop_duplicates(subset=['period_start'], inplace=True)
+    combined_df.sort_values(by='period_start', inplace=True)
+    return combined_df
 
-                # Drop duplicates and sort the data in descending order
-                combined_df.drop_duplicates(subset=['period_start'], inplace=True)
-                combined_df.sort_values(by='period_start', inplace=True)
+def merge_partition(area_code, year, frames, source_files=None):
+    """
+    Merge new frames into the preprocessed file of one area code and year.
 
-                combined_df.to_csv(preprocessed_file_path, index=False)
-            else:
-                year_df.to_csv(preprocessed_file_path, index=False)
+    Existing rows take precedence over new rows with the same period_start.
 
-            try:
-                update_file_metadata(preprocessed_file_path, 'preprocessed')
-                print(f"Metadata updated for {preprocessed_file_path}")
-            except Exception as e:
-                print(f"Error updating metadata for {preprocessed_file_path}: {e}")
+    Parameters:
+    area_code (str): The area code.
+    year (int): The year of the partition.
+    frames (list): New DataFrames for the partition, in order of precedence.
+    source_files (list, optional): Raw files the new frames were parsed from.
+    """
+    preprocessed_file_path = stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year)
+    os.makedirs(os.path.dirname(preprocessed_file_path), exist_ok=True)
+
+    with track_stage('preprocess', area_code, year, rows_in=sum(len(df) for df in frames)) as record:
+        record.read(preprocessed_file_path)
+        combined_df = combine_partition(area_code, year, frames)
+        write_df(combined_df, preprocessed_file_path)
+        record.add_rows(rows_out=len(combined_df))
+        record.wrote(preprocessed_file_path)
+
+    try:
+        update_file_metadata(preprocessed_file_path, 'preprocessed', df=combined_df, source_files=source_files)
+        print(f"Metadata updated for {preprocessed_file_path}")
+    except Exception as e:
+        print(f"Error updating metadata for {preprocessed_file_path}: {e}")
 
 def filter_xml_files_by_year(area_code, start_year, end_year):
     folder_path = os.path.join(config.DATA_RAW_DIR, area_code)
@@ -179,16 +341,46 @@ def filter_xml_files_by_year(area_code, start_year, end_year):
 
     return filtered_files
 
+def filter_xml_files_by_date(area_code, start_date, end_date):
+    """
+    Get the raw XML files of an area code whose date range overlaps start_date..end_date.
+
+    The files are matched on the dates in their names, so a file is processed as a
+    whole if any of its days lies in the range.
+
+    Parameters:
+    area_code (str): The area code.
+    start_date (str): First day (YYYYMMDD).
+    end_date (str): Last day (YYYYMMDD).
+
+    Returns:
+    list: Paths to the matching files.
+    """
+    folder_path = os.path.join(config.DATA_RAW_DIR, area_code)
+
+    filtered_files = []
+    for file in glob.glob(os.path.join(folder_path, '*.xml')):
+        file_name_parts = os.path.basename(file).split('_')
+        file_start_date = ''.join(file_name_parts[1:4])
+        file_end_date = ''.join(file_name_parts[5:8])
+
+        # YYYYMMDD strings compare like the dates they stand for
+        if file_end_date >= start_date and file_start_date <= end_date:
+            filtered_files.append(file)
+
+    return filtered_files
+
 if __name__ == "__main__":
     
     # Example usage for specific files
     # xml_file_path = 'NO1_2023_10_02_to_2023_10_08_day_ahead_prices.xml'  # Replace with your XML file path
     
-    area_code = input("Enter the area code (e.g., 'NO1'): ").strip().upper()
+    area_codes = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
 
-    if not check_area_code_folder(area_code):
-        print(f"No data folder found for area code {area_code}. Exiting.")
-        exit()
+    for area_code in area_codes:
+        if not check_area_code_folder(area_code):
+            print(f"No data folder found for area code {area_code}. Exiting.")
+            exit()
 
     start_year = int(input("Enter the start year (YYYY): "))
     end_year = int(input("Enter the end year (YYYY): "))
@@ -196,29 +388,29 @@ if __name__ == "__main__":
     user_choice = input("Choose an option: 'all', 'first X', 'last X', or 'random X' files: ").strip().lower()
 
     # Filter XML files once here
-    xml_files = filter_xml_files_by_year(area_code, start_year, end_year)
+    xml_files = [xml_file for area_code in area_codes for xml_file in filter_xml_files_by_year(area_code, start_year, end_year)]
 
     if user_choice == 'all':
-        process_files(xml_files)
-        print("Processed all relevant files in the specified area code directory.")
+        process_files(xml_files, workers=config.PREPROCESS_WORKERS)
+        print("Processed all relevant files in the specified area code directories.")
 
     elif user_choice.startswith('first'):
         num_files = int(user_choice.split()[1])
         first_x_files = sorted(xml_files)[:num_files]
         process_files(first_x_files)
-        print(f"Processed the first {num_files} files in the specified area code directory.")
+        print(f"Processed the first {num_files} files in the specified area code directories.")
 
     elif user_choice.startswith('last'):
         num_files = int(user_choice.split()[1])
         last_x_files = sorted(xml_files)[-num_files:]
         process_files(last_x_files)
-        print(f"Processed the last {num_files} files in the specified area code directory.")
+        print(f"Processed the last {num_files} files in the specified area code directories.")
 
     elif user_choice.startswith('random'):
         num_files = int(user_choice.split()[1])
         random_x_files = random.sample(xml_files, min(num_files, len(xml_files)))
         process_files(random_x_files)
-        print(f"Processed a random selection of {num_files} files from the specified area code directory.")
+        print(f"Processed a random selection of {num_files} files from the specified area code directories.")
 
     else:
         print("Invalid input. Please enter one of the specified options.")
\ No newline at end of file
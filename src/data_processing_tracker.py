@@ -2,33 +2,182 @@
 # This file is part of NEPP which is released under GNU GPLv3.
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
-def update_file_metadata(file_path, new_stage):
+import os
+import glob
+import json
+import hashlib
+from datetime import datetime, timezone
+import pandas as pd
+import config
+from storage import FILE_EXTENSIONS, get_storage_format, read_df, write_df
+
+# Each data directory keeps the stage and provenance of its files in this sidecar file
+MANIFEST_FILE_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Stage names that the old in-file metadata could contain
+KNOWN_STAGES = ['preprocessed', 'cleaned', 'normalized']
+
+manifest_cache = {}  # Directory -> (manifest mtime, manifest)
+
+def get_manifest_path(directory):
+    return os.path.join(directory, MANIFEST_FILE_NAME)
+
+def load_manifest(directory, exclude=None):
+    """
+    Load the manifest of a data directory.
+
+    The manifest is cached in memory and only read again when it has changed on
+    disk. A directory without a manifest has its files migrated from the old
+    in-file metadata the first time it is loaded.
+
+    Parameters:
+    directory (str): The data directory, e.g. 'data/processed/cleaned/NO1'.
+    exclude (str, optional): File name to leave out of a migration, e.g. a file that was just written.
+
+    Returns:
+    dict: The manifest, with a 'files' dict keyed by file name.
+    """
+    manifest_path = get_manifest_path(directory)
+
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        if not os.path.isdir(directory):
+            return {'version': MANIFEST_VERSION, 'files': {}}
+        return migrate_legacy_metadata(directory, exclude=exclude)
+
+    cached = manifest_cache.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+    manifest_cache[directory] = (mtime, manifest)
+    return manifest
+
+def save_manifest(directory, manifest):
+    """
+    Write the manifest of a data directory, replacing the old one atomically.
+    """
+    manifest_path = get_manifest_path(directory)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+    manifest_cache[directory] = (os.stat(manifest_path).st_mtime_ns, manifest)
+
+def compute_content_hash(file_path, offset=0, previous_hash=None, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hash of a file, reading it in chunks.
+
+    With an offset and the previous hash, only the bytes appended since then are
+    read and the hash is chained onto the previous one.
+    """
+    digest = hashlib.sha256()
+    if previous_hash is not None:
+        digest.update(previous_hash.encode())
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+def describe_df(df):
     """
-    Update the metadata of a file to include a new processing stage.
+    Get the row count and the time range of a DataFrame for the manifest.
+    """
+    description = {'rows': len(df), 'start': None, 'end': None}
+    if 'period_start' in df.columns and len(df):
+        period_start = pd.to_datetime(df['period_start'])
+        description['start'] = period_start.min().isoformat()
+        description['end'] = period_start.max().isoformat()
+    return description
+
+def merge_descriptions(first, second):
+    """
+    Combine the descriptions (see describe_df) of two parts of the same file, e.g. of
+    the chunks it was written in.
+    """
+    if first is None:
+        return second
+    return {
+        'rows': first['rows'] + second['rows'],
+        'start': min(filter(None, [first['start'], second['start']]), default=None, key=pd.Timestamp),
+        'end': max(filter(None, [first['end'], second['end']]), default=None, key=pd.Timestamp),
+    }
+
+def update_file_metadata(file_path, new_stage, df=None, source_files=None, appended=False, extra=None, description=None):
+    """
+    Record a new processing stage, and the provenance of the file, in the manifest of its directory.
 
     Parameters:
     file_path (str): Path to the file.
     new_stage (str): The processing stage to add (e.g., 'preprocessed').
+    df (DataFrame, optional): The data just written to the file, used for the row count and time range.
+    source_files (list, optional): Paths of the files the data was produced from.
+    appended (bool): If True, df holds only rows appended to the file. The row count and
+        time range are extended, and for CSV only the appended bytes are hashed.
+    extra (dict, optional): Further fields to store in the entry.
+    description (dict, optional): Row count and time range of the data, for data written
+        in chunks without a single DataFrame (see merge_descriptions). Used instead of df.
     """
+    directory = os.path.dirname(file_path)
+    manifest = load_manifest(directory, exclude=os.path.basename(file_path))
+    entry = manifest['files'].setdefault(os.path.basename(file_path), {'stages': [], 'source_files': []})
+
+    if new_stage not in entry['stages']:
+        entry['stages'].append(new_stage)
+    if description is None and df is not None:
+        description = describe_df(df)
+    if description is not None and appended and entry.get('rows') is not None:
+        entry.update(merge_descriptions({key: entry.get(key) for key in ('rows', 'start', 'end')}, description))
+    elif description is not None:
+        entry.update(description)
+    if source_files:
+        entry['source_files'] = sorted(set(entry['source_files']) | {os.path.basename(path) for path in source_files})
+    if extra:
+        entry.update(extra)
+
     try:
-        with open(file_path, 'r+') as file:
-            content = file.readlines()
-            if len(content) > 0:
-                stages = content[0].strip().split(',')
-                if new_stage not in stages:
-                    stages.append(new_stage)
-                    content[0] = ','.join(stages) + '\n'
-            else:
-                content.insert(0, new_stage + '\n')
-            file.seek(0)
-            file.writelines(content)
+        if appended and get_storage_format(file_path) == 'csv' and 'size' in entry and 'content_hash' in entry:
+            entry['content_hash'] = compute_content_hash(file_path, offset=entry['size'], previous_hash=entry['content_hash'])
+        else:
+            entry['content_hash'] = compute_content_hash(file_path)
+        entry['size'] = os.path.getsize(file_path)
+        entry['updated'] = datetime.now(timezone.utc).isoformat()
+        save_manifest(directory, manifest)
     except IOError as e:
         print(f"Error updating file metadata: {e}")
 
+def get_file_metadata(file_path):
+    """
+    Get the manifest entry of a file.
+
+    Returns:
+    dict or None: The entry (stages, rows, start, end, source_files, content_hash), or None if the file is not recorded.
+    """
+    return load_manifest(os.path.dirname(file_path))['files'].get(os.path.basename(file_path))
+
+def get_high_water_mark(directory):
+    """
+    Get the latest period_start recorded for any file in a data directory.
+
+    Parameters:
+    directory (str): The data directory of an area code in a stage, e.g. 'data/processed/cleaned/NO1'.
+
+    Returns:
+    Timestamp or None: The high-water mark, or None if nothing with a time range is recorded.
+    """
+    ends = [entry['end'] for entry in load_manifest(directory)['files'].values() if entry.get('end')]
+    return max((pd.Timestamp(end) for end in ends), default=None)
+
 def check_processing_stage(file_path, required_stage):
     """
     Check if a file has undergone a specific processing stage.
 
+    This is a lookup in the manifest of the file's directory and does not read the file itself.
+
     Parameters:
     file_path (str): Path to the file.
     required_stage (str): The processing stage to check (e.g., 'cleaned').
@@ -37,9 +186,77 @@ def check_processing_stage(file_path, required_stage):
     bool: True if the stage is present, False otherwise.
     """
     try:
-        with open(file_path, 'r') as file:
-            first_line = file.readline().strip()
-            return required_stage in first_line.split(',')
-    except IOError as e:
+        entry = get_file_metadata(file_path)
+    except (IOError, ValueError) as e:
         print(f"Error reading file metadata: {e}")
-        return False
\ No newline at end of file
+        return False
+    return entry is not None and required_stage in entry['stages']
+
+def migrate_legacy_metadata(directory, exclude=None):
+    """
+    Build the manifest of a directory from the old in-file metadata.
+
+    CSV files used to carry their stages on the first line, appended to the header.
+    Those tags are moved to the manifest and the files are rewritten as plain CSV.
+    Other files, and CSV files without tags, get the stage of the directory they are in.
+
+    Parameters:
+    directory (str): The data directory.
+    exclude (str, optional): File name to leave out.
+
+    Returns:
+    dict: The new manifest.
+    """
+    manifest = {'version': MANIFEST_VERSION, 'files': {}}
+    directory_stage = os.path.basename(os.path.dirname(os.path.normpath(directory)))
+
+    data_files = sorted(
+        path for extension in FILE_EXTENSIONS.values()
+        for path in glob.glob(os.path.join(directory, f'*{extension}'))
+        if os.path.basename(path) != exclude
+    )
+
+    for file_path in data_files:
+        area_code = os.path.basename(file_path).split('_')[0]
+        tags = []
+
+        if get_storage_format(file_path) == 'csv':
+            with open(file_path, 'r') as file:
+                first_line = file.readline().strip()
+            tags = [token for token in first_line.split(',') if token in KNOWN_STAGES or token == area_code]
+
+            if tags and len(tags) == len(first_line.split(',')):
+                # Only tags on the first line, no header or data
+                df = pd.DataFrame()
+                with open(file_path, 'w'):
+                    pass
+            else:
+                df = read_df(file_path)
+                if tags:
+                    df = df.drop(columns=tags)
+                    write_df(df, file_path)
+        else:
+            df = read_df(file_path)
+
+        stages = [tag for tag in tags if tag in KNOWN_STAGES]
+        if not stages and directory_stage in KNOWN_STAGES:
+            stages = [directory_stage]
+
+        manifest['files'][os.path.basename(file_path)] = {
+            'stages': stages,
+            'source_files': [],
+            'content_hash': compute_content_hash(file_path),
+            'size': os.path.getsize(file_path),
+            'updated': datetime.now(timezone.utc).isoformat(),
+            **describe_df(df),
+        }
+        print(f"Migrated metadata of {file_path}: {stages}")
+
+    save_manifest(directory, manifest)
+    return manifest
+
+if __name__ == "__main__":
+    # Migrate every area code folder of every processing stage
+    for stage in KNOWN_STAGES:
+        for directory in sorted(glob.glob(os.path.join(config.DATA_PROCESSED_DIR, stage, '*', ''))):
+            load_manifest(directory.rstrip(os.sep))
@@ -0,0 +1,232 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+from functools import partial, reduce
+import numpy as np
+import tensorflow as tf
+import config
+from data_normalizer import FEATURE_COLUMNS
+from data_loader import load_file
+from feature_store import load_features, load_timestamps, to_nanoseconds
+from storage import stage_file_path
+from windowing import make_sequences
+
+def get_training_files(years, area_codes, stage_dir=None):
+    """
+    List the yearly files of the requested years and area codes that exist in a stage.
+
+    Parameters:
+    years (list): Years to include.
+    area_codes (list): Area codes to include, e.g. ['NO1', 'NO2'].
+    stage_dir (str, optional): Stage directory, config.DATA_NORMALIZED_DIR by default.
+
+    Returns:
+    list: Paths of the existing files.
+    """
+    stage_dir = stage_dir or config.DATA_NORMALIZED_DIR
+    file_paths = []
+    for area_code in area_codes:
+        for year in years:
+            file_path = stage_file_path(stage_dir, area_code, int(year))
+            if os.path.exists(file_path):
+                file_paths.append(file_path)
+            else:
+                print(f"No data available for year {year} and area code {area_code}.")
+    return file_paths
+
+def generate_window_chunks(file_path, look_back, horizon, stride, chunk_size, shuffle, seed=None, use_feature_store=False):
+    """
+    Yield the windows of one file in chunks.
+
+    The windows are views of the file's data (see windowing.make_sequences), and only
+    one chunk at a time is copied out, so a file never has all its windows in memory.
+    With use_feature_store the file's float32 export is mapped into memory (see
+    feature_store.load_features), so only the pages of the copied chunks are read.
+    Otherwise the file is read through data_loader.load_file, so later epochs reuse the parsed data.
+
+    Yields:
+    Tuple of (input_sequences, target_prices) for up to chunk_size windows.
+    """
+    if isinstance(file_path, bytes):
+        file_path = file_path.decode()
+    if use_feature_store:
+        data = load_features(file_path)
+    else:
+        data = load_file(file_path, columns=FEATURE_COLUMNS).values
+    input_sequences, target_prices = make_sequences(data, look_back=look_back, horizon=horizon, stride=stride)
+    yield from copy_chunks(input_sequences, target_prices, chunk_size, shuffle, seed)
+
+def copy_chunks(input_sequences, target_prices, chunk_size, shuffle, seed=None):
+    """
+    Yield contiguous copies of the windows and targets, up to chunk_size at a time, in order or shuffled.
+    """
+    chunk_starts = np.arange(0, len(input_sequences), chunk_size)
+    if shuffle:
+        np.random.default_rng(seed).shuffle(chunk_starts)
+    for start in chunk_starts:
+        yield (np.ascontiguousarray(input_sequences[start:start + chunk_size]),
+               np.ascontiguousarray(target_prices[start:start + chunk_size]))
+
+def load_zone_year(year, area_codes, use_feature_store=False):
+    """
+    Load the normalized features of several area codes in one year, aligned by hour.
+
+    Only the hours present for every area code are kept, so that the zones of a
+    timestep are the same hour.
+
+    Parameters:
+    year (int): The year.
+    area_codes (list): Area codes, in the order of the zone axis.
+    use_feature_store (bool): Read the float32 exports of the feature store instead of the normalized files.
+
+    Returns:
+    np.array: float32 array of shape (hours, zones, len(FEATURE_COLUMNS)).
+    """
+    arrays, timestamps = [], []
+    for area_code in area_codes:
+        file_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, year)
+        if use_feature_store:
+            arrays.append(load_features(file_path))
+            timestamps.append(load_timestamps(file_path))
+        else:
+            df = load_file(file_path, columns=FEATURE_COLUMNS + ['period_start'])
+            arrays.append(df[FEATURE_COLUMNS].to_numpy(dtype=np.float32))
+            timestamps.append(to_nanoseconds(df['period_start']))
+    if any(starts is None for starts in timestamps):
+        raise ValueError(f"The normalized files of {year} have no period_start to align the zones by")
+
+    common = reduce(np.intersect1d, timestamps)
+    return np.stack([data[np.isin(starts, common)] for data, starts in zip(arrays, timestamps)], axis=1)
+
+def generate_zone_window_chunks(year, area_codes, look_back, horizon, stride, chunk_size, shuffle, seed=None,
+                                use_feature_store=False):
+    """
+    Yield the multi-zone windows of one year in chunks, see load_zone_year and generate_window_chunks.
+
+    Yields:
+    Tuple of (input_sequences, target_prices) of shapes (windows, look_back, zones, features)
+    and (windows, zones) or (windows, zones, horizon).
+    """
+    area_codes = [code.decode() if isinstance(code, bytes) else code for code in area_codes]
+    data = load_zone_year(int(year), area_codes, use_feature_store)
+    input_sequences, target_prices = make_sequences(data, look_back=look_back, horizon=horizon, stride=stride)
+    yield from copy_chunks(input_sequences, target_prices, chunk_size, shuffle, seed)
+
+def stream_windows(sources, source_windows, shuffle, shuffle_buffer_size, batch_size, seed=None):
+    """
+    Interleave the windows of several sources, shuffle them, and batch and prefetch them.
+
+    Parameters:
+    sources (list): File paths or years, one windows dataset each.
+    source_windows (callable): Maps a source to a dataset of window chunks.
+
+    Returns:
+    tf.data.Dataset: Batches of (input_sequences, target_prices).
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(sources)
+    if shuffle:
+        dataset = dataset.shuffle(len(sources), seed=seed, reshuffle_each_iteration=True)
+    # Only a few sources are open at a time, each holding a chunk of windows, and the
+    # shuffle buffer mixes their windows with those of the sources read before
+    cycle_length = max(1, min(len(sources), config.INTERLEAVE_CYCLE_LENGTH))
+    dataset = dataset.interleave(source_windows, cycle_length=cycle_length, block_length=1,
+                                 num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def build_dataset(years, area_codes, look_back=24, horizon=1, stride=1, batch_size=None, shuffle=True,
+                  shuffle_buffer_size=None, chunk_size=None, seed=None, stage_dir=None):
+    """
+    Build a tf.data pipeline that streams training windows from the processed store.
+
+    Files are read and windowed lazily, config.INTERLEAVE_CYCLE_LENGTH at a time, and
+    their windows are interleaved so that a shuffle buffer mixes the requested years and area codes.
+    The windows are batched and prefetched while the model trains on the previous batch.
+
+    Parameters:
+    years (list): Years to include.
+    area_codes (list): Area codes to include, e.g. ['NO1', 'NO2'].
+    look_back (int): Number of timesteps in each input window.
+    horizon (int): Number of hours to predict after each window.
+    stride (int): Number of hours between the starts of consecutive windows.
+    batch_size (int, optional): Windows per batch, config.BATCH_SIZE by default.
+    shuffle (bool): Shuffle the files, the chunks within a file, and the windows.
+    shuffle_buffer_size (int, optional): Windows in the shuffle buffer, config.SHUFFLE_BUFFER_SIZE by default.
+    chunk_size (int, optional): Windows copied out of a file at a time, config.WINDOW_CHUNK_SIZE by default.
+    seed (int, optional): Seed for the shuffling.
+    stage_dir (str, optional): Stage directory, config.DATA_NORMALIZED_DIR by default. The
+        feature store (config.USE_FEATURE_STORE) is only used for the normalized stage.
+
+    Returns:
+    tf.data.Dataset or None: Batches of (input_sequences, target_prices), or None if no file exists.
+    """
+    file_paths = get_training_files(years, area_codes, stage_dir)
+    if not file_paths:
+        return None
+
+    batch_size = batch_size or config.BATCH_SIZE
+    shuffle_buffer_size = shuffle_buffer_size or config.SHUFFLE_BUFFER_SIZE
+    chunk_size = chunk_size or config.WINDOW_CHUNK_SIZE
+    num_features = len(FEATURE_COLUMNS) - 1
+    target_shape = (None,) if horizon == 1 else (None, horizon)
+    use_feature_store = config.USE_FEATURE_STORE and stage_dir is None
+
+    def file_windows(file_path):
+        return tf.data.Dataset.from_generator(
+            partial(generate_window_chunks, look_back=look_back, horizon=horizon, stride=stride,
+                    chunk_size=chunk_size, shuffle=shuffle, seed=seed, use_feature_store=use_feature_store),
+            args=(file_path,),
+            output_signature=(
+                tf.TensorSpec(shape=(None, look_back, num_features), dtype=tf.float32),
+                tf.TensorSpec(shape=target_shape, dtype=tf.float32),
+            ),
+        )
+
+    return stream_windows(file_paths, file_windows, shuffle, shuffle_buffer_size, batch_size, seed)
+
+def build_multi_zone_dataset(years, area_codes, look_back=24, horizon=1, stride=1, batch_size=None, shuffle=True,
+                             shuffle_buffer_size=None, chunk_size=None, seed=None):
+    """
+    Build a tf.data pipeline of windows that hold every requested zone, for model.create_multi_zone_model.
+
+    The zones of every year are aligned by hour and stacked along a zone axis (see
+    load_zone_year), so one batch trains the model on all zones at once. Years
+    missing for any zone are left out.
+
+    Parameters:
+    years (list): Years to include.
+    area_codes (list): Area codes, in the order of the zone axis, e.g. ['NO1', 'NO2', 'NO3', 'NO4', 'NO5'].
+    Other parameters: See build_dataset.
+
+    Returns:
+    tf.data.Dataset or None: Batches of (input_sequences, target_prices) with inputs of
+        shape (batch, look_back, zones, features), or None if no year has data for all zones.
+    """
+    years = [int(year) for year in years
+             if len(get_training_files([year], area_codes)) == len(area_codes)]
+    if not years:
+        return None
+
+    batch_size = batch_size or config.BATCH_SIZE
+    shuffle_buffer_size = shuffle_buffer_size or config.SHUFFLE_BUFFER_SIZE
+    chunk_size = chunk_size or config.WINDOW_CHUNK_SIZE
+    num_zones, num_features = len(area_codes), len(FEATURE_COLUMNS) - 1
+    target_shape = (None, num_zones) if horizon == 1 else (None, num_zones, horizon)
+
+    def year_windows(year):
+        return tf.data.Dataset.from_generator(
+            partial(generate_zone_window_chunks, area_codes=list(area_codes), look_back=look_back, horizon=horizon,
+                    stride=stride, chunk_size=chunk_size, shuffle=shuffle, seed=seed,
+                    use_feature_store=config.USE_FEATURE_STORE),
+            args=(year,),
+            output_signature=(
+                tf.TensorSpec(shape=(None, look_back, num_zones, num_features), dtype=tf.float32),
+                tf.TensorSpec(shape=target_shape, dtype=tf.float32),
+            ),
+        )
+
+    return stream_windows(years, year_windows, shuffle, shuffle_buffer_size, batch_size, seed)
@@ -0,0 +1,135 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import config
+from data_loader import get_file_signature, load_file
+from data_normalizer import FEATURE_COLUMNS
+from storage import list_stage_files
+
+def to_nanoseconds(period_start):
+    """
+    Convert a period_start column to int64 nanoseconds since the epoch (UTC).
+    """
+    return pd.to_datetime(period_start, utc=True).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def get_feature_paths(file_path, store_dir=None):
+    """
+    Get the paths of the exported features, timestamps and metadata of a normalized file.
+
+    A file data/processed/normalized/NO1/NO1_2022.csv is exported to
+    data/processed/features/NO1/NO1_2022.features.npy, .timestamps.npy and .json.
+
+    Returns:
+    tuple: (features path, timestamps path, metadata path).
+    """
+    store_dir = store_dir or config.FEATURE_STORE_DIR
+    area_code = os.path.basename(os.path.dirname(file_path))
+    base = os.path.join(store_dir, area_code, os.path.splitext(os.path.basename(file_path))[0])
+    return base + '.features.npy', base + '.timestamps.npy', base + '.json'
+
+def is_exported(file_path, store_dir=None):
+    """
+    Check whether the export of a normalized file exists and was made from its current contents.
+    """
+    features_path, _, metadata_path = get_feature_paths(file_path, store_dir)
+    if not os.path.exists(features_path) or not os.path.exists(metadata_path):
+        return False
+    with open(metadata_path, 'r') as file:
+        metadata = json.load(file)
+    return metadata.get('signature') == list(get_file_signature(file_path)) and metadata.get('columns') == FEATURE_COLUMNS
+
+def save_array(array, path):
+    # One temporary file per process, so that concurrent exports never rename each other's file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(temp_path, path)
+
+def export_features(file_path, store_dir=None):
+    """
+    Write the features of a normalized file as one contiguous float32 array.
+
+    The rows are stored in FEATURE_COLUMNS order, with period_start as int64
+    nanoseconds since the epoch (UTC) in a second array, so training can map the
+    arrays into memory instead of parsing the file.
+
+    Parameters:
+    file_path (str): Path to the normalized file.
+    store_dir (str, optional): Feature store directory, config.FEATURE_STORE_DIR by default.
+
+    Returns:
+    str: Path of the features array.
+    """
+    features_path, timestamps_path, metadata_path = get_feature_paths(file_path, store_dir)
+    os.makedirs(os.path.dirname(features_path), exist_ok=True)
+
+    signature = get_file_signature(file_path)
+    df = load_file(file_path, use_cache=False)
+    save_array(np.ascontiguousarray(df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)), features_path)
+    if 'period_start' in df.columns:
+        save_array(to_nanoseconds(df['period_start']), timestamps_path)
+
+    # Written last, so an interrupted export is not taken as current
+    metadata = {'source': file_path, 'signature': list(signature), 'columns': FEATURE_COLUMNS, 'rows': len(df)}
+    temp_path = f"{metadata_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(metadata, file, indent=2)
+    os.replace(temp_path, metadata_path)
+    return features_path
+
+def export_area(area_code, store_dir=None):
+    """
+    Export the normalized files of an area code whose export is missing or out of date.
+
+    Returns:
+    list: Paths of the exported files.
+    """
+    exported = []
+    for file_path in list_stage_files(os.path.join(config.DATA_NORMALIZED_DIR, area_code)):
+        if not is_exported(file_path, store_dir):
+            export_features(file_path, store_dir)
+            exported.append(file_path)
+    return exported
+
+def load_features(file_path, store_dir=None, export=True):
+    """
+    Map the features of a normalized file into memory, without reading them.
+
+    Windows made from the returned array (see windowing.make_sequences) are views
+    of the memory map, so the data is only paged in when the windows are copied out.
+
+    Parameters:
+    file_path (str): Path to the normalized file.
+    store_dir (str, optional): Feature store directory, config.FEATURE_STORE_DIR by default.
+    export (bool): Export the file first if its export is missing or out of date.
+
+    Returns:
+    np.memmap or None: Read-only float32 array of shape (rows, len(FEATURE_COLUMNS)),
+        or None if the file has not been exported and export is False.
+    """
+    if not is_exported(file_path, store_dir):
+        if not export:
+            return None
+        export_features(file_path, store_dir)
+    return np.load(get_feature_paths(file_path, store_dir)[0], mmap_mode='r')
+
+def load_timestamps(file_path, store_dir=None):
+    """
+    Map the exported period_start of a normalized file into memory.
+
+    Returns:
+    np.memmap or None: int64 nanoseconds since the epoch (UTC), or None if they were not exported.
+    """
+    timestamps_path = get_feature_paths(file_path, store_dir)[1]
+    return np.load(timestamps_path, mmap_mode='r') if os.path.exists(timestamps_path) else None
+
+if __name__ == "__main__":
+    area_codes = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
+    for area_code in area_codes:
+        exported = export_area(area_code)
+        print(f"Exported {len(exported)} normalized file(s) of {area_code} to {config.FEATURE_STORE_DIR}")
@@ -0,0 +1,309 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import json
+import time
+import asyncio
+import traceback
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import config
+from data_loader import load_range
+from data_normalizer import FEATURE_COLUMNS
+from inference import forecast, load_cached_model, FORECAST_HOURS
+from scaler_registry import inverse_transform_prices
+from storage import list_stage_files, read_tail
+from windowing import make_prediction_windows
+
+LOOK_BACK = 24
+LATENCY_SAMPLES = 10000  # Latest request latencies kept for the percentiles
+
+def get_model_path(area_code):
+    """
+    Get the model that serves an area code, from config.FORECAST_MODEL_PATHS or the default model.
+    """
+    return config.FORECAST_MODEL_PATHS.get(area_code, config.FORECAST_MODEL_PATH)
+
+class WindowCache:
+    """
+    Keep the latest normalized input window of every area code in memory.
+
+    A window is read again only when the newest normalized file of the area
+    code has changed on disk, and then only its last rows are read, from the
+    previous year's file as well just after New Year.
+    """
+
+    def __init__(self, look_back=LOOK_BACK):
+        self.look_back = look_back
+        self.windows = {}  # Area code -> (file path, file mtime, window, last period_start)
+
+    def get(self, area_code):
+        """
+        Returns:
+        tuple or None: (window, last period_start), or None without enough data.
+        """
+        file_paths = list_stage_files(os.path.join(config.DATA_NORMALIZED_DIR, area_code))
+        if not file_paths:
+            return None
+        file_path = file_paths[-1]
+        mtime = os.stat(file_path).st_mtime_ns
+
+        cached = self.windows.get(area_code)
+        if cached is None or cached[:2] != (file_path, mtime):
+            tail = read_tail(file_path, num_rows=self.look_back)
+            if 0 < len(tail) < self.look_back and 'period_start' in tail.columns:
+                # Early in a year the window reaches back into the previous year's file
+                last_start = pd.Timestamp(tail['period_start'].iloc[-1])
+                tail = load_range(area_code, last_start - pd.Timedelta(hours=self.look_back - 1),
+                                  last_start + pd.Timedelta(hours=1), columns=FEATURE_COLUMNS + ['period_start'])
+            if len(tail) < self.look_back:
+                return None
+            window = make_prediction_windows(tail[FEATURE_COLUMNS].values, look_back=self.look_back)[-1]
+            last_start = pd.Timestamp(tail['period_start'].iloc[-1]) if 'period_start' in tail.columns else None
+            cached = (file_path, mtime, window, last_start)
+            self.windows[area_code] = cached
+        return cached[2:]
+
+class LatencyStats:
+    """
+    Record request latencies and report their percentiles.
+    """
+
+    def __init__(self, max_samples=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+        self.requests = 0
+        self.batches = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.requests += 1
+
+    def summary(self):
+        summary = {'requests': self.requests, 'batches': self.batches}
+        if self.samples:
+            p50, p90, p99 = np.percentile(np.array(self.samples) * 1000, [50, 90, 99])
+            summary.update({'p50_ms': round(p50, 3), 'p90_ms': round(p90, 3), 'p99_ms': round(p99, 3),
+                            'max_ms': round(max(self.samples) * 1000, 3)})
+        return summary
+
+def answer(future, status, body):
+    """
+    Set the (status, body) response of a request, unless it already has one or its client is gone.
+    """
+    if not future.done():
+        future.set_result((status, body))
+
+class ForecastServer:
+    """
+    Serve next-day forecasts over HTTP from models and input windows kept in memory.
+
+    Concurrent requests are collected for up to batch_wait_ms and forecast with one
+    inference.forecast call per model. The input windows are read in a loader thread
+    and the calls run one at a time in a dedicated inference thread, so that the
+    event loop keeps accepting requests. Requests that fail are answered with a 500.
+
+    Endpoints:
+    GET /forecast/{area}: The forecast of the 24 hours after the latest normalized data of an area code.
+    GET /stats: Request count, batch count and latency percentiles.
+    """
+
+    def __init__(self, host=None, port=None, batch_wait_ms=None, max_batch_size=None):
+        self.host = host or config.FORECAST_SERVER_HOST
+        self.port = config.FORECAST_SERVER_PORT if port is None else port
+        self.batch_wait = (config.FORECAST_BATCH_WAIT_MS if batch_wait_ms is None else batch_wait_ms) / 1000
+        self.max_batch_size = max_batch_size or config.FORECAST_MAX_BATCH_SIZE
+        self.windows = WindowCache()
+        self.stats = LatencyStats()
+        self.queue = None
+        self.server = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='forecast')
+        # The windows are read in their own thread, one batch at a time, so WindowCache is used by one thread only
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='windows')
+
+    def warm_up(self, area_codes):
+        """
+        Load the models and input windows of the given area codes and compile their forecast functions.
+        """
+        for area_code in area_codes:
+            model_path = get_model_path(area_code)
+            cached = self.windows.get(area_code)
+            if os.path.exists(model_path) and cached is not None:
+                forecast(load_cached_model(model_path), cached[0][None])
+                print(f"Model {model_path} is warm for {area_code}.")
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.batcher = asyncio.create_task(self.run_batches())
+        print(f"Forecast server listening on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        self.batcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+        self.loader.shutdown(wait=False)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.forecast_batch(batch)
+            except Exception as e:
+                # A failed batch must neither stop the loop nor leave its requests waiting
+                traceback.print_exc()
+                for _, future in batch:
+                    answer(future, 500, {'error': str(e)})
+
+    def load_windows(self, area_codes):
+        """
+        Get the cached window of every area code, with the error instead if reading it failed.
+
+        Runs in the loader thread, so the file reads do not block the event loop.
+
+        Returns:
+        dict: Area code -> (window, last period_start), None, or the exception.
+        """
+        windows = {}
+        for area_code in area_codes:
+            try:
+                windows[area_code] = self.windows.get(area_code)
+            except Exception as e:
+                traceback.print_exc()
+                windows[area_code] = e
+        return windows
+
+    async def forecast_batch(self, batch):
+        """
+        Forecast a batch of (area code, future) requests, with one call per model.
+
+        A request that fails is answered with a 500 on its own, without affecting the rest of the batch.
+        """
+        loop = asyncio.get_running_loop()
+        windows = await loop.run_in_executor(self.loader, self.load_windows, sorted({area_code for area_code, _ in batch}))
+        by_model = {}
+        for area_code, future in batch:
+            cached = windows[area_code]
+            if isinstance(cached, Exception):
+                answer(future, 500, {'error': str(cached)})
+                continue
+            if cached is None:
+                answer(future, 404, {'error': f"No normalized data for {area_code}"})
+                continue
+            model_path = get_model_path(area_code)
+            if not os.path.exists(model_path):
+                answer(future, 503, {'error': f"No model for {area_code}"})
+                continue
+            by_model.setdefault(model_path, []).append((area_code, future, cached))
+
+        for model_path, requests in by_model.items():
+            windows = np.stack([cached[0] for _, _, cached in requests])
+            try:
+                forecasts = await loop.run_in_executor(self.executor, forecast, model_path, windows)
+            except Exception as e:
+                for _, future, _ in requests:
+                    answer(future, 500, {'error': str(e)})
+                continue
+            self.stats.batches += 1
+
+            for (area_code, future, (_, last_start)), normalized_prices in zip(requests, forecasts):
+                try:
+                    start = None if last_start is None else (last_start + pd.Timedelta(hours=1)).isoformat()
+                    prices = inverse_transform_prices(area_code, normalized_prices)
+                    answer(future, 200, {
+                        'area_code': area_code,
+                        'start': start,
+                        'hours': FORECAST_HOURS,
+                        'normalized_prices': normalized_prices.tolist(),
+                        'prices': None if prices is None else prices.tolist(),
+                        'model': os.path.basename(model_path),
+                        'batch_size': len(requests),
+                    })
+                except Exception as e:
+                    traceback.print_exc()
+                    answer(future, 500, {'error': str(e)})
+
+    async def handle_connection(self, reader, writer):
+        start = time.perf_counter()
+        request_line = []
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # Headers are not used
+
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                status, body = 405, {'error': 'Only GET is supported'}
+            else:
+                path = request_line[1].split('?')[0].strip('/').split('/')
+                if len(path) == 2 and path[0] == 'forecast' and path[1].isalnum():
+                    future = asyncio.get_running_loop().create_future()
+                    await self.queue.put((path[1].upper(), future))
+                    status, body = await future
+                elif path == ['stats']:
+                    status, body = 200, self.stats.summary()
+                else:
+                    status, body = 404, {'error': 'Not found'}
+
+            payload = json.dumps(body).encode()
+            writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                         "Connection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+            if request_line[:2] and request_line[1].startswith('/forecast/'):
+                self.stats.record(time.perf_counter() - start)
+
+def request_json(path, host=None, port=None, timeout=10):
+    """
+    Send a GET request to a running forecast server and return the JSON response.
+    """
+    host = host or config.FORECAST_SERVER_HOST
+    port = port or config.FORECAST_SERVER_PORT
+    with urllib.request.urlopen(f"http://{host}:{port}/{path}", timeout=timeout) as response:
+        return json.load(response)
+
+def fetch_forecast(area_code, host=None, port=None, timeout=10):
+    """
+    Request the forecast of an area code from a running forecast server.
+
+    Returns:
+    dict: The JSON response, see ForecastServer.
+    """
+    return request_json(f"forecast/{area_code}", host, port, timeout)
+
+def fetch_stats(host=None, port=None, timeout=10):
+    """
+    Request the request count and latency percentiles from a running forecast server.
+    """
+    return request_json('stats', host, port, timeout)
+
+if __name__ == "__main__":
+    server = ForecastServer()
+    if os.path.isdir(config.DATA_NORMALIZED_DIR):
+        server.warm_up(sorted(os.listdir(config.DATA_NORMALIZED_DIR)))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("Forecast server stopped.")
@@ -0,0 +1,172 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import weakref
+import numpy as np
+import tensorflow as tf
+from keras.models import load_model
+from data_loader import load_data
+from data_normalizer import FEATURE_COLUMNS
+from model import get_model_zones, load_model_zones
+from windowing import make_prediction_windows
+
+FORECAST_HOURS = 24
+
+model_cache = {}  # Model path -> (file mtime, model)
+forecast_fn_cache = weakref.WeakKeyDictionary()  # Model -> {steps: compiled forecast function}
+
+def load_cached_model(model_path):
+    """
+    Load a Keras model, reusing the loaded model until the file changes on disk.
+
+    Parameters:
+    model_path (str): Path to the saved model.
+
+    Returns:
+    The Keras model.
+    """
+    mtime = os.stat(model_path).st_mtime_ns
+    cached = model_cache.get(model_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    model = load_model(model_path)
+    model.area_codes = load_model_zones(model_path)
+    model_cache[model_path] = (mtime, model)
+    return model
+
+def get_forecast_fn(model, steps=FORECAST_HOURS):
+    """
+    Get the compiled function that forecasts the next steps for a batch of windows.
+
+    A model with at least `steps` outputs (see model.create_model) predicts all hours
+    at once. A model with a single output is run autoregressively in a
+    tf.function loop: after every step the windows are shifted by one timestep and
+    the prediction is written to the first feature of the last timestep, like the
+    original predict_next_24_hours loop. Multi-zone models (see
+    model.create_multi_zone_model) are run the same way for all zones at once.
+
+    Parameters:
+    model: The Keras model.
+    steps (int): Number of hours to forecast.
+
+    Returns:
+    Compiled function mapping windows (batch, look_back, features) to forecasts (batch, steps),
+    or windows (batch, look_back, zones, features) to forecasts (batch, zones, steps).
+    """
+    functions = forecast_fn_cache.setdefault(model, {})
+    if steps in functions:
+        return functions[steps]
+
+    input_signature = [tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)]
+    multi_zone = len(model.input_shape) == 4
+    # A multi-zone model predicting one hour has one output per zone and no hour axis
+    hours_axis = not multi_zone or len(model.output_shape) == 3
+    horizon = model.output_shape[-1] if hours_axis else 1
+
+    if horizon >= steps:
+        @tf.function(input_signature=input_signature)
+        def forecast(windows):
+            return model(windows, training=False)[..., :steps]
+    else:
+        @tf.function(input_signature=input_signature)
+        def forecast(windows):
+            predictions = tf.TensorArray(tf.float32, size=steps)
+            for step in tf.range(steps):
+                prediction = model(windows, training=False)
+                if hours_axis:
+                    prediction = prediction[..., 0]
+                predictions = predictions.write(step, prediction)
+                windows = tf.roll(windows, shift=-1, axis=1)
+                last_step = tf.concat([prediction[..., None], windows[:, -1, ..., 1:]], axis=-1)
+                windows = tf.concat([windows[:, :-1], last_step[:, None]], axis=1)
+            # Put the steps last, after the zone axis if there is one
+            return tf.transpose(predictions.stack(), [1, 2, 0] if multi_zone else [1, 0])
+
+    functions[steps] = forecast
+    return forecast
+
+def forecast(model, windows, steps=FORECAST_HOURS):
+    """
+    Forecast the next hours for a batch of input windows in one call.
+
+    Parameters:
+    model (str or Keras model): The model, or the path to a saved model.
+    windows (np.array): Input windows of shape (batch, look_back, features), or
+        (batch, look_back, zones, features) for a multi-zone model.
+    steps (int): Number of hours to forecast.
+
+    Returns:
+    np.array: Forecasts of shape (batch, steps), or (batch, zones, steps) for a multi-zone model.
+    """
+    if isinstance(model, str):
+        model = load_cached_model(model)
+    windows = np.asarray(windows, dtype=np.float32)
+    if len(windows) == 0:
+        return np.empty((0,) + windows.shape[2:-1] + (steps,), dtype=np.float32)
+    return get_forecast_fn(model, steps)(tf.constant(windows)).numpy()
+
+def forecast_next_day(model, area_codes, dates, look_back=24):
+    """
+    Forecast the day after each given date for several area codes in one batch.
+
+    The input window of an area code and date is the last look_back hours of
+    normalized data on that date. A multi-zone model forecasts all of its zones
+    from one window per date, so area_codes must be the zones it was trained on.
+
+    Parameters:
+    model (str or Keras model): The model, or the path to a saved model.
+    area_codes (list): Area codes, e.g. ['NO1', 'NO2'].
+    dates (list): Dates in 'YYYYMMDD' format.
+
+    Returns:
+    dict: Forecasts of shape (24,) keyed by (area code, date). Pairs without enough data are left out.
+    """
+    if isinstance(model, str):
+        model = load_cached_model(model)
+    if len(model.input_shape) == 4:
+        return forecast_next_day_multi_zone(model, area_codes, dates, look_back)
+
+    keys, windows = [], []
+    for area_code in area_codes:
+        for date in dates:
+            data = load_data(int(date[:4]), area_code, 'normalized', specific_date=date, return_array=True,
+                             columns=FEATURE_COLUMNS)
+            if data is None or len(data) < look_back:
+                print(f"Not enough data to forecast {area_code} after {date}.")
+                continue
+            keys.append((area_code, date))
+            windows.append(make_prediction_windows(data, look_back=look_back)[-1])
+
+    if not windows:
+        return {}
+    forecasts = forecast(model, np.stack(windows))
+    return dict(zip(keys, forecasts))
+
+def forecast_next_day_multi_zone(model, area_codes, dates, look_back=24):
+    """
+    Forecast the day after each given date for all zones of a multi-zone model, see forecast_next_day.
+    """
+    zones = get_model_zones(model)
+    if zones is not None and list(area_codes) != zones:
+        raise ValueError(f"The model forecasts the zones {', '.join(zones)}, not {', '.join(area_codes)}")
+
+    keys, windows = [], []
+    for date in dates:
+        zone_data = [load_data(int(date[:4]), area_code, 'normalized', specific_date=date, return_array=True,
+                               columns=FEATURE_COLUMNS) for area_code in area_codes]
+        if any(data is None or len(data) < look_back for data in zone_data):
+            print(f"Not enough data to forecast {', '.join(area_codes)} after {date}.")
+            continue
+        keys.append(date)
+        # The last look_back hours of every zone, stacked along the zone axis
+        windows.append(make_prediction_windows(np.stack([data[-look_back:] for data in zone_data], axis=1),
+                                               look_back=look_back)[-1])
+
+    if not windows:
+        return {}
+    forecasts = forecast(model, np.stack(windows))
+    return {(area_code, date): zone_forecasts[zone]
+            for date, zone_forecasts in zip(keys, forecasts) for zone, area_code in enumerate(area_codes)}
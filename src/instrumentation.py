@@ -0,0 +1,306 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import json
+import time
+import cProfile
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Identifies the records of one run. The zone processes of a batch run take over its id, see main.init_worker.
+RUN_ID = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{os.getpid()}"
+MAX_RECORDS = 10000  # Latest stage records kept in memory
+
+records = deque(maxlen=MAX_RECORDS)
+report_lock = threading.Lock()
+profiling = threading.local()
+
+PROC_STATUS_PATH = '/proc/self/status'
+PROC_CLEAR_REFS_PATH = '/proc/self/clear_refs'
+
+# Peaks measured so far by the stages running in this process, which a stage
+# starting inside them adds to before it resets the high-water mark
+active_peaks = []
+peak_lock = threading.Lock()
+
+# Record fields exported as Prometheus metrics, with their help text
+METRICS = {
+    'wall_seconds': 'Wall time spent in the stage',
+    'cpu_seconds': 'CPU time of the process spent in the stage',
+    'rows_in': 'Rows going into the stage',
+    'rows_out': 'Rows coming out of the stage',
+    'bytes_read': 'Bytes of the files read by the stage',
+    'bytes_written': 'Bytes of the files written by the stage',
+    'peak_rss_bytes': 'Peak resident set size of the process during the stage',
+    'rss_delta_bytes': 'Change of the resident set size of the process over the stage',
+    'process_peak_rss_bytes': 'Peak resident set size of the process since it started, at the end of the stage',
+}
+
+# Fields of METRICS that are summarized by their maximum instead of their total
+PEAK_METRICS = ['peak_rss_bytes', 'process_peak_rss_bytes']
+
+class StageRecord:
+    """
+    Measurements of one run of a stage for one area code and year.
+
+    The stage fills in what it knows while it runs: rows through add_rows, and the
+    files it reads and writes through read and wrote.
+    """
+
+    def __init__(self, stage, area_code=None, year=None, rows_in=None):
+        self.stage = stage
+        self.area_code = area_code
+        self.year = None if year is None else int(year)
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.status = 'ok'
+
+    def add_rows(self, rows_in=None, rows_out=None):
+        if rows_in is not None:
+            self.rows_in = (self.rows_in or 0) + rows_in
+        if rows_out is not None:
+            self.rows_out = (self.rows_out or 0) + rows_out
+
+    def read(self, file_path):
+        if file_path and os.path.exists(file_path):
+            self.bytes_read += os.path.getsize(file_path)
+
+    def wrote(self, file_path):
+        if file_path and os.path.exists(file_path):
+            self.bytes_written += os.path.getsize(file_path)
+
+def read_proc_status(field):
+    """
+    Read a memory field of /proc/self/status in bytes, e.g. 'VmRSS', or None where it is not available.
+    """
+    try:
+        with open(PROC_STATUS_PATH, 'r') as file:
+            return next((int(line.split()[1]) * 1024 for line in file if line.startswith(f'{field}:')), None)
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size (VmHWM) of the process to its current RSS.
+
+    Returns:
+    bool: True if reset, False where Linux does not allow it, or on other systems.
+    """
+    try:
+        with open(PROC_CLEAR_REFS_PATH, 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_process_peak_rss():
+    """
+    Get the peak resident set size of the process since it started in bytes, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+class PeakRss:
+    """
+    Measure the memory of the process over one stage.
+
+    On Linux the high-water mark of the process is reset when the stage starts and
+    read when it ends, giving the peak of the stage itself. Stages running inside
+    it reset the mark too, so they first add the peak so far to the outer stages.
+    Where the mark cannot be reset only the change of the RSS is measured, along
+    with the peak of the whole process so far (ru_maxrss).
+    """
+
+    def __init__(self):
+        self.start_rss = read_proc_status('VmRSS')
+        self.peak = None
+        with peak_lock:
+            high_water_mark = read_proc_status('VmHWM')
+            if active_peaks and high_water_mark is not None:
+                for outer in active_peaks:
+                    outer.peak = max(outer.peak or 0, high_water_mark)
+            if reset_peak_rss():
+                self.peak = 0
+                active_peaks.append(self)
+
+    def stop(self):
+        """
+        Returns:
+        dict: peak_rss_bytes, rss_delta_bytes and process_peak_rss_bytes, None where not measured.
+        """
+        end_rss = read_proc_status('VmRSS')
+        peak = None
+        with peak_lock:
+            if self.peak is not None:
+                active_peaks.remove(self)
+                peak = max(self.peak, read_proc_status('VmHWM') or 0)
+                for outer in active_peaks:
+                    outer.peak = max(outer.peak, peak)
+        return {
+            'peak_rss_bytes': peak,
+            'rss_delta_bytes': None if self.start_rss is None or end_rss is None else end_rss - self.start_rss,
+            # Resetting the mark also resets ru_maxrss, so it is only the peak of the process without resets
+            'process_peak_rss_bytes': get_process_peak_rss() if peak is None else None,
+        }
+
+def should_profile(stage):
+    stages = config.PROFILE_STAGES or []
+    return (stage in stages or '*' in stages) and not getattr(profiling, 'active', False)
+
+def get_profile_path(record):
+    labels = [record.stage, record.area_code, None if record.year is None else str(record.year)]
+    name = '_'.join(label for label in labels if label)
+    return os.path.join(config.PROFILE_DIR, f"{name}_{os.getpid()}_{time.time_ns()}.prof")
+
+@contextmanager
+def track_stage(stage, area_code=None, year=None, rows_in=None):
+    """
+    Measure a stage run and add it to the run report.
+
+    Wall time, CPU time and the memory of the process (see PeakRss) are measured
+    around the block. Rows and bytes are recorded by the block through the yielded StageRecord.
+    The finished record is kept in memory (see records) and appended to
+    config.RUN_REPORT_PATH as one JSON line, if set. If the stage is listed in
+    config.PROFILE_STAGES, the block also runs under cProfile and its statistics are
+    saved in config.PROFILE_DIR, for a look with pstats or snakeviz.
+
+    Parameters:
+    stage (str): Stage name, e.g. 'clean'.
+    area_code (str, optional): The area code the stage works on.
+    year (int, optional): The year the stage works on.
+    rows_in (int, optional): Rows going into the stage, if known up front.
+
+    Yields:
+    StageRecord: The record to add rows and files to.
+    """
+    record = StageRecord(stage, area_code, year, rows_in)
+    profiler = None
+    if should_profile(stage):
+        profiler = cProfile.Profile()
+        profiling.active = True
+        profiler.enable()
+
+    started = datetime.now(timezone.utc)
+    memory = PeakRss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        # Only the type, since messages can hold request URLs with credentials
+        record.status = f"failed: {type(e).__name__}"
+        raise
+    finally:
+        wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        memory_fields = memory.stop()
+        if profiler is not None:
+            profiler.disable()
+            profiling.active = False
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(get_profile_path(record))
+
+        entry = {
+            'run_id': RUN_ID, 'pid': os.getpid(), 'started': started.isoformat(),
+            'stage': record.stage, 'area_code': record.area_code, 'year': record.year, 'status': record.status,
+            'wall_seconds': round(wall_seconds, 6), 'cpu_seconds': round(cpu_seconds, 6),
+            'rows_in': record.rows_in, 'rows_out': record.rows_out,
+            'bytes_read': record.bytes_read, 'bytes_written': record.bytes_written,
+            **memory_fields,
+        }
+        records.append(entry)
+        if config.RUN_REPORT_PATH:
+            append_report(entry, config.RUN_REPORT_PATH)
+
+def append_report(entry, report_path):
+    """
+    Append a record to a JSON-lines run report.
+
+    Every record is one write to a file opened for appending, so the records of
+    concurrent worker processes do not interleave.
+    """
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    line = json.dumps(entry) + '\n'
+    with report_lock, open(report_path, 'a') as file:
+        file.write(line)
+
+def read_report(report_path, run_id=None):
+    """
+    Read the records of a JSON-lines run report, optionally only those of one run.
+
+    Returns:
+    list: The records, as dicts.
+    """
+    if not os.path.exists(report_path):
+        return []
+    with open(report_path, 'r') as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    return [entry for entry in entries if run_id is None or entry['run_id'] == run_id]
+
+def summarize(entries):
+    """
+    Add up the records of every stage, area code and year.
+
+    Returns:
+    dict: Totals of the METRICS fields keyed by (stage, area code, year), with the
+        maximum of the PEAK_METRICS fields and a count of the runs.
+    """
+    totals = defaultdict(lambda: defaultdict(float))
+    for entry in entries:
+        total = totals[(entry['stage'], entry.get('area_code') or '', '' if entry.get('year') is None else str(entry['year']))]
+        total['runs'] += 1
+        total['failures'] += entry.get('status', 'ok') != 'ok'
+        for field in METRICS:
+            value = entry.get(field)
+            if value is None:
+                continue
+            total[field] = max(total[field], value) if field in PEAK_METRICS else total[field] + value
+    return totals
+
+def format_prometheus(entries):
+    """
+    Format the totals of run records in the Prometheus text exposition format.
+    """
+    totals = summarize(entries)
+    lines = []
+    for field, help_text in list(METRICS.items()) + [('runs', 'Runs of the stage'), ('failures', 'Failed runs of the stage')]:
+        name = f"nepp_stage_{field}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for (stage, area_code, year), total in sorted(totals.items()):
+            if field in total:
+                lines.append(f'{name}{{stage="{stage}",area_code="{area_code}",year="{year}"}} {total[field]:g}')
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(prometheus_path, entries=None, run_id=None):
+    """
+    Write the totals of a run in the Prometheus text format, e.g. for the node exporter's textfile collector.
+
+    Parameters:
+    prometheus_path (str): File to write, replaced atomically.
+    entries (list, optional): Records to export. By default the records of the run
+        in config.RUN_REPORT_PATH, or the records in memory without a report file.
+    run_id (str, optional): Run whose records are read from the report, this run by default.
+    """
+    if entries is None:
+        if config.RUN_REPORT_PATH:
+            entries = read_report(config.RUN_REPORT_PATH, run_id or RUN_ID)
+        else:
+            entries = list(records)
+    os.makedirs(os.path.dirname(prometheus_path) or '.', exist_ok=True)
+    temp_path = prometheus_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(format_prometheus(entries))
+    os.replace(temp_path, prometheus_path)
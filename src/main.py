@@ -2,13 +2,46 @@
 # This file is part of NEPP which is released under GNU GPLv3.
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
-from data_fetcher import fetch_data_with_retries
-from data_preprocessor import process_all_xml_files
-from data_cleaner import clean_file
-from data_normalizer import normalize_file
-from train import train_model
+import argparse
+import json
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import pytz
+import instrumentation
+from instrumentation import write_prometheus
 import os, config
 
+# The stage modules are imported by the functions that run them, so that a run only
+# loads the libraries of its stages: TensorFlow for training, requests and entsoe
+# for fetching. Data-only runs then start without the seconds TensorFlow takes.
+
+# Pipeline stages in order, and the stage each one needs to have succeeded first
+STAGES = ['fetch', 'preprocess', 'clean', 'normalize', 'train']
+STAGE_DEPENDENCIES = {
+    'preprocess': 'fetch',
+    'clean': 'preprocess',
+    'normalize': 'clean',
+    'train': 'normalize',
+}
+
+# Stages run per zone in the process pool, the others run once for all zones
+ZONE_STAGES = ['preprocess', 'clean', 'normalize']
+
+# Config values the zone processes take over from the batch run (see init_worker),
+# so that settings made by run_cli reach them however the processes are started
+WORKER_CONFIG = ['DATA_RAW_DIR', 'DATA_PROCESSED_DIR', 'DATA_PREPROCESSED_DIR', 'DATA_CLEANED_DIR', 'DATA_NORMALIZED_DIR',
+                 'STORAGE_FORMAT', 'PARQUET_COMPRESSION', 'PARQUET_ROW_GROUP_SIZE', 'CHUNK_SIZE',
+                 'WRITE_INTERMEDIATE_STAGES', 'PREPROCESS_WORKERS', 'SCALER_REGISTRY_PATH',
+                 'CLEAN_RESOLUTION_MINUTES', 'GAP_FILL_POLICY', 'GAP_FILL_LIMIT', 'GAP_REPORT_DIR',
+                 'RUN_REPORT_PATH', 'PROMETHEUS_REPORT_PATH', 'PROFILE_STAGES', 'PROFILE_DIR']
+
+# Exit statuses of the batch run
+EXIT_OK = 0
+EXIT_STAGE_FAILED = 1
+EXIT_USAGE = 2
+
 def main():
     area_code = input("Enter the area code (e.g., NO1): ").strip().upper()
 
@@ -31,6 +64,7 @@ def main():
     # Training Model
     if input("Do you want to train the model? (yes/no): ").lower() == 'yes':
         years = input("Enter the years to train on (comma-separated, e.g., 2017,2018,2019): ")
+        from train import train_model
         train_model(years.split(','), area_code)
 
 def proceed_to_next_step(area_code, directory, stage):
@@ -47,20 +81,270 @@ def clear_directory(folder_path):
         os.remove(os.path.join(folder_path, file))
 
 def fetch_data(area_code):
+    from backfill import run_backfill
     start_date = input("Enter the start date (YYYYMMDD): ")
     end_date = input("Enter the end date (YYYYMMDD): ")
-    fetch_data_with_retries(start_date, end_date, area_code)
+    run_backfill(start_date, end_date, [area_code])
 
 def preprocess_data(area_code):
+    from data_preprocessor import process_files, filter_xml_files_by_date
     start_date = input("Enter the start date for preprocessing (YYYY-MM-DD): ")
     end_date = input("Enter the end date for preprocessing (YYYY-MM-DD): ")
-    process_all_xml_files(area_code, start_date, end_date)
+    xml_files = filter_xml_files_by_date(area_code, start_date.replace('-', ''), end_date.replace('-', ''))
+    process_files(xml_files, workers=config.PREPROCESS_WORKERS)
 
 def clean_data(area_code):
-    clean_file(area_code)
+    from data_cleaner import clean_file
+    from storage import list_stage_files
+    cleaned_folder = os.path.join(config.DATA_CLEANED_DIR, area_code)
+    os.makedirs(cleaned_folder, exist_ok=True)
+    for file_path in list_stage_files(os.path.join(config.DATA_PREPROCESSED_DIR, area_code)):
+        clean_file(file_path, cleaned_folder)
 
 def normalize_data(area_code):
-    normalize_file(area_code)
+    from data_normalizer import normalize_area
+    normalize_area(area_code)
+
+def run_zone_stages(area_code, stages, start_date, end_date, fused=False):
+    """
+    Run the per-zone stages of one area code in order.
+
+    A stage only runs if the stage it depends on succeeded or was not requested;
+    otherwise it is skipped. Module level so it can be sent to the worker processes.
+
+    Only the raw files whose dates overlap start_date..end_date are preprocessed, and
+    their rows are merged into the yearly files. Clean and normalize then run over
+    the yearly files of the area code.
+
+    Parameters:
+    area_code (str): The area code.
+    stages (list): Requested stages, see STAGES.
+    start_date (str): First day (YYYYMMDD).
+    end_date (str): Last day (YYYYMMDD).
+    fused (bool): Run preprocess, clean and normalize as one pipeline.run_pipeline pass.
+
+    Returns:
+    dict: Status of every requested zone stage: 'ok', 'failed: <error>' or 'skipped'.
+    """
+    from data_preprocessor import process_files, filter_xml_files_by_date
+    xml_files = filter_xml_files_by_date(area_code, start_date, end_date)
+    runners = {
+        'preprocess': lambda: process_files(xml_files),
+        'clean': lambda: clean_data(area_code),
+        'normalize': lambda: normalize_data(area_code),
+    }
+
+    statuses = {}
+    for stage in ZONE_STAGES:
+        if stage not in stages:
+            continue
+        dependency = STAGE_DEPENDENCIES.get(stage)
+        if dependency in statuses and statuses[dependency] != 'ok':
+            statuses[stage] = 'skipped'
+            continue
+
+        if fused and stage in ('clean', 'normalize') and 'preprocess' in stages:
+            # Already done by the fused pass of the preprocess stage
+            statuses[stage] = statuses['preprocess']
+            continue
+        try:
+            if fused and stage == 'preprocess':
+                from pipeline import run_pipeline
+                run_pipeline(xml_files)
+            else:
+                runners[stage]()
+            statuses[stage] = 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            statuses[stage] = f"failed: {e}"
+    return statuses
+
+def init_worker(config_values, run_id):
+    """
+    Set up a zone process: take over the config and the run id of the batch run,
+    so its stage records go to the run's report under the run's id.
+    """
+    for name, value in config_values.items():
+        setattr(config, name, value)
+    instrumentation.RUN_ID = run_id
+
+def run_batch(area_codes, stages, start_date, end_date, workers=None, fused=False, train_years=None, multi_zone=False):
+    """
+    Run the requested stages for several area codes without any prompts.
+
+    Fetching runs once for all area codes, so that they share the fetcher's rate
+    limit. The per-zone stages of the area codes then run concurrently in a process
+    pool, and training runs last on the area codes whose normalization succeeded.
+
+    Parameters:
+    area_codes (list): Area codes, e.g. ['NO1', 'NO2'].
+    stages (list): Stages to run, see STAGES.
+    start_date (str): First day (YYYYMMDD).
+    end_date (str): Last day (YYYYMMDD).
+    workers (int, optional): Number of zone processes, config.PIPELINE_WORKERS or one per area code by default.
+    fused (bool): Run preprocess, clean and normalize as one pass per zone.
+    train_years (list, optional): Years to train on. All years of the date range by default.
+    multi_zone (bool): Train one joint model for all trainable area codes, see train.train_model.
+
+    Returns:
+    dict: Status of every requested stage, keyed by area code and then by stage.
+    """
+    statuses = {area_code: {} for area_code in area_codes}
+
+    if 'fetch' in stages:
+        try:
+            from backfill import run_backfill
+            _, failures = run_backfill(start_date, end_date, area_codes)
+            failed_areas = {job[0] for job in failures}
+            for area_code in area_codes:
+                statuses[area_code]['fetch'] = 'failed: fetch errors' if area_code in failed_areas else 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            for area_code in area_codes:
+                statuses[area_code]['fetch'] = f"failed: {e}"
+
+    zone_stages = [stage for stage in ZONE_STAGES if stage in stages]
+    if zone_stages:
+        ready = [area_code for area_code in area_codes if statuses[area_code].get('fetch', 'ok') == 'ok']
+        for area_code in set(area_codes) - set(ready):
+            statuses[area_code].update({stage: 'skipped' for stage in zone_stages})
+
+        workers = workers or config.PIPELINE_WORKERS or max(len(ready), 1)
+        config_values = {name: getattr(config, name) for name in WORKER_CONFIG}
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(config_values, instrumentation.RUN_ID)) as executor:
+            futures = {area_code: executor.submit(run_zone_stages, area_code, zone_stages, start_date, end_date, fused)
+                       for area_code in ready}
+            for area_code, future in futures.items():
+                try:
+                    statuses[area_code].update(future.result())
+                except Exception as e:
+                    statuses[area_code].update({stage: f"failed: {e}" for stage in zone_stages})
+
+    if 'train' in stages:
+        trainable = [area_code for area_code in area_codes if statuses[area_code].get('normalize', 'ok') == 'ok']
+        for area_code in set(area_codes) - set(trainable):
+            statuses[area_code]['train'] = 'skipped'
+        if trainable:
+            years = train_years or list(range(int(start_date[:4]), int(end_date[:4]) + 1))
+            try:
+                from train import train_model
+                train_model(years, trainable, multi_zone=multi_zone)
+                status = 'ok'
+            except Exception as e:
+                traceback.print_exc()
+                status = f"failed: {e}"
+            for area_code in trainable:
+                statuses[area_code]['train'] = status
+
+    return statuses
+
+def parse_args(argv):
+    """
+    Parse the command line of a batch run, with defaults from an optional JSON config file.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the NEPP pipeline for several zones without prompts. "
+                    "Without arguments the interactive single-zone flow runs.")
+    parser.add_argument('--config', help="JSON file with any of the options below, e.g. "
+                                         "{\"zones\": [\"NO1\", \"NO2\"], \"start\": \"20230101\", \"stages\": [\"fetch\"]}")
+    parser.add_argument('--zones', help="Comma-separated area codes (default: NO1-NO5)")
+    parser.add_argument('--start', help="First day, YYYYMMDD. The raw files overlapping the date range are preprocessed")
+    parser.add_argument('--end', help="Last day, YYYYMMDD (default: tomorrow in UTC+1)")
+    parser.add_argument('--stages', help=f"Comma-separated stages out of {','.join(STAGES)} (default: all but train)")
+    parser.add_argument('--workers', type=int, help="Number of zone processes (default: one per zone)")
+    parser.add_argument('--fused', action='store_true', default=None,
+                        help="Run preprocess, clean and normalize as one pass per zone")
+    parser.add_argument('--train-years', help="Comma-separated years to train on (default: the date range)")
+    parser.add_argument('--multi-zone', action='store_true', default=None,
+                        help="Train one joint model that predicts all zones at once")
+    parser.add_argument('--report', help="JSON-lines file to append the timing and memory of every stage to")
+    parser.add_argument('--prometheus', help="File to write the stage totals of the run to in Prometheus text format")
+    parser.add_argument('--profile', help="Comma-separated stages to run under cProfile, or '*' for all")
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.config:
+        try:
+            with open(args.config, 'r') as file:
+                options = json.load(file)
+        except (OSError, ValueError) as e:
+            parser.error(f"Could not read config file {args.config}: {e}")
+
+    def option(name, value, default=None):
+        if value is not None:
+            return value
+        return options.get(name, default)
+
+    def as_list(value):
+        return [item.strip() for item in value.split(',')] if isinstance(value, str) else list(value)
+
+    tomorrow = datetime.now(pytz.utc) + timedelta(hours=1) + timedelta(days=1)
+    settings = {
+        'area_codes': [code.upper() for code in as_list(option('zones', args.zones, ['NO1', 'NO2', 'NO3', 'NO4', 'NO5']))],
+        'start_date': option('start', args.start),
+        'end_date': option('end', args.end, tomorrow.strftime('%Y%m%d')),
+        'stages': as_list(option('stages', args.stages, STAGES[:-1])),
+        'workers': option('workers', args.workers),
+        'fused': bool(option('fused', args.fused, False)),
+        'train_years': option('train_years', args.train_years),
+        'multi_zone': bool(option('multi_zone', args.multi_zone, False)),
+        'report_path': option('report', args.report),
+        'prometheus_path': option('prometheus', args.prometheus),
+        'profile_stages': as_list(option('profile', args.profile, [])),
+    }
+    if settings['train_years'] is not None:
+        settings['train_years'] = [int(year) for year in as_list(settings['train_years'])]
+
+    if not settings['start_date']:
+        parser.error("a start date is required, with --start or in the config file")
+    for name in ('start_date', 'end_date'):
+        try:
+            datetime.strptime(str(settings[name]), '%Y%m%d')
+        except ValueError:
+            parser.error(f"{name} must be YYYYMMDD, got {settings[name]}")
+        settings[name] = str(settings[name])
+    unknown = set(settings['stages']) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}")
+    return settings
+
+def run_cli(argv):
+    """
+    Run a batch from command line arguments and report the status of every stage.
+
+    Returns:
+    int: EXIT_OK if every stage succeeded, EXIT_STAGE_FAILED otherwise.
+    """
+    try:
+        settings = parse_args(argv)
+    except SystemExit as e:
+        return EXIT_USAGE if e.code else EXIT_OK
+
+    # The stage records of the zone processes only come together in the report file
+    prometheus_path = settings.pop('prometheus_path')
+    report_path = settings.pop('report_path') or config.RUN_REPORT_PATH
+    if prometheus_path and not report_path:
+        report_path = os.path.splitext(prometheus_path)[0] + '.jsonl'
+    config.RUN_REPORT_PATH = report_path
+    config.PROMETHEUS_REPORT_PATH = prometheus_path or config.PROMETHEUS_REPORT_PATH
+    config.PROFILE_STAGES = settings.pop('profile_stages') or config.PROFILE_STAGES
+
+    statuses = run_batch(**settings)
+    if config.PROMETHEUS_REPORT_PATH:
+        write_prometheus(config.PROMETHEUS_REPORT_PATH)
+        print(f"Stage metrics written to {config.PROMETHEUS_REPORT_PATH}")
+
+    failed = False
+    print("Stage summary:")
+    for area_code, stage_statuses in statuses.items():
+        for stage in STAGES:
+            if stage in stage_statuses:
+                print(f"  {area_code} {stage}: {stage_statuses[stage]}")
+                failed |= stage_statuses[stage] != 'ok'
+    return EXIT_STAGE_FAILED if failed else EXIT_OK
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    main()
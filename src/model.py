@@ -2,8 +2,13 @@
 # This file is part of NEPP which is released under GNU GPLv3.
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
+import os
+import json
 from keras.models import Sequential
-from keras.layers import LSTM, Dense, Dropout
+from keras.layers import LSTM, Dense, Dropout, Reshape
+
+# Sidecar file saved next to a multi-zone model, with its zones in the order of the zone axis
+ZONES_FILE_SUFFIX = '.zones.json'
 
 def create_model(input_shape, num_outputs=1, units=50, dropout_rate=0.2):
     """
@@ -32,4 +37,85 @@ def create_model(input_shape, num_outputs=1, units=50, dropout_rate=0.2):
     # Compile the model
     model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mae'])  # Using MSE for regression
 
-    return model
\ No newline at end of file
+    return model
+
+def create_multi_zone_model(input_shape, num_outputs=1, units=128, dropout_rate=0.2, area_codes=None):
+    """
+    Create and return a LSTM model that predicts several zones at once.
+
+    The features of all zones at a timestep are fed to the LSTM layers together, so
+    one model learns every zone and the coupling between their prices.
+
+    Args:
+    input_shape (tuple): The shape of the input data (look_back, number_of_zones, number_of_features).
+    num_outputs (int): The number of hours predicted for every zone.
+    units (int): The number of units in the LSTM layers.
+    dropout_rate (float): Dropout rate for regularization.
+    area_codes (list, optional): The zones in the order of the zone axis, kept on the
+        model and saved next to it by save_model (see get_model_zones).
+
+    Returns:
+    A compiled Keras model with outputs of shape (number_of_zones,), or
+    (number_of_zones, num_outputs) if more than one hour is predicted.
+    """
+    look_back, num_zones, num_features = input_shape
+    model = Sequential()
+
+    # Put the features of all zones side by side at every timestep
+    model.add(Reshape((look_back, num_zones * num_features), input_shape=input_shape))
+    model.add(LSTM(units, return_sequences=True))
+    model.add(Dropout(dropout_rate))
+    model.add(LSTM(units, return_sequences=False))
+    model.add(Dropout(dropout_rate))
+
+    # One output per zone and predicted hour
+    model.add(Dense(num_zones * num_outputs))
+    if num_outputs > 1:
+        model.add(Reshape((num_zones, num_outputs)))
+
+    model.compile(optimizer='adam', loss='mean_squared_error', metrics=['mae'])
+    model.area_codes = list(area_codes) if area_codes else None
+
+    return model
+
+def get_model_zones(model):
+    """
+    Get the zones a multi-zone model was created for, in the order of its zone axis.
+
+    Returns:
+    list or None: The area codes, or None for a single-zone model or if they were not recorded.
+    """
+    zones = getattr(model, 'area_codes', None)
+    if len(model.input_shape) != 4 or not zones:
+        return None
+    return list(zones)
+
+def save_model(model, model_path):
+    """
+    Save a model, and the zones of a multi-zone model in a JSON file next to it.
+    """
+    model.save(model_path)
+    zones_path = model_path + ZONES_FILE_SUFFIX
+    zones = get_model_zones(model)
+    if zones is None:
+        # Do not leave the zones of an earlier model saved under the same path
+        if os.path.exists(zones_path):
+            os.remove(zones_path)
+        return
+    temp_path = f"{zones_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump({'area_codes': zones}, file)
+    os.replace(temp_path, zones_path)
+
+def load_model_zones(model_path):
+    """
+    Read the zones saved next to a model by save_model.
+
+    Returns:
+    list or None: The area codes, or None if none were saved.
+    """
+    try:
+        with open(model_path + ZONES_FILE_SUFFIX, 'r') as file:
+            return json.load(file)['area_codes']
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,173 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+from collections import defaultdict
+import pandas as pd
+import config
+from data_preprocessor import parse_files, collect_partitions, combine_partition, filter_xml_files_by_year
+from data_cleaner import clean_data, write_gap_report, summarize_gaps
+from data_normalizer import normalize_data
+from data_processing_tracker import update_file_metadata, get_file_metadata
+from instrumentation import track_stage
+from scaler_registry import get_scaler, get_scaler_entry, update_scaler
+from schema import apply_schema
+from storage import read_df, write_df, stage_file_path
+
+def write_stage(df, stage_dir, stage, area_code, year, source_files, extra=None):
+    """
+    Write the rows of one area code and year to a processing stage and record them in its manifest.
+
+    Returns:
+    str: Path of the written file.
+    """
+    file_path = stage_file_path(stage_dir, area_code, year)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    write_df(df, file_path)
+    update_file_metadata(file_path, stage, df=df, source_files=source_files, extra=extra)
+    return file_path
+
+def merge_normalized(file_path, df):
+    """
+    Merge newly normalized rows with the rows of an existing normalized file.
+
+    Used when a year has no preprocessed file to merge the parsed rows with, so that a
+    run on some of a year's raw files does not replace the rest of the year. Existing
+    rows take precedence over new rows with the same period_start, like in
+    data_preprocessor.combine_partition.
+
+    Returns:
+    DataFrame: The rows to write, sorted by period_start.
+    """
+    existing_df = read_df(file_path)
+    combined_df = apply_schema(pd.concat([existing_df, df]))
+    combined_df.drop_duplicates(subset=['period_start'], inplace=True)
+    combined_df.sort_values(by='period_start', inplace=True)
+    return combined_df.reset_index(drop=True)
+
+def check_rescaled_years(cleaned, merged_preprocessed, refit_scaler):
+    """
+    Refuse to normalize part of a year whose normalized file would have to be merged
+    with rows scaled by another scaler.
+
+    Only years without a preprocessed file are merged with their normalized file
+    (see merge_normalized). If the scaler of the area code is refitted by the run,
+    or was not used for the file, the run has to cover all rows of the file instead.
+
+    Raises:
+    ValueError: For the first such year whose rows are not all covered by the run.
+    """
+    for (area_code, year), df in sorted(cleaned.items()):
+        file_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, year)
+        if (area_code, year) in merged_preprocessed or not os.path.exists(file_path):
+            continue
+        entry = get_file_metadata(file_path) or {}
+        scaler_entry = None if refit_scaler else get_scaler_entry(area_code)
+        if not entry.get('rows') or (scaler_entry is not None and entry.get('scaler_fitted') == scaler_entry['fitted']):
+            continue
+        if not (len(df) and entry.get('start') and entry.get('end')
+                and df['period_start'].min() <= pd.Timestamp(entry['start'])
+                and df['period_start'].max() >= pd.Timestamp(entry['end'])):
+            raise ValueError(f"{file_path} was scaled with another scaler and the raw files do not cover all of its "
+                             "rows. Run on all raw files of the year, or keep the preprocessed stage (write_intermediate).")
+
+def run_pipeline(file_list, workers=1, write_intermediate=None, refit_scaler=False):
+    """
+    Take raw XML files through preprocessing, cleaning and normalization in one pass.
+
+    The parsed frames of every (area code, year) are cleaned, given their time
+    features and scaled in memory, and only the normalized file is written. The
+    preprocessed and cleaned files are written only if write_intermediate is set, for
+    debugging or auditing, so a run costs one write per area code and year instead
+    of three writes and two reads.
+
+    The parsed rows are merged with the preprocessed file of their year if there is
+    one, and otherwise with the normalized file (see merge_normalized), so a run on
+    some of a year's raw files keeps the rest of the year.
+
+    Raises:
+    ValueError: If part of a year would be merged with rows scaled by another scaler,
+        see check_rescaled_years. Nothing is normalized or refitted then.
+
+    Parameters:
+    file_list (list): Paths to the raw XML files.
+    workers (int, optional): Number of processes used for parsing, see data_preprocessor.process_files.
+    write_intermediate (bool, optional): Also write the preprocessed and cleaned stages.
+        config.WRITE_INTERMEDIATE_STAGES by default.
+    refit_scaler (bool): Refit the price scaler of each area code on the data of this
+        run. By default a registered scaler is reused and only a missing one is fitted.
+
+    Returns:
+    dict: Paths of the written normalized files keyed by (area code, year).
+    """
+    if write_intermediate is None:
+        write_intermediate = config.WRITE_INTERMEDIATE_STAGES
+
+    partitions = defaultdict(list)
+    sources = defaultdict(list)
+    collect_partitions(file_list, parse_files(file_list, workers), partitions, sources)
+
+    # Clean every partition first, so the scaler of an area code can be fitted on all of its years
+    cleaned = {}
+    merged_preprocessed = set()
+    for (area_code, year), frames in sorted(partitions.items()):
+        if os.path.exists(stage_file_path(config.DATA_PREPROCESSED_DIR, area_code, year)):
+            merged_preprocessed.add((area_code, year))
+        with track_stage('preprocess', area_code, year, rows_in=sum(len(df) for df in frames)) as record:
+            preprocessed_df = combine_partition(area_code, year, frames)
+            record.add_rows(rows_out=len(preprocessed_df))
+            if write_intermediate:
+                record.wrote(write_stage(preprocessed_df, config.DATA_PREPROCESSED_DIR, 'preprocessed', area_code, year,
+                                         sources[(area_code, year)]))
+
+        with track_stage('clean', area_code, year, rows_in=len(preprocessed_df)) as record:
+            gap_report = []
+            cleaned_df = clean_data(preprocessed_df, gap_report=gap_report)
+            record.add_rows(rows_out=len(cleaned_df))
+            write_gap_report(gap_report, area_code, year)
+            if write_intermediate:
+                record.wrote(write_stage(cleaned_df, config.DATA_CLEANED_DIR, 'cleaned', area_code, year,
+                                         sources[(area_code, year)], extra=summarize_gaps(gap_report)))
+        cleaned[(area_code, year)] = cleaned_df
+
+    check_rescaled_years(cleaned, merged_preprocessed, refit_scaler)
+    scalers = {}
+    for area_code in sorted({area_code for area_code, _ in cleaned}):
+        scaler = None if refit_scaler else get_scaler(area_code)
+        if scaler is None:
+            frames = [df for (code, _), df in sorted(cleaned.items()) if code == area_code]
+            scaler = update_scaler(area_code, frames, refit=True)
+        scalers[area_code] = (scaler, get_scaler_entry(area_code))
+
+    normalized_files = {}
+    for area_code, year in sorted(cleaned):
+        scaler, scaler_entry = scalers[area_code]
+        with track_stage('normalize', area_code, year) as record:
+            # Release each cleaned frame once it is normalized
+            cleaned_df = cleaned.pop((area_code, year))
+            record.add_rows(rows_in=len(cleaned_df))
+            normalized_df = normalize_data(cleaned_df, scaler)
+            del cleaned_df
+            normalized_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, year)
+            if (area_code, year) not in merged_preprocessed and os.path.exists(normalized_path):
+                record.read(normalized_path)
+                normalized_df = merge_normalized(normalized_path, normalized_df)
+
+            file_path = write_stage(normalized_df, config.DATA_NORMALIZED_DIR, 'normalized', area_code, year,
+                                    sources[(area_code, year)], extra={'scaler_fitted': scaler_entry['fitted']})
+            record.add_rows(rows_out=len(normalized_df))
+            record.wrote(file_path)
+        print(f"Normalized {len(normalized_df)} rows of {area_code} {year} into {file_path}")
+        normalized_files[(area_code, year)] = file_path
+
+    return normalized_files
+
+if __name__ == "__main__":
+    area_codes = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
+    start_year = int(input("Enter the start year (YYYY): "))
+    end_year = int(input("Enter the end year (YYYY): "))
+    write_intermediate = input("Also write the preprocessed and cleaned stages? (yes/no): ").strip().lower() == 'yes'
+
+    xml_files = [xml_file for area_code in area_codes for xml_file in filter_xml_files_by_year(area_code, start_year, end_year)]
+    run_pipeline(xml_files, workers=config.PREPROCESS_WORKERS, write_intermediate=write_intermediate)
@@ -2,13 +2,15 @@
 # This file is part of NEPP which is released under GNU GPLv3.
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
-import matplotlib.pyplot as plt
-from keras.models import load_model
 from data_fetcher import fetch_data_with_retries
-from data_preprocessor import process_files, filter_xml_files_by_year
-from data_cleaner import clean_file
-from data_normalizer import normalize_file
+from data_preprocessor import process_files_incremental, filter_xml_files_by_year
+from data_cleaner import clean_incremental
+from data_normalizer import normalize_incremental, FEATURE_COLUMNS
 from data_loader import load_data
+from storage import stage_file_path
+from windowing import make_prediction_windows
+from inference import forecast
+from scaler_registry import inverse_transform_prices
 import config 
 import numpy as np
 from datetime import datetime, timedelta
@@ -30,11 +32,11 @@ def fetch_and_process_recent_data(area_code):
     end_date_str = end_date.strftime('%Y%m%d')
 
 
-    normalized_file_path = os.path.join(config.DATA_NORMALIZED_DIR, area_code, f"{area_code}_{current_year}.csv")
+    normalized_file_path = stage_file_path(config.DATA_NORMALIZED_DIR, area_code, current_year)
 
     # Check if normalized data for the specific date exists
     if os.path.exists(normalized_file_path):
-        existing_data = load_data(int(current_year), area_code, 'normalized', specific_date=data_date_str, return_array=True)
+        existing_data = load_data(int(current_year), area_code, 'normalized', specific_date=data_date_str, return_array=True, columns=FEATURE_COLUMNS)
         if existing_data is not None and not existing_data.size == 0:
             print(f"Normalized data for {data_date_str} already exists. Loading data.")
             return existing_data
@@ -42,53 +44,44 @@ def fetch_and_process_recent_data(area_code):
     # Data for the specific date does not exist, proceed to fetch and process
     fetch_data_with_retries(data_date_str, end_date_str, area_code)
 
+    # Only the hours after each stage's high-water mark are processed and appended
     xml_files = filter_xml_files_by_year(area_code, int(current_year), int(current_year))
-    process_files(xml_files)
+    new_rows = process_files_incremental(xml_files)
+    new_preprocessed = {year: df for (code, year), df in new_rows.items() if code == area_code}
+    new_cleaned = clean_incremental(area_code, new_preprocessed)
+    normalize_incremental(area_code, new_cleaned)
 
-    # Path for the specific year's preprocessed and cleaned data
-    preprocessed_file_path = os.path.join(config.DATA_PREPROCESSED_DIR, area_code, f"{area_code}_{current_year}.csv")
-    cleaned_file_path = os.path.join(config.DATA_CLEANED_DIR, area_code, f"{area_code}_{current_year}.csv")
+    # Load the normalized data for the specified date
+    return load_data(int(current_year), area_code, 'normalized', specific_date=data_date_str, return_array=True, columns=FEATURE_COLUMNS)
 
-    # Clean the specific preprocessed file if it exists
-    if os.path.exists(preprocessed_file_path):
-        cleaned_area_code_folder = os.path.join(config.DATA_CLEANED_DIR, area_code)
-        os.makedirs(cleaned_area_code_folder, exist_ok=True)
-        clean_file(preprocessed_file_path, cleaned_area_code_folder)
-    else:
-        print(f"Preprocessed file not found: {preprocessed_file_path}")
-        return None
-
-    # Normalize the specific cleaned file if it exists
-    if os.path.exists(cleaned_file_path):
-        normalized_area_code_folder = os.path.join(config.DATA_NORMALIZED_DIR, area_code)
-        os.makedirs(normalized_area_code_folder, exist_ok=True)
-        normalize_file(cleaned_file_path, normalized_area_code_folder)
-    else:
-        print(f"Cleaned file not found: {cleaned_file_path}")
-        return None
+def predict_next_24_hours(model, recent_data, area_code=None):
+    """
+    Predict the 24 hours after the most recent input window.
 
-    # Load the normalized data for the specified date
-    return load_data(int(current_year), area_code, 'normalized', specific_date=data_date_str, return_array=True)
-
-def predict_next_24_hours(model, recent_data):
-    model = load_model(model)
-
-    predictions = []
-    current_input = recent_data
-    
-    # Predict iteratively
-    for _ in range(24):
-        # Predict the next hour
-        next_hour_prediction = model.predict(current_input)
-        predictions.append(next_hour_prediction[0, 0])  # Assuming the prediction shape is (1, 1)
-        
-        # Update current_input to include the new prediction
-        current_input = np.roll(current_input, -1, axis=1)
-        current_input[0, -1, 0] = next_hour_prediction  # Set the last value to the new prediction
-    
-    return np.array(predictions)
+    The model is loaded once and cached, and the hours are predicted in a single
+    compiled call (see inference.forecast). Only the last window of recent_data,
+    the one ending with the latest hour, is used, like in inference.forecast_next_day
+    and the forecast server. Earlier versions predicted from the first window,
+    which for the windows of a day ends 23 hours before the latest hour.
+
+    Args:
+    model (str or Keras model): The model, or the path to a saved model.
+    recent_data (np.array): Input windows of shape (num_windows, look_back, features), oldest first.
+    area_code (str, optional): If given, the predictions are mapped back to prices with
+        the registered scaler of the area code (see scaler_registry).
+
+    Returns:
+    np.array: The 24 predicted prices, normalized unless the area code has a registered scaler.
+    """
+    predictions = forecast(model, recent_data[-1:])[0]
+    if area_code is not None:
+        prices = inverse_transform_prices(area_code, predictions)
+        if prices is not None:
+            return prices
+    return predictions
 
 def visualize_predictions(predictions):
+    import matplotlib.pyplot as plt  # Only needed to plot, and slow to import
     plt.figure(figsize=(12, 6))
     plt.plot(predictions, label='Predicted Prices')
 
@@ -129,22 +122,15 @@ def reshape_data_for_prediction(data, look_back=24):
     Returns:
     np.array: Reshaped data ready for prediction.
     """
-    # Assuming the first column is the price, exclude it from features
-    feature_data = data[:, 1:]  # Exclude the price column
-    
-    # Initialize an array to hold the reshaped data
-    reshaped_data = []
-
-    # Generate sequences for prediction
-    for i in range(len(feature_data) - look_back + 1):
-        sequence = feature_data[i:(i + look_back)]
-        reshaped_data.append(sequence)
-
-    return np.array(reshaped_data)
+    # The first column is the price, which is excluded from the features.
+    # The windows are a float32 view of the data, not copies.
+    return make_prediction_windows(data, look_back=look_back)
 
 if __name__ == "__main__":
+    area_code = 'NO5'
+
     # Fetch and process recent data
-    recent_data = fetch_and_process_recent_data('NO5')
+    recent_data = fetch_and_process_recent_data(area_code)
 
     # Reshape data for prediction
     reshaped_recent_data = reshape_data_for_prediction(recent_data)
@@ -159,9 +145,9 @@ if __name__ == "__main__":
 
         if latest_data_date == current_date:
             print('Data is for today, predict for tomorrow')
-            next_day_predictions = predict_next_24_hours(config.MODEL_SAVE_PATH+'trained_model1.keras', reshaped_recent_data)
+            next_day_predictions = predict_next_24_hours(config.MODEL_SAVE_PATH+'trained_model1.keras', reshaped_recent_data, area_code)
             visualize_predictions(next_day_predictions)
         elif latest_data_date < current_date:
             print('Data is for tomorrows date, predict for the next two days')
-            next_two_days_predictions = predict_next_24_hours(config.MODEL_SAVE_PATH+'trained_model1.keras', reshaped_recent_data)
+            next_two_days_predictions = predict_next_24_hours(config.MODEL_SAVE_PATH+'trained_model1.keras', reshaped_recent_data, area_code)
             visualize_predictions(next_two_days_predictions[1])  # Visualize second day's predictions
\ No newline at end of file
@@ -0,0 +1,166 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import json
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import config
+from storage import iter_chunks
+
+try:
+    import fcntl
+except ImportError:  # Windows, where zones are not normalized in parallel processes
+    fcntl = None
+
+REGISTRY_VERSION = 1
+
+registry_cache = {}  # Registry path -> (file mtime, registry)
+
+def load_registry(registry_path=None, use_cache=True):
+    """
+    Load the scaler registry, reusing the loaded registry until the file changes on disk.
+
+    Parameters:
+    registry_path (str, optional): Registry file, config.SCALER_REGISTRY_PATH by default.
+    use_cache (bool): If False, always read the file. Writers do so under registry_lock,
+        since another process can replace the file without changing its mtime.
+
+    Returns:
+    dict: The registry, with a 'scalers' dict keyed by area code and then by feature.
+    """
+    registry_path = registry_path or config.SCALER_REGISTRY_PATH
+    try:
+        mtime = os.stat(registry_path).st_mtime_ns
+    except FileNotFoundError:
+        return {'version': REGISTRY_VERSION, 'scalers': {}}
+
+    cached = registry_cache.get(registry_path)
+    if use_cache and cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(registry_path, 'r') as file:
+        registry = json.load(file)
+    registry_cache[registry_path] = (mtime, registry)
+    return registry
+
+def save_registry(registry, registry_path=None):
+    """
+    Write the scaler registry, replacing the old one atomically.
+    """
+    registry_path = registry_path or config.SCALER_REGISTRY_PATH
+    os.makedirs(os.path.dirname(registry_path) or '.', exist_ok=True)
+    # One temporary file per process, so that concurrent writers never rename each other's file
+    temp_path = f"{registry_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(registry, file, indent=2, sort_keys=True)
+    os.replace(temp_path, registry_path)
+    registry_cache[registry_path] = (os.stat(registry_path).st_mtime_ns, registry)
+
+@contextmanager
+def registry_lock(registry_path=None):
+    """
+    Hold an exclusive lock on the scaler registry while it is read, updated and written.
+
+    The zones of a batch run (see main.run_batch) fit their scalers in separate
+    processes, and without the lock one process could overwrite another's update.
+    """
+    registry_path = registry_path or config.SCALER_REGISTRY_PATH
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(registry_path) or '.', exist_ok=True)
+    with open(registry_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def scaler_from_entry(entry, feature='price'):
+    """
+    Rebuild a fitted MinMaxScaler of a feature from its registry entry.
+    """
+    from sklearn.preprocessing import MinMaxScaler  # sklearn takes most of a second to import
+    scaler = MinMaxScaler().partial_fit(pd.DataFrame({feature: [entry['data_min'], entry['data_max']]}))
+    scaler.n_samples_seen_ = entry['n_samples_seen']
+    return scaler
+
+def get_scaler_entry(area_code, feature='price', registry_path=None):
+    """
+    Get the registry entry (data_min, data_max, n_samples_seen, fitted) of a scaler, or None.
+    """
+    return load_registry(registry_path)['scalers'].get(area_code, {}).get(feature)
+
+def get_scaler(area_code, feature='price', registry_path=None):
+    """
+    Get the fitted scaler of a feature of an area code.
+
+    Returns:
+    MinMaxScaler or None: The scaler, or None if none has been fitted.
+    """
+    entry = get_scaler_entry(area_code, feature, registry_path)
+    return None if entry is None else scaler_from_entry(entry, feature)
+
+def update_scaler(area_code, chunks, feature='price', refit=False, registry_path=None):
+    """
+    Fit the scaler of a feature of an area code with partial_fit over chunks of data and save it.
+
+    Parameters:
+    area_code (str): The area code.
+    chunks (iterable): DataFrames or arrays holding the feature, fitted one at a time.
+    feature (str): The feature column.
+    refit (bool): If True, start from an unfitted scaler instead of updating the registered one.
+    registry_path (str, optional): Registry file, config.SCALER_REGISTRY_PATH by default.
+
+    Returns:
+    MinMaxScaler or None: The updated scaler, or None if there was no data.
+    """
+    from sklearn.preprocessing import MinMaxScaler
+    # The registered scaler is read and updated under the lock, so that an update from
+    # another process between the read and the write is never lost
+    with registry_lock(registry_path):
+        registry = load_registry(registry_path, use_cache=False)
+        entry = None if refit else registry['scalers'].get(area_code, {}).get(feature)
+        scaler = MinMaxScaler() if entry is None else scaler_from_entry(entry, feature)
+
+        for chunk in chunks:
+            values = chunk[[feature]] if hasattr(chunk, 'columns') else pd.DataFrame({feature: np.ravel(chunk)})
+            if len(values):
+                scaler.partial_fit(values)
+        if not hasattr(scaler, 'data_min_'):
+            return None
+
+        registry['scalers'].setdefault(area_code, {})[feature] = {
+            'data_min': float(scaler.data_min_[0]),
+            'data_max': float(scaler.data_max_[0]),
+            'n_samples_seen': int(scaler.n_samples_seen_),
+            'fitted': datetime.now(timezone.utc).isoformat(),
+        }
+        save_registry(registry, registry_path)
+    return scaler
+
+def fit_scaler_from_files(area_code, file_paths, feature='price', registry_path=None):
+    """
+    Refit the scaler of a feature of an area code over the given files, reading only
+    that column, one chunk of config.CHUNK_SIZE rows at a time.
+    """
+    chunks = (chunk for file_path in file_paths for chunk in iter_chunks(file_path, config.CHUNK_SIZE, columns=[feature]))
+    return update_scaler(area_code, chunks, feature=feature, refit=True, registry_path=registry_path)
+
+def inverse_transform_prices(area_code, normalized_prices, registry_path=None):
+    """
+    Map normalized prices of an area code back to prices in EUR/MWh.
+
+    Returns:
+    np.array or None: The prices, with the shape of normalized_prices, or None if no scaler is registered.
+    """
+    entry = get_scaler_entry(area_code, 'price', registry_path)
+    if entry is None:
+        return None
+    # Invert the min-max scaling from the registered range, without building a scaler on every call
+    data_range = entry['data_max'] - entry['data_min']
+    return np.asarray(normalized_prices, dtype=float) * (data_range or 1.0) + entry['data_min']
@@ -0,0 +1,51 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+
+# Compact dtypes of the columns of the processed stages. The TimeSeries fields hold
+# one value per document and become categoricals, the calendar fields small ints,
+# and prices and time features float32, which keeps the two decimals of a price.
+# The timestamp columns stay datetime64[ns] in UTC+1, see storage.normalize_timestamps.
+CATEGORY_COLUMNS = ['business_type', 'in_domain', 'out_domain', 'currency']
+SCHEMA = {
+    'price': 'float32',
+    **{column: 'category' for column in CATEGORY_COLUMNS},
+    'hour': 'int8',
+    'day_of_week': 'int8',
+    'day_of_month': 'int8',
+    'month': 'int8',
+    'year': 'int16',
+    'hour_sin': 'float32',
+    'hour_cos': 'float32',
+    'day_of_week_sin': 'float32',
+    'day_of_week_cos': 'float32',
+}
+
+def apply_schema(df):
+    """
+    Give the columns of a DataFrame the dtypes of SCHEMA, in place.
+
+    Columns that are not in the schema, or not in the DataFrame, are left alone.
+    Categoricals get the categories of the values at hand, so frames with different
+    categories are concatenated to object columns and need the schema applied again.
+
+    Parameters:
+    df (DataFrame): The DataFrame, e.g. a parsed file or a chunk read from a stage.
+
+    Returns:
+    DataFrame: The same DataFrame.
+
+    Raises:
+    ValueError: If an integer column has values outside the range of its dtype.
+    """
+    for column, dtype in SCHEMA.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if dtype.startswith('int') and len(df):
+            limits = np.iinfo(dtype)
+            if df[column].min() < limits.min or df[column].max() > limits.max:
+                raise ValueError(f"Values of {column} do not fit in {dtype}")
+        df[column] = df[column].astype(dtype)
+    return df
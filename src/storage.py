@@ -0,0 +1,513 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import io
+import os
+import glob
+import operator
+from datetime import timedelta, timezone
+import numpy as np
+import pandas as pd
+import config
+from schema import apply_schema
+
+# File extension for each supported storage format
+FILE_EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+}
+
+# Columns stored as timestamps, parsed back to datetime when reading CSV
+DATETIME_COLUMNS = ['period_start', 'period_end']
+
+# Comparison operators accepted in read_df filters
+FILTER_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+csv_index_cache = {}  # CSV path -> (mtime, size, period_start as int64 ns, byte offset of every row and of the end)
+
+# Suffix of the file next to a CSV file (and its directory's manifest) that keeps its time index across processes
+CSV_INDEX_SUFFIX = '.index.npz'
+
+# Timezone of naive timestamps in time range queries, like the day boundaries of the raw files
+UTC_PLUS_1 = timezone(timedelta(hours=1))
+
+def get_storage_format(file_path=None):
+    """
+    Get the storage format of a file from its extension, or the configured format.
+
+    Parameters:
+    file_path (str, optional): Path to a data file. If omitted, config.STORAGE_FORMAT is returned.
+
+    Returns:
+    str: 'csv', 'parquet' or 'feather'.
+    """
+    if file_path is None:
+        storage_format = config.STORAGE_FORMAT
+    else:
+        extension = os.path.splitext(file_path)[1]
+        storage_format = next((name for name, ext in FILE_EXTENSIONS.items() if ext == extension), None)
+
+    if storage_format not in FILE_EXTENSIONS:
+        raise ValueError(f"Unsupported storage format: {storage_format}")
+    return storage_format
+
+def stage_file_path(stage_dir, area_code, year):
+    """
+    Build the path of the yearly file of an area code in a processing stage directory.
+
+    Parameters:
+    stage_dir (str): Stage directory, e.g. config.DATA_CLEANED_DIR.
+    area_code (str): The area code.
+    year (int): The year of the data.
+
+    Returns:
+    str: Path to the file in the configured storage format.
+    """
+    extension = FILE_EXTENSIONS[get_storage_format()]
+    return os.path.join(stage_dir, area_code, f"{area_code}_{year}{extension}")
+
+def stage_file_area_year(file_path):
+    """
+    Get the area code and year of a yearly stage file, e.g. ('NO1', 2022) for .../NO1/NO1_2022.csv.
+    """
+    area_code, year = os.path.splitext(os.path.basename(file_path))[0].split('_')[:2]
+    return area_code, int(year)
+
+def list_stage_files(folder):
+    """
+    List the data files in the configured storage format within a folder.
+    """
+    extension = FILE_EXTENSIONS[get_storage_format()]
+    return sorted(glob.glob(os.path.join(folder, f'*{extension}')))
+
+def normalize_timestamps(df):
+    """
+    Give the timestamp columns of a DataFrame a uniform dtype, and the other columns the dtypes of schema.SCHEMA.
+
+    CSV timestamps are parsed to datetime, and fixed UTC offsets (which Arrow
+    returns as pytz.FixedOffset) become datetime.timezone like in the parser output,
+    so frames read from different formats can be concatenated. Every reader below
+    goes through here, so all stages are read with the same compact dtypes.
+    """
+    for column in DATETIME_COLUMNS:
+        if column not in df.columns:
+            continue
+        if not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column])
+        tz = getattr(df[column].dtype, 'tz', None)
+        if tz is not None and not isinstance(tz, timezone):
+            offset = tz.utcoffset(None)
+            if offset is not None:
+                df[column] = df[column].dt.tz_convert(timezone(offset))
+    return apply_schema(df)
+
+def read_df(file_path, columns=None, filters=None):
+    """
+    Read a data file into a DataFrame.
+
+    Parquet files are read with column projection and the filters are pushed down
+    so that row groups whose statistics do not match are skipped. For CSV and
+    Feather the filters are applied after reading.
+
+    Parameters:
+    file_path (str): Path to the data file.
+    columns (list, optional): Columns to read. All columns if omitted.
+    filters (list, optional): (column, operator, value) tuples that must all hold, e.g.
+        ('month', '==', 12) or ('period_start', '>', timestamp). See FILTER_OPERATORS.
+
+    Returns:
+    DataFrame: The data, with the timestamp columns as datetime64.
+    """
+    storage_format = get_storage_format(file_path)
+    filter_columns = [column for column, _, _ in filters or []]
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + filter_columns))
+
+    if storage_format == 'parquet':
+        df = normalize_timestamps(pd.read_parquet(file_path, columns=read_columns, filters=filters or None))
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    if storage_format == 'feather':
+        df = pd.read_feather(file_path, columns=read_columns)
+    else:
+        df = pd.read_csv(file_path, usecols=read_columns)
+    normalize_timestamps(df)
+
+    if filters:
+        mask = pd.Series(True, index=df.index)
+        for column, op, value in filters:
+            mask &= FILTER_OPERATORS[op](df[column], value)
+        df = df[mask]
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+def write_df(df, file_path, append=False):
+    """
+    Write a DataFrame to a data file in the format given by the file extension.
+
+    CSV files are appended to in place. Parquet and Feather files cannot be
+    appended to, so the existing data is read and written back with the new rows.
+
+    Parameters:
+    df (DataFrame): The DataFrame to write.
+    file_path (str): Path to the data file.
+    append (bool): If True and the file exists, add the rows to the existing data.
+    """
+    storage_format = get_storage_format(file_path)
+    exists = os.path.exists(file_path)
+
+    if storage_format == 'csv':
+        if append and exists:
+            df.to_csv(file_path, mode='a', index=False, header=False)
+        else:
+            df.to_csv(file_path, index=False)
+        return
+
+    if append and exists:
+        df = pd.concat([read_df(file_path), df])
+    df = df.reset_index(drop=True)
+
+    if storage_format == 'parquet':
+        df.to_parquet(file_path, index=False, compression=config.PARQUET_COMPRESSION,
+                      row_group_size=config.PARQUET_ROW_GROUP_SIZE)
+    else:
+        df.to_feather(file_path)
+
+def iter_chunks(file_path, chunk_size, columns=None):
+    """
+    Read a data file in chunks of rows, holding only one chunk in memory at a time.
+
+    CSV files are read with a chunked reader, Parquet files one batch of rows at a
+    time, and Feather files are memory-mapped and sliced.
+
+    Parameters:
+    file_path (str): Path to the data file.
+    chunk_size (int): Maximum number of rows per chunk.
+    columns (list, optional): Columns to read. All columns if omitted.
+
+    Yields:
+    DataFrame: The next chunk, with the timestamp columns as datetime64.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    storage_format = get_storage_format(file_path)
+
+    if storage_format == 'parquet':
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield normalize_timestamps(batch.to_pandas())
+        return
+
+    if storage_format == 'feather':
+        with pa.memory_map(file_path) as source:
+            reader = pa.ipc.open_file(source)
+            for index in range(reader.num_record_batches):
+                batch = reader.get_batch(index)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    yield normalize_timestamps(batch.slice(offset, chunk_size).to_pandas())
+        return
+
+    if os.path.getsize(file_path) == 0:
+        return
+    with pd.read_csv(file_path, usecols=columns, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield normalize_timestamps(chunk)
+
+class ChunkWriter:
+    """
+    Write a data file one DataFrame chunk at a time, in the format given by the file extension.
+
+    The chunks go to a temporary file that replaces file_path when the writer is
+    closed, so readers never see a partly written file. Parquet chunks are written as
+    row groups and Feather chunks as record batches, so no chunk is held after it is written.
+
+    Usage:
+    with ChunkWriter(file_path) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        # One temporary file per process, so that concurrent writers never rename each other's file
+        self.temp_path = f"{file_path}.{os.getpid()}.tmp"
+        self.storage_format = get_storage_format(file_path)
+        self.writer = None
+        self.schema = None
+        self.started = False
+        self.rows = 0
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        df = df.reset_index(drop=True)
+        if self.storage_format == 'csv':
+            df.to_csv(self.temp_path, mode='a' if self.started else 'w', index=False, header=not self.started)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                if self.storage_format == 'parquet':
+                    self.writer = pq.ParquetWriter(self.temp_path, self.schema, compression=config.PARQUET_COMPRESSION)
+                else:
+                    compression = 'lz4' if pa.Codec.is_available('lz4') else None
+                    self.writer = pa.ipc.new_file(self.temp_path, self.schema,
+                                                  options=pa.ipc.IpcWriteOptions(compression=compression))
+            if self.storage_format == 'parquet':
+                self.writer.write_table(table, row_group_size=config.PARQUET_ROW_GROUP_SIZE)
+            else:
+                self.writer.write_table(table)
+        self.started = True
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if not self.started:
+            # No chunks, leave an empty file of the right format
+            write_df(pd.DataFrame(), self.file_path)
+            return
+        os.replace(self.temp_path, self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.writer is not None:
+                self.writer.close()
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+def to_utc_nanoseconds(timestamp):
+    """
+    Convert a timestamp to int64 nanoseconds since the epoch. Naive timestamps are taken as UTC+1.
+    """
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(UTC_PLUS_1)
+    return timestamp.value
+
+def get_csv_index_path(file_path):
+    """
+    Get the path of the persisted time index of a CSV file, e.g. .../NO1/NO1_2023.csv.index.npz.
+    """
+    return file_path + CSV_INDEX_SUFFIX
+
+def load_csv_time_index(file_path, stat):
+    """
+    Load the persisted time index of a CSV file, if it was built for the file as it is now.
+
+    Returns:
+    tuple or None: (period_start, offsets), with both None if the rows are not sorted,
+        or None if there is no index or the size or mtime of the file have changed.
+    """
+    try:
+        with np.load(get_csv_index_path(file_path)) as index:
+            if (int(index['mtime_ns']), int(index['size'])) != (stat.st_mtime_ns, stat.st_size):
+                return None
+            if not index['sorted']:
+                return None, None
+            return index['period_start'], index['offsets']
+    except (OSError, KeyError, ValueError):
+        return None
+
+def save_csv_time_index(file_path, stat, timestamps, offsets):
+    """
+    Write the time index of a CSV file next to it, replacing the old one atomically.
+
+    The index holds the size and mtime of the file it was built for, the first and
+    last period_start, and the period_start and byte offset of every row. Files not
+    sorted by period_start only get the marker, so they are not scanned again.
+    """
+    index_path = get_csv_index_path(file_path)
+    # One temporary file per process, so that concurrent readers never rename each other's file
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    is_sorted = timestamps is not None
+    timestamps = timestamps if is_sorted else np.array([], dtype=np.int64)
+    try:
+        with open(temp_path, 'wb') as file:
+            np.savez(file, mtime_ns=stat.st_mtime_ns, size=stat.st_size, sorted=is_sorted,
+                     start=timestamps[0] if len(timestamps) else -1, end=timestamps[-1] if len(timestamps) else -1,
+                     period_start=timestamps, offsets=offsets if is_sorted else np.array([], dtype=np.int64))
+        os.replace(temp_path, index_path)
+    except OSError as e:
+        # A read-only data directory only costs a scan of the file in every process
+        print(f"Error saving the time index of {file_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_csv_time_index(file_path):
+    """
+    Get the period_start and byte offset of every row of a CSV file, sorted by period_start.
+
+    The index is built by one scan of the file and saved next to it (see
+    save_csv_time_index), so later time range reads, also in other processes,
+    only read the bytes of the rows they need. It is built again when the size
+    or mtime of the file change.
+
+    Returns:
+    tuple or None: (period_start as int64 nanoseconds, row byte offsets with the end of
+        the file appended), or None if the rows are not sorted by period_start.
+    """
+    stat = os.stat(file_path)
+    cached = csv_index_cache.get(file_path)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        index = load_csv_time_index(file_path, stat)
+        if index is None:
+            index = build_csv_time_index(file_path)
+            save_csv_time_index(file_path, stat, *index)
+        cached = csv_index_cache[file_path] = (stat.st_mtime_ns, stat.st_size, *index)
+    return cached[2:] if cached[2] is not None else None
+
+def build_csv_time_index(file_path):
+    """
+    Scan a CSV file for the period_start and byte offset of every row.
+
+    Returns:
+    tuple: (period_start as int64 nanoseconds, row byte offsets with the end of the
+        file appended), with both None if the rows are not sorted by period_start.
+    """
+    with open(file_path, 'rb') as file:
+        content = file.read()
+    line_ends = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == ord('\n'))
+    offsets = np.append(line_ends + 1, len(content)) if len(content) and content[-1:] != b'\n' else line_ends + 1
+    period_start = normalize_timestamps(pd.read_csv(io.BytesIO(content), usecols=['period_start']))['period_start']
+    timestamps = period_start.dt.tz_convert('UTC').values.astype(np.int64) if len(period_start) else np.array([], dtype=np.int64)
+    # offsets[0] is the start of the first data row, after the header line
+    offsets = offsets[:len(timestamps) + 1].astype(np.int64)
+
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        return None, None
+    return timestamps, offsets
+
+def read_time_slice(file_path, start=None, end=None, columns=None):
+    """
+    Read the rows of a data file with start <= period_start < end.
+
+    The files are sorted by period_start, so the rows are found by binary search
+    instead of filtering the whole file. Parquet files push the range down to the
+    row group statistics, Feather files are memory-mapped and sliced, and CSV files
+    only read the byte range of the rows, found with a persisted row offset index
+    (see get_csv_time_index).
+
+    Parameters:
+    file_path (str): Path to the data file.
+    start (Timestamp or str, optional): First period_start to include. Naive times are UTC+1.
+    end (Timestamp or str, optional): First period_start to leave out. Naive times are UTC+1.
+    columns (list, optional): Columns to read. All columns if omitted.
+
+    Returns:
+    DataFrame: The rows in the range, with the timestamp columns as datetime64.
+    """
+    import pyarrow as pa
+
+    storage_format = get_storage_format(file_path)
+    start_ns = None if start is None else to_utc_nanoseconds(start)
+    end_ns = None if end is None else to_utc_nanoseconds(end)
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['period_start']))
+
+    def select(df):
+        return df if columns is None else df[list(columns)]
+
+    def range_filters(to_value):
+        filters = []
+        if start_ns is not None:
+            filters.append(('period_start', '>=', to_value(start_ns)))
+        if end_ns is not None:
+            filters.append(('period_start', '<', to_value(end_ns)))
+        return filters or None
+
+    if storage_format == 'parquet':
+        # Arrow only compares timestamps of the same unit, so the bounds are given as nanosecond scalars
+        filters = range_filters(lambda value: pa.scalar(value, type=pa.timestamp('ns', tz='UTC')))
+        return read_df(file_path, columns=columns, filters=filters).reset_index(drop=True)
+
+    if storage_format == 'feather':
+        with pa.memory_map(file_path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            timestamps = table.column('period_start').cast(pa.int64()).to_numpy()
+            first = 0 if start_ns is None else np.searchsorted(timestamps, start_ns, side='left')
+            last = len(timestamps) if end_ns is None else np.searchsorted(timestamps, end_ns, side='left')
+            if read_columns is not None:
+                table = table.select(read_columns)
+            return select(normalize_timestamps(table.slice(first, max(last - first, 0)).to_pandas()))
+
+    index = get_csv_time_index(file_path)
+    if index is None:
+        # Not sorted by period_start, filter the whole file
+        filters = range_filters(lambda value: pd.Timestamp(value, tz='UTC'))
+        return read_df(file_path, columns=columns, filters=filters).reset_index(drop=True)
+
+    timestamps, offsets = index
+    first = 0 if start_ns is None else np.searchsorted(timestamps, start_ns, side='left')
+    last = len(timestamps) if end_ns is None else np.searchsorted(timestamps, end_ns, side='left')
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+        if last > first:
+            file.seek(offsets[first])
+            data = file.read(offsets[last] - offsets[first])
+        else:
+            data = b''
+    df = pd.read_csv(io.BytesIO(header + data), usecols=read_columns)
+    return select(normalize_timestamps(df))
+
+def read_tail(file_path, num_rows=1):
+    """
+    Read the last rows of a data file without reading the whole file.
+
+    CSV files are read backwards from the end until enough lines are found, and
+    Parquet files only read their last row group. Feather files are read in full.
+
+    Parameters:
+    file_path (str): Path to the data file.
+    num_rows (int): Number of rows to read.
+
+    Returns:
+    DataFrame: The last rows, with the timestamp columns as datetime64.
+    """
+    storage_format = get_storage_format(file_path)
+
+    if storage_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(file_path)
+        if parquet_file.num_row_groups == 0:
+            return parquet_file.schema_arrow.empty_table().to_pandas()
+        last_group = parquet_file.read_row_group(parquet_file.num_row_groups - 1).to_pandas()
+        return normalize_timestamps(last_group.tail(num_rows).reset_index(drop=True))
+
+    if storage_format == 'feather':
+        return read_df(file_path).tail(num_rows).reset_index(drop=True)
+
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+        data_start = file.tell()
+        end = position = file.seek(0, os.SEEK_END)
+        data = b''
+        # Read blocks from the end until num_rows complete lines are available
+        while position > data_start and data.count(b'\n') <= num_rows:
+            position = max(data_start, position - 64 * 1024)
+            file.seek(position)
+            data = file.read(end - position)
+
+    lines = data.splitlines()[-num_rows:] if data.strip() else []
+    df = pd.read_csv(io.BytesIO(header + b''.join(line + b'\n' for line in lines)))
+    return normalize_timestamps(df)
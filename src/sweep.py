@@ -0,0 +1,224 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import time
+import random
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from keras.callbacks import Callback, EarlyStopping
+import config
+from data_normalizer import FEATURE_COLUMNS
+from dataset import build_dataset, get_training_files
+from feature_store import load_features
+from model import create_model
+
+# Trial settings that are not create_model parameters
+TRAINING_PARAMETERS = ['batch_size', 'epochs']
+
+# Config settings that the worker processes take over from the process that starts the sweep:
+# every setting run_trial reads, directly or through build_dataset
+WORKER_CONFIG = ['DATA_PROCESSED_DIR', 'DATA_NORMALIZED_DIR', 'FEATURE_STORE_DIR', 'USE_FEATURE_STORE',
+                 'STORAGE_FORMAT', 'DATA_CACHE_MAX_BYTES', 'SHUFFLE_BUFFER_SIZE', 'WINDOW_CHUNK_SIZE',
+                 'INTERLEAVE_CYCLE_LENGTH', 'BATCH_SIZE', 'TRAINING_EPOCHS', 'VALIDATION_YEAR']
+
+def grid_trials(grid):
+    """
+    List every combination of the parameter values of a grid.
+
+    Parameters:
+    grid (dict): Values to try for each parameter, e.g. {'units': [32, 64], 'dropout_rate': [0.1, 0.2]}.
+
+    Returns:
+    list: One dict of parameters per trial.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def random_trials(grid, num_trials, seed=None):
+    """
+    Draw distinct random combinations of the parameter values of a grid.
+
+    Returns:
+    list: Up to num_trials dicts of parameters, fewer if the grid has fewer combinations.
+    """
+    trials = grid_trials(grid)
+    return random.Random(seed).sample(trials, min(num_trials, len(trials)))
+
+class PruneCallback(Callback):
+    """
+    Stop a trial whose validation MAE after an epoch is worse than that of the trials finished before it.
+
+    Parameters:
+    reference (list): The median validation MAE of the finished trials after every epoch.
+    min_epochs (int): Epochs a trial always runs before it can be pruned.
+    """
+
+    def __init__(self, reference, min_epochs=1):
+        super().__init__()
+        self.reference = reference
+        self.min_epochs = min_epochs
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_mae = (logs or {}).get('val_mae')
+        if val_mae is None or epoch + 1 < self.min_epochs or epoch >= len(self.reference):
+            return
+        if val_mae > self.reference[epoch]:
+            self.pruned = True
+            self.model.stop_training = True
+
+def init_worker(threads, config_values):
+    """
+    Set up a sweep worker: limit TensorFlow to its share of the CPU cores and take over the config.
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    for name, value in config_values.items():
+        setattr(config, name, value)
+
+def run_trial(trial, years, area_codes, validation_years, patience=5, prune_reference=None, min_epochs=3, seed=0):
+    """
+    Train and validate one model with the parameters of a trial.
+
+    Parameters:
+    trial (dict): create_model parameters (units, dropout_rate, num_outputs) and
+        optionally batch_size and epochs, config.BATCH_SIZE and config.TRAINING_EPOCHS by default.
+    years (list): Years to train on.
+    area_codes (list): Area codes to train on.
+    validation_years (list): Years to validate on.
+    patience (int): Epochs without a better validation MAE before the trial stops early.
+    prune_reference (list, optional): See PruneCallback. No pruning if omitted.
+    min_epochs (int): Epochs a trial always runs before it can be pruned.
+    seed (int): Seed for the weights and the shuffling.
+
+    Returns:
+    dict: The trial parameters with its status ('ok', 'pruned' or 'failed: <error>'),
+        epochs run, best validation MAE, validation MAE after every epoch and wall time.
+    """
+    start = time.perf_counter()
+    result = dict(trial)
+    try:
+        tf.keras.utils.set_random_seed(seed)
+        model_parameters = {name: value for name, value in trial.items() if name not in TRAINING_PARAMETERS}
+        horizon = model_parameters.get('num_outputs', 1)
+        batch_size = trial.get('batch_size', config.BATCH_SIZE)
+
+        model = create_model(input_shape=(24, len(FEATURE_COLUMNS) - 1), **model_parameters)
+        train_dataset = build_dataset(years, area_codes, horizon=horizon, batch_size=batch_size, seed=seed)
+        validation_dataset = build_dataset(validation_years, area_codes, horizon=horizon, batch_size=batch_size,
+                                           shuffle=False)
+        if train_dataset is None or validation_dataset is None:
+            raise ValueError("No training or validation data available")
+
+        prune = PruneCallback(prune_reference or [], min_epochs)
+        early_stopping = EarlyStopping(monitor='val_mae', patience=patience, restore_best_weights=True)
+        history = model.fit(train_dataset, epochs=trial.get('epochs', config.TRAINING_EPOCHS),
+                            validation_data=validation_dataset, callbacks=[early_stopping, prune], verbose=0)
+
+        val_mae = [float(value) for value in history.history['val_mae']]
+        result.update({'status': 'pruned' if prune.pruned else 'ok', 'epochs_run': len(val_mae),
+                       'val_mae': min(val_mae), 'val_mae_history': val_mae})
+    except Exception as e:
+        traceback.print_exc()
+        result.update({'status': f"failed: {e}", 'epochs_run': 0, 'val_mae': np.nan, 'val_mae_history': []})
+    result['wall_time'] = time.perf_counter() - start
+    return result
+
+def median_curve(results):
+    """
+    Get the median validation MAE after every epoch over the trials that ran to the end.
+    """
+    curves = [result['val_mae_history'] for result in results if result['status'] == 'ok']
+    reference = []
+    for epoch in range(max((len(curve) for curve in curves), default=0)):
+        values = [curve[epoch] for curve in curves if len(curve) > epoch]
+        reference.append(float(np.median(values)))
+    return reference
+
+def run_sweep(trials, years, area_codes, validation_years=None, workers=None, threads_per_worker=None,
+              patience=None, prune=True, min_epochs=3, results_path=None, seed=0):
+    """
+    Train a model for every trial in a process pool and collect a results table.
+
+    The normalized files are exported to the feature store first, so every worker maps
+    the same float32 arrays (see feature_store.load_features) and the windows are read
+    from the shared page cache instead of being parsed once per trial. Every worker is
+    limited to threads_per_worker TensorFlow threads, so the workers do not compete
+    for the same cores. Trials stop early when their validation MAE stops improving,
+    and with prune a trial is stopped as soon as it does worse after an epoch than the
+    median of the trials finished before it.
+
+    Parameters:
+    trials (list): Parameter dicts, see grid_trials, random_trials and run_trial.
+    years (list): Years to train on.
+    area_codes (list): Area codes to train on.
+    validation_years (list, optional): Years to validate on, [config.VALIDATION_YEAR] by default.
+    workers (int, optional): Number of trials trained at a time, config.SWEEP_WORKERS by default.
+    threads_per_worker (int, optional): TensorFlow threads of every worker, config.SWEEP_THREADS_PER_WORKER by default.
+    patience (int, optional): Epochs without improvement before a trial stops, config.SWEEP_PATIENCE by default.
+    prune (bool): Stop trials that do worse than the median of the finished trials.
+    min_epochs (int): Epochs a trial always runs before it can be pruned.
+    results_path (str, optional): CSV file to write the results table to, config.SWEEP_RESULTS_PATH by default.
+    seed (int): Seed of every trial.
+
+    Returns:
+    DataFrame: One row per trial with its parameters, status, epochs run, best validation MAE
+        and wall time, sorted by validation MAE. Empty, and not written, without trials.
+    """
+    if not trials:
+        return pd.DataFrame()
+
+    validation_years = validation_years or [config.VALIDATION_YEAR]
+    threads_per_worker = threads_per_worker or config.SWEEP_THREADS_PER_WORKER
+    workers = workers or config.SWEEP_WORKERS or max((os.cpu_count() or 1) // threads_per_worker, 1)
+    patience = config.SWEEP_PATIENCE if patience is None else patience
+    results_path = results_path or config.SWEEP_RESULTS_PATH
+
+    if config.USE_FEATURE_STORE:
+        for file_path in get_training_files(sorted(set(years) | set(validation_years)), area_codes):
+            load_features(file_path)
+
+    config_values = {name: getattr(config, name) for name in WORKER_CONFIG}
+    # Spawned workers start without the parent's TensorFlow threads, so their thread limits take effect
+    context = multiprocessing.get_context('spawn')
+    results, pending = [], list(trials)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(threads_per_worker, config_values)) as executor:
+        running = set()
+        while pending or running:
+            # Submit trials as workers free up, so later trials are pruned against more finished ones
+            while pending and len(running) < workers:
+                reference = median_curve(results) if prune else None
+                running.add(executor.submit(run_trial, pending.pop(0), years, area_codes, validation_years,
+                                            patience, reference, min_epochs, seed))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                parameters = ', '.join(f"{name}={value}" for name, value in result.items() if name in trials[0])
+                print(f"Trial {len(results)}/{len(trials)} ({parameters}): {result['status']}, "
+                      f"val MAE {result['val_mae']:.4f} after {result['epochs_run']} epochs in {result['wall_time']:.1f} s")
+
+    table = pd.DataFrame(results).drop(columns='val_mae_history').sort_values('val_mae', ignore_index=True)
+    os.makedirs(os.path.dirname(results_path) or '.', exist_ok=True)
+    table.to_csv(results_path, index=False)
+    return table
+
+if __name__ == "__main__":
+    input_years = input("Enter the years for training (comma-separated, e.g., 2017,2018,2019): ")
+    area_codes = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
+    num_trials = input("Number of random trials (leave empty for the full grid): ").strip()
+
+    years = [int(year.strip()) for year in input_years.split(',')]
+    grid = {'units': [32, 50, 64, 128], 'dropout_rate': [0.0, 0.1, 0.2, 0.3], 'batch_size': [32, 64, 128]}
+    trials = random_trials(grid, int(num_trials)) if num_trials else grid_trials(grid)
+    table = run_sweep(trials, years, area_codes)
+    print(table.to_string(index=False))
+    print(f"Results saved to {config.SWEEP_RESULTS_PATH}")
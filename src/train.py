@@ -5,9 +5,12 @@
 import numpy as np
 import pandas as pd
 import os
-from model import create_model
+from model import create_model, create_multi_zone_model, save_model
 from data_loader import load_data
-from config import MODEL_SAVE_PATH, TRAINING_EPOCHS, BATCH_SIZE
+from data_normalizer import FEATURE_COLUMNS
+from windowing import make_sequences
+from dataset import build_dataset, build_multi_zone_dataset
+from config import MODEL_SAVE_PATH, TRAINING_EPOCHS, VALIDATION_YEAR
 
 def get_unique_model_name():
     """
@@ -25,72 +28,82 @@ def get_unique_model_name():
     new_model_name = f"trained_model{model_count + 1}.keras"
     return os.path.join(model_dir, new_model_name)
 
-def prepare_sequences(data, look_back=24):
+def prepare_sequences(data, look_back=24, horizon=1, stride=1):
     """
-    Create sequences of 24-hour windows to predict the next hour.
+    Create sequences of 24-hour windows to predict the next hour(s).
+
+    The windows are float32 views of the data (see windowing.make_sequences), so
+    they are not copied look_back times.
 
     Args:
-    data (np.array): Array of input features.
+    data (np.array): Array of input features, with the price in the first column.
     look_back (int): Number of timesteps to look back for prediction.
+    horizon (int): Number of hours to predict after each window.
+    stride (int): Number of hours between the starts of consecutive windows.
 
     Returns:
     Tuple of (input_sequences, target_prices).
     """
-    input_sequences, target_prices = [], []
-    for i in range(len(data) - look_back):
-        # Extracting the sequence of features (all columns except the first one)
-        sequence = data[i:(i + look_back), 1:]
-        # Ensure sequence is numeric
-        sequence = sequence.astype(np.float32)
+    return make_sequences(data, look_back=look_back, horizon=horizon, stride=stride)
 
-        # Extracting the target price (last column)
-        target = data[i + look_back, 0]
-        # Ensure target is numeric
-        target = float(target)
+def train_model(years, area_code, horizon=1, multi_zone=False):
+    """
+    Train a model on the normalized data of the given years and area code(s) and save it.
 
-        input_sequences.append(sequence)
-        target_prices.append(target)
+    All years and area codes are streamed through one tf.data pipeline (see
+    dataset.build_dataset), so the model is fitted once on windows shuffled across
+    all of them instead of once per year.
 
-    return np.array(input_sequences), np.array(target_prices)
+    Args:
+    years (list): Years to train on.
+    area_code (str or list): Area code, or list of area codes, to train on.
+    horizon (int): Number of hours the model predicts at once. With 24 the model
+        forecasts a whole day in one call instead of hour by hour (see inference.forecast).
+    multi_zone (bool): Train one joint model on the hours of all area codes stacked
+        along a zone axis (see model.create_multi_zone_model), which predicts every
+        zone at once, instead of a model that sees one zone per window.
+    """
+    area_codes = [area_code] if isinstance(area_code, str) else list(area_code)
 
-def train_model(years, area_code):
     # Initialize model
-    num_features = 7  # Update this based on your actual number of features
-    num_outputs = 1  # For single regression target
-    model = create_model(input_shape=(24, num_features), num_outputs=num_outputs)
-    model.compile(optimizer='adam', loss='mse', metrics=['mae'])
-
-    # Train model for each specified year
-    for year in years:
-        print(f"Training on data from year: {year} and area code: {area_code}")
-        year_data = load_data(int(year), area_code, 'normalized')  # Load normalized data
-
-        if year_data is not None:
-            train_sequences, train_targets = prepare_sequences(year_data.values)
-            model.fit(train_sequences, train_targets, epochs=TRAINING_EPOCHS, batch_size=BATCH_SIZE)
-        else:
-            print(f"No data available for year {year} and area code {area_code}.")
-
-    # Validate model using data from 2022
-    validation_data = load_data(2022, area_code, 'normalized')
-    if isinstance(validation_data, pd.DataFrame):
-        validation_sequences, validation_targets = prepare_sequences(validation_data.values)
+    num_features = len(FEATURE_COLUMNS) - 1  # Every feature except the price
+    num_outputs = horizon  # One output per predicted hour
+    if multi_zone:
+        model = create_multi_zone_model(input_shape=(24, len(area_codes), num_features), num_outputs=num_outputs,
+                                        area_codes=area_codes)
+        make_dataset = build_multi_zone_dataset
     else:
+        model = create_model(input_shape=(24, num_features), num_outputs=num_outputs)
+        model.compile(optimizer='adam', loss='mse', metrics=['mae'])
+        make_dataset = build_dataset
+
+    print(f"Training on data from years: {', '.join(map(str, years))} and area code(s): {', '.join(area_codes)}")
+    train_dataset = make_dataset(years, area_codes, horizon=horizon)
+    if train_dataset is None:
+        print("No training data available.")
+        return
+
+    # Validate model using data from the validation year
+    validation_dataset = make_dataset([VALIDATION_YEAR], area_codes, horizon=horizon, shuffle=False)
+    if validation_dataset is None:
         print("No valid data for validation.")
 
+    model.fit(train_dataset, epochs=TRAINING_EPOCHS, validation_data=validation_dataset)
 
-    validation_results = model.evaluate(validation_sequences, validation_targets)
-    print(f"Validation Results - Loss: {validation_results[0]}, MAE: {validation_results[1]}")
+    if validation_dataset is not None:
+        validation_results = model.evaluate(validation_dataset)
+        print(f"Validation Results - Loss: {validation_results[0]}, MAE: {validation_results[1]}")
 
     # Get a unique name for the model
     unique_model_path = get_unique_model_name()
 
     # Save the trained model
-    model.save(unique_model_path)
+    save_model(model, unique_model_path)
     print(f"Model saved as: {unique_model_path}")
 
 if __name__ == "__main__":
     input_years = input("Enter the years for training (comma-separated, e.g., 2017,2018,2019): ")
-    input_area_code = input("Enter the area code (e.g., NO1): ")
+    input_area_code = [code.strip().upper() for code in input("Enter the area code(s) (e.g., 'NO1' or 'NO1,NO2'): ").split(',')]
     years = [int(year.strip()) for year in input_years.split(',')]
-    train_model(years, input_area_code)
\ No newline at end of file
+    multi_zone = len(input_area_code) > 1 and input("Train one joint model for all area codes? (yes/no): ").strip().lower() == 'yes'
+    train_model(years, input_area_code, multi_zone=multi_zone)
\ No newline at end of file
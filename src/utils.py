@@ -3,7 +3,7 @@
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
 import os
-from data_processing_tracker import update_file_metadata
+from storage import write_df
 
 def save_df_to_csv(df, file_path, overwrite=False):
     """
@@ -18,5 +18,14 @@ def save_df_to_csv(df, file_path, overwrite=False):
         df.to_csv(file_path, index=False)
     else:
         df.to_csv(file_path, mode='a', index=False, header=False)
-    
-    update_file_metadata(file_path, os.path.basename(file_path).split('_')[0])
\ No newline at end of file
+
+def save_df(df, file_path, overwrite=False):
+    """
+    Save a DataFrame in the storage format given by the file extension (see config.STORAGE_FORMAT).
+
+    Parameters:
+    df (DataFrame): The DataFrame to save.
+    file_path (str): The path to the file where the DataFrame should be saved.
+    overwrite (bool): If True, overwrite the existing file, otherwise append to it.
+    """
+    write_df(df, file_path, append=not overwrite)
\ No newline at end of file
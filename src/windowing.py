@@ -0,0 +1,84 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Column of the normalized data holding the price (see data_normalizer.FEATURE_COLUMNS)
+PRICE_COLUMN = 0
+
+def to_float32(data):
+    """
+    Cast data to a float32 array once, before any windows are made.
+
+    Arrays that already are float32 are returned as they are, without a copy.
+    """
+    return np.asarray(data, dtype=np.float32)
+
+def sliding_windows(data, window, stride=1):
+    """
+    Make overlapping windows over the first axis of an array, without copying.
+
+    Parameters:
+    data (np.array): Array of shape (timesteps, features).
+    window (int): Number of timesteps in each window.
+    stride (int): Number of timesteps between the starts of consecutive windows.
+
+    Returns:
+    np.array: Read-only view of shape (num_windows, window, features).
+    """
+    if len(data) < window:
+        return np.empty((0, window) + data.shape[1:], dtype=data.dtype)
+    # sliding_window_view puts the window axis last, move it back in front of the features
+    return np.moveaxis(sliding_window_view(data, window, axis=0), -1, 1)[::stride]
+
+def make_sequences(data, look_back=24, horizon=1, stride=1):
+    """
+    Create input windows and the prices that follow each of them.
+
+    Every window holds look_back timesteps of all columns except the price, and its
+    target is the price of the next horizon timesteps. Data of several zones stacked
+    along a zone axis is windowed the same way, with a target for every zone. The data is cast to float32
+    once and the windows and targets are views of that array, so they take no more
+    memory than the data itself.
+
+    Parameters:
+    data (np.array): Array of the normalized features of shape (timesteps, features), or
+        (timesteps, zones, features) for several zones, with the price in the first feature.
+    look_back (int): Number of timesteps in each input window.
+    horizon (int): Number of timesteps to predict after each window.
+    stride (int): Number of timesteps between the starts of consecutive windows.
+
+    Returns:
+    Tuple of (input_sequences, target_prices). The targets have shape (num_windows,) for a
+    horizon of 1 and (num_windows, horizon) otherwise, with a zone axis after num_windows
+    for several zones.
+    """
+    data = to_float32(data)
+    num_windows = max(len(data) - look_back - horizon + 1, 0)
+
+    input_sequences = sliding_windows(data[:look_back + num_windows - 1, ..., PRICE_COLUMN + 1:], look_back, stride)
+    target_prices = sliding_windows(data[look_back:, ..., PRICE_COLUMN], horizon, stride)[:len(input_sequences)]
+
+    # Put the hours last, after the zone axis if there is one
+    target_prices = np.moveaxis(target_prices, 1, -1)
+    if horizon == 1:
+        target_prices = target_prices[..., 0]
+    return input_sequences, target_prices
+
+def make_prediction_windows(data, look_back=24, stride=1):
+    """
+    Create the input windows for prediction, including the window that ends with the last timestep.
+
+    Parameters:
+    data (np.array): Array of the normalized features, with the price in the first feature,
+        and optionally a zone axis before the features (see make_sequences).
+    look_back (int): Number of timesteps in each input window.
+    stride (int): Number of timesteps between the starts of consecutive windows.
+
+    Returns:
+    np.array: Read-only float32 view of shape (num_windows, look_back, features), or
+        (num_windows, look_back, zones, features) for several zones.
+    """
+    return sliding_windows(to_float32(data)[..., PRICE_COLUMN + 1:], look_back, stride)
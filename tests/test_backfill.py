@@ -0,0 +1,57 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+
+os.environ.setdefault('ENTSOE_API_KEY', 'test-key')
+
+import pandas as pd
+import config
+from backfill import plan_backfill, get_job_key
+from tests.test_pipeline import write_day_ahead_xml
+
+def test_plan_backfill_fetches_only_missing_days(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed') + '/')
+    # Fetched before the prices of 2023-01-10 were published, so the name claims a day without data
+    raw_file = write_day_ahead_xml(str(tmp_path / 'raw' / 'NO1'), 'NO1', '20230101', '20230109')
+    os.replace(raw_file, tmp_path / 'raw' / 'NO1' / 'NO1_2023_01_01_to_2023_01_10_day_ahead_prices.xml')
+
+    # Preprocessed rows cover 2023-01-12 to 2023-01-20 apart from one hour on 2023-01-16
+    preprocessed_folder = tmp_path / 'preprocessed' / 'NO1'
+    preprocessed_folder.mkdir(parents=True)
+    period_start = pd.date_range('2023-01-12', periods=9 * 24, freq='h', tz='+01:00').delete(4 * 24 + 5)
+    pd.DataFrame({'price': 1.0, 'period_start': period_start, 'period_end': period_start + pd.Timedelta(hours=1)}) \
+        .to_csv(preprocessed_folder / 'NO1_2023.csv', index=False)
+
+    jobs = plan_backfill('20230101', '20230120', ['NO1'])
+
+    assert [(area, start.strftime('%Y%m%d'), end.strftime('%Y%m%d')) for area, start, end in jobs] == [
+        ('NO1', '20230110', '20230111'),
+        ('NO1', '20230116', '20230116'),
+    ]
+
+def test_plan_backfill_skips_checkpointed_windows_and_splits_long_gaps(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed') + '/')
+
+    jobs = plan_backfill('20200101', '20211231', ['NO1', 'NO2'])
+    assert len(jobs) == 4
+    assert all((end - start).days < 370 for _, start, end in jobs)
+
+    checkpoint = {'jobs': {get_job_key(jobs[0]): {'status': 'done'}, get_job_key(jobs[1]): {'status': 'failed'}}}
+    assert plan_backfill('20200101', '20211231', ['NO1', 'NO2'], checkpoint) == jobs[1:]
+
+def test_windows_without_data_are_retried_until_final(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed') + '/')
+    jobs = plan_backfill('20230101', '20230110', ['NO1'])
+
+    def checked(timestamp):
+        return {'jobs': {get_job_key(jobs[0]): {'status': 'empty', 'checked': timestamp}}}
+
+    # Checked the day after the window, when its last day may not have been published yet
+    assert plan_backfill('20230101', '20230110', ['NO1'], checked('2023-01-11T12:00:00+00:00')) == jobs
+    assert plan_backfill('20230101', '20230110', ['NO1'], checked('2023-01-14T00:00:00+00:00')) == []
+    assert plan_backfill('20230101', '20230110', ['NO1'], {'jobs': {get_job_key(jobs[0]): {'status': 'empty'}}}) == jobs
@@ -0,0 +1,120 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import config
+from data_cleaner import clean_data, clean_file
+from data_normalizer import normalize_data, normalize_file
+from data_processing_tracker import update_file_metadata, get_file_metadata
+from instrumentation import read_report
+from scaler_registry import get_scaler
+from storage import read_df, write_df, stage_file_path
+
+@pytest.mark.parametrize('storage_format', ['csv', 'parquet', 'feather'])
+def test_chunked_clean_and_normalize_match_whole_file(tmp_path, monkeypatch, storage_format):
+    monkeypatch.setattr(config, 'STORAGE_FORMAT', storage_format)
+    monkeypatch.setattr(config, 'DATA_CLEANED_DIR', str(tmp_path / 'cleaned') + '/')
+    monkeypatch.setattr(config, 'SCALER_REGISTRY_PATH', str(tmp_path / 'scalers.json'))
+    monkeypatch.setattr(config, 'RUN_REPORT_PATH', str(tmp_path / 'report.jsonl'))
+    monkeypatch.setattr(config, 'GAP_REPORT_DIR', str(tmp_path / 'gaps') + '/')
+    for stage in ('preprocessed', 'cleaned', 'normalized'):
+        (tmp_path / stage / 'NO1').mkdir(parents=True)
+
+    period_start = pd.date_range('2023-01-01', periods=40, freq='h', tz='+01:00')
+    df = pd.DataFrame({'price': np.arange(40.0), 'period_start': period_start, 'period_end': period_start + pd.Timedelta(hours=1)})
+    # Missing prices at the start of the second and third chunk, and a duplicate across the third chunk boundary
+    df.loc[[8, 9, 16], 'price'] = np.nan
+    df = pd.concat([df.iloc[:16], df.iloc[15:]], ignore_index=True)
+
+    preprocessed_file = stage_file_path(str(tmp_path / 'preprocessed'), 'NO1', 2023)
+    write_df(df, preprocessed_file)
+    update_file_metadata(preprocessed_file, 'preprocessed', df=df)
+
+    clean_file(preprocessed_file, str(tmp_path / 'cleaned' / 'NO1'), chunk_size=8)
+    cleaned_file = stage_file_path(config.DATA_CLEANED_DIR, 'NO1', 2023)
+    cleaned = read_df(cleaned_file)
+    expected_cleaned = clean_data(df.copy()).reset_index(drop=True)
+    pd.testing.assert_frame_equal(cleaned, expected_cleaned)
+    assert get_file_metadata(cleaned_file)['rows'] == 40
+
+    normalize_file(cleaned_file, str(tmp_path / 'normalized' / 'NO1'), chunk_size=8)
+    normalized = read_df(stage_file_path(str(tmp_path / 'normalized'), 'NO1', 2023))
+    expected_normalized = normalize_data(expected_cleaned.copy(), get_scaler('NO1')).reset_index(drop=True)
+    pd.testing.assert_frame_equal(normalized, expected_normalized, check_dtype=False)
+
+    clean_report, normalize_report = read_report(config.RUN_REPORT_PATH)
+    assert (clean_report['stage'], clean_report['area_code'], clean_report['year']) == ('clean', 'NO1', 2023)
+    assert (clean_report['rows_in'], clean_report['rows_out']) == (41, 40)
+    assert clean_report['bytes_read'] == os.path.getsize(preprocessed_file)
+    assert clean_report['bytes_written'] == os.path.getsize(cleaned_file)
+    assert normalize_report['stage'] == 'normalize' and normalize_report['rows_out'] == 40
+
+def hourly_frame(hours, start='2023-03-25', minutes=60):
+    period_start = pd.date_range(start, periods=max(hours) + 1, freq=f'{minutes}min', tz='+01:00')[hours]
+    return pd.DataFrame({'price': np.array(hours, dtype=float), 'currency': 'EUR', 'period_start': period_start,
+                         'period_end': period_start + pd.Timedelta(minutes=minutes)})
+
+def test_missing_hours_become_filled_rows_and_are_reported():
+    # Hours 3 and 6-8 are missing and hour 10 has no price
+    df = hourly_frame([0, 1, 2, 4, 5, 9, 10, 11])
+    df.loc[df['period_start'].dt.hour == 10, 'price'] = np.nan
+
+    gaps = []
+    cleaned = clean_data(df, gap_report=gaps)
+    assert (cleaned['period_start'].diff().dropna() == pd.Timedelta(hours=1)).all() and len(cleaned) == 12
+    assert cleaned['price'].tolist() == [0, 1, 2, 2, 4, 5, 5, 5, 5, 9, 9, 11]
+    assert cleaned['currency'].dtype == 'category' and cleaned['currency'].notna().all()
+    assert [(gap['gap_start'], gap['slots'], gap['filled']) for gap in gaps] == [
+        ('2023-03-25T03:00:00+01:00', 1, True), ('2023-03-25T06:00:00+01:00', 3, True), ('2023-03-25T10:00:00+01:00', 1, True)]
+
+    interpolated = clean_data(df, fill_policy='interpolate')
+    assert interpolated['price'].tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+
+    # Gaps longer than the limit are left out, like every gap with the drop policy
+    gaps = []
+    limited = clean_data(df, fill_limit=2, gap_report=gaps)
+    assert limited['period_start'].dt.hour.tolist() == [0, 1, 2, 3, 4, 5, 9, 10, 11]
+    assert [gap['filled'] for gap in gaps] == [True, False, True]
+    assert clean_data(df, fill_policy='drop')['period_start'].dt.hour.tolist() == [0, 1, 2, 4, 5, 9, 11]
+
+    with pytest.raises(ValueError):
+        clean_data(df, fill_policy='mean')
+
+def test_resolution_changes_average_and_repeat_prices():
+    # Four 15-minute prices per hour are averaged into hourly slots
+    quarters = hourly_frame(list(range(8)), minutes=15)
+    hourly = clean_data(quarters, resolution=pd.Timedelta(hours=1))
+    assert hourly['price'].tolist() == [1.5, 5.5]
+    assert (hourly['period_end'] - hourly['period_start'] == pd.Timedelta(hours=1)).all()
+
+    # Hourly prices hold for every quarter of the hour
+    quarterly = clean_data(hourly_frame([0, 1]), resolution=pd.Timedelta(minutes=15))
+    assert quarterly['price'].tolist() == [0] * 4 + [1] * 4
+    assert quarterly['period_start'].iloc[-1] == pd.Timestamp('2023-03-25 01:45', tz='+01:00')
+
+def test_chunked_clean_downsamples_across_chunks_and_writes_gap_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_CLEANED_DIR', str(tmp_path / 'cleaned') + '/')
+    monkeypatch.setattr(config, 'GAP_REPORT_DIR', str(tmp_path / 'gaps') + '/')
+    (tmp_path / 'preprocessed' / 'NO1').mkdir(parents=True)
+    (tmp_path / 'cleaned' / 'NO1').mkdir(parents=True)
+
+    # 15-minute prices of 12 hours, with hours 5 and 6 missing
+    df = hourly_frame([quarter for quarter in range(48) if not 20 <= quarter < 28], start='2023-01-01', minutes=15)
+    preprocessed_file = stage_file_path(str(tmp_path / 'preprocessed'), 'NO1', 2023)
+    write_df(df, preprocessed_file)
+    update_file_metadata(preprocessed_file, 'preprocessed', df=df)
+
+    # Chunks of 7 rows split the hours, whose quarters must still be averaged together
+    clean_file(preprocessed_file, str(tmp_path / 'cleaned' / 'NO1'), chunk_size=7)
+    cleaned_file = stage_file_path(config.DATA_CLEANED_DIR, 'NO1', 2023)
+    expected = clean_data(df.copy()).reset_index(drop=True)
+    pd.testing.assert_frame_equal(read_df(cleaned_file), expected)
+    assert len(expected) == 12
+
+    report = pd.read_csv(tmp_path / 'gaps' / 'NO1' / 'NO1_2023_gaps.csv')
+    assert report[['gap_start', 'slots', 'filled']].values.tolist() == [['2023-01-01T05:00:00+01:00', 2, True]]
+    assert get_file_metadata(cleaned_file)['missing_slots'] == 2
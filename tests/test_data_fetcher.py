@@ -0,0 +1,113 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+
+os.environ.setdefault('ENTSOE_API_KEY', 'test-key')
+
+import config
+import data_fetcher
+
+PRICES_XML = b'<?xml version="1.0" encoding="UTF-8"?><Publication_MarketDocument></Publication_MarketDocument>'
+NO_DATA_XML = (b'<?xml version="1.0" encoding="UTF-8"?><Acknowledgement_MarketDocument><Reason><code>999</code>'
+               b'<text>No matching data found for Data item</text></Reason></Acknowledgement_MarketDocument>')
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like the ENTSO-E API: the first request for every NO1 window is rate limited,
+    NO2 has no data and NO3 is always unavailable.
+    """
+    def do_GET(self):
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        with self.server.lock:
+            self.server.calls.append(params)
+            attempt = Counter((call['in_Domain'], call['periodStart']) for call in self.server.calls)[(params['in_Domain'], params['periodStart'])]
+
+        if params['in_Domain'] == data_fetcher.area_codes['NO3']:
+            status, body = 503, b''
+        elif params['in_Domain'] == data_fetcher.area_codes['NO2']:
+            status, body = 200, NO_DATA_XML
+        elif attempt == 1:
+            status, body = 429, b''
+        else:
+            status, body = 200, PRICES_XML
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.calls = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_fetch_data_concurrent_retries_and_streams_to_disk(stub_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw'))
+    base_url = f"http://127.0.0.1:{stub_server.server_address[1]}/api"
+
+    results, failures = data_fetcher.fetch_data_concurrent(
+        '20230101', '20240110', ['NO1', 'NO2', 'NO3'], max_workers=4, requests_per_minute=60000,
+        base_url=base_url, max_retries=2, backoff_seconds=0.01)
+
+    # 370-day windows, the next one starting the day after the previous window's last day
+    no1_files = sorted(path for (area, _, _), path in results.items() if area == 'NO1')
+    assert [os.path.basename(path) for path in no1_files] == [
+        'NO1_2023_01_01_to_2024_01_05_day_ahead_prices.xml',
+        'NO1_2024_01_06_to_2024_01_10_day_ahead_prices.xml',
+    ]
+    assert all(open(path, 'rb').read() == PRICES_XML for path in no1_files)
+    assert [path for (area, _, _), path in results.items() if area == 'NO2'] == [None, None]
+    assert sorted(area for area, _, _ in failures) == ['NO3', 'NO3']
+    assert not list((tmp_path / 'raw').glob('*/*.part'))
+
+    first_call = min((call for call in stub_server.calls if call['in_Domain'] == data_fetcher.area_codes['NO1']),
+                     key=lambda call: call['periodStart'])
+    assert first_call['documentType'] == 'A44'
+    assert first_call['periodStart'] == '202212312300'
+    # Windows meet at midnight UTC+1, without overlapping hours
+    no1_calls = {(call['periodStart'], call['periodEnd']) for call in stub_server.calls
+                 if call['in_Domain'] == data_fetcher.area_codes['NO1']}
+    assert sorted(no1_calls) == [('202212312300', '202401052300'), ('202401052300', '202401102300')]
+
+def test_split_date_range_windows_are_whole_days_without_overlap():
+    windows = data_fetcher.split_date_range('20230101', '20230110', max_days_per_request=4)
+    assert [(start.strftime('%Y%m%d'), end.strftime('%Y%m%d')) for start, end in windows] == [
+        ('20230101', '20230104'), ('20230105', '20230108'), ('20230109', '20230110')]
+    assert len(data_fetcher.split_date_range('20230101', '20230101')) == 1
+
+def test_rate_limiter_spaces_requests():
+    rate_limiter = data_fetcher.RateLimiter(requests_per_minute=1200)  # One request every 50 ms
+
+    start = data_fetcher.time.monotonic()
+    for _ in range(5):
+        rate_limiter.wait()
+
+    assert data_fetcher.time.monotonic() - start >= 0.2
+
+def test_api_key_and_client_are_set_up_on_first_use(monkeypatch):
+    monkeypatch.setattr(data_fetcher, 'api_key', None)
+    monkeypatch.setattr(data_fetcher, 'client', None)
+    monkeypatch.setattr(data_fetcher, 'load_dotenv', lambda: None)
+    monkeypatch.delenv('ENTSOE_API_KEY', raising=False)
+    with pytest.raises(ValueError):
+        data_fetcher.get_api_key()
+
+    monkeypatch.setenv('ENTSOE_API_KEY', 'first-use-key')
+    client = data_fetcher.get_client()
+    assert data_fetcher.get_client() is client and client.api_key == 'first-use-key'
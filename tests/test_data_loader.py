@@ -0,0 +1,91 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+import pandas as pd
+import pytest
+import config
+import data_loader
+import storage
+from data_loader import load_range, load_data, cache_stats
+from data_processing_tracker import update_file_metadata
+from storage import write_df, stage_file_path, read_time_slice
+
+def write_stage_year(tmp_path, area_code, year, hours=None):
+    period_start = pd.date_range(f'{year}-01-01', f'{year}-12-31 23:00', freq='h', tz='+01:00')[:hours]
+    df = pd.DataFrame({'price': np.arange(len(period_start), dtype=np.float32) + year, 'period_start': period_start,
+                       'period_end': period_start + pd.Timedelta(hours=1)})
+    file_path = stage_file_path(str(tmp_path / 'cleaned'), area_code, year)
+    (tmp_path / 'cleaned' / area_code).mkdir(parents=True, exist_ok=True)
+    write_df(df, file_path)
+    update_file_metadata(file_path, 'cleaned', df=df)
+    return df
+
+@pytest.mark.parametrize('storage_format', ['csv', 'parquet', 'feather'])
+def test_load_range_slices_across_years_and_zones(tmp_path, monkeypatch, storage_format):
+    monkeypatch.setattr(config, 'STORAGE_FORMAT', storage_format)
+    monkeypatch.setattr(config, 'DATA_PROCESSED_DIR', str(tmp_path) + '/')
+    frames = {(area_code, year): write_stage_year(tmp_path, area_code, year)
+              for area_code in ('NO1', 'NO2') for year in (2021, 2022, 2023)}
+
+    # A 24-hour look-back across New Year
+    df = load_range('NO1', '2022-12-31 12:00', '2023-01-01 12:00', columns=['price', 'period_start'], stage='cleaned')
+    expected = pd.concat([frames[('NO1', 2022)].iloc[-12:], frames[('NO1', 2023)].iloc[:12]], ignore_index=True)
+    pd.testing.assert_frame_equal(df, expected[['price', 'period_start']])
+
+    df = load_range(['NO1', 'NO2'], pd.Timestamp('2022-06-01', tz='UTC'), pd.Timestamp('2022-06-02', tz='UTC'), stage='cleaned')
+    assert df['area_code'].tolist() == ['NO1'] * 24 + ['NO2'] * 24
+    assert df['period_start'].iloc[0] == pd.Timestamp('2022-06-01 01:00', tz='+01:00')
+
+    assert load_range('NO1', '20300101', '20300102', stage='cleaned').empty
+    assert len(load_data(2022, 'NO2', 'cleaned', specific_date='20220315')) == 24
+
+def test_csv_time_index_is_persisted_until_the_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'STORAGE_FORMAT', 'csv')
+    df = write_stage_year(tmp_path, 'NO1', 2022, hours=48)
+    file_path = stage_file_path(str(tmp_path / 'cleaned'), 'NO1', 2022)
+    builds = []
+    build_csv_time_index = storage.build_csv_time_index
+    monkeypatch.setattr(storage, 'build_csv_time_index', lambda path: builds.append(path) or build_csv_time_index(path))
+
+    read_time_slice(file_path, '2022-01-01 10:00', '2022-01-01 12:00')
+    # A fresh process only has the index file next to the CSV file
+    storage.csv_index_cache.clear()
+    pd.testing.assert_frame_equal(read_time_slice(file_path, '2022-01-01 10:00', '2022-01-01 12:00'), df.iloc[10:12].reset_index(drop=True))
+    assert len(builds) == 1
+
+    write_df(df.iloc[:1].assign(period_start=df['period_start'].iloc[-1] + pd.Timedelta(hours=1)), file_path, append=True)
+    storage.csv_index_cache.clear()
+    assert len(read_time_slice(file_path, '2022-01-02 23:00')) == 2
+    assert len(builds) == 2
+
+def test_frame_cache_reads_each_file_once_until_it_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'STORAGE_FORMAT', 'parquet')
+    monkeypatch.setattr(config, 'DATA_PROCESSED_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(data_loader, 'frame_cache', data_loader.FrameCache())
+    df = write_stage_year(tmp_path, 'NO1', 2022, hours=48)
+
+    first = load_data(2022, 'NO1', 'cleaned')
+    first['price'] = 0.0  # Callers get a copy
+    second = load_data(2022, 'NO1', 'cleaned')
+    pd.testing.assert_frame_equal(second, df)
+    assert cache_stats()['hits'] == 1 and cache_stats()['misses'] == 1
+
+    # Rewriting the file drops its cached frames
+    df = write_stage_year(tmp_path, 'NO1', 2022, hours=24)
+    pd.testing.assert_frame_equal(load_data(2022, 'NO1', 'cleaned'), df)
+    assert cache_stats()['misses'] == 2 and cache_stats()['entries'] == 1
+
+def test_frame_cache_evicts_least_recently_used():
+    frames = [pd.DataFrame({'price': np.zeros(1000)}) for _ in range(3)]
+    size = int(frames[0].memory_usage(index=True, deep=True).sum())
+    cache = data_loader.FrameCache(max_bytes=2 * size)
+    cache.put(('a',), 1, frames[0])
+    cache.put(('b',), 1, frames[1])
+    assert cache.get(('a',), 1) is frames[0]
+    cache.put(('c',), 1, frames[2])
+
+    assert cache.get(('b',), 1) is None
+    assert cache.get(('a',), 1) is frames[0] and cache.get(('c',), 1) is frames[2]
+    assert cache.stats()['bytes'] == 2 * size
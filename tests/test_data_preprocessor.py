@@ -2,3 +2,89 @@
 # This file is part of NEPP which is released under GNU GPLv3.
 # See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
 
+import os
+import sys
+import pandas as pd
+from data_preprocessor import parse_xml_to_df
+from schema import apply_schema
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from legacy_parser import parse_xml_to_df_legacy
+
+NAMESPACE = 'urn:iec62325.351:tc57wg16:451-3:publicationdocument:7:0'
+
+def write_xml(tmp_path, periods, file_name='NO1_2023_12_01_to_2023_12_01_day_ahead_prices.xml'):
+    """
+    Write a minimal day-ahead document with one TimeSeries per (start, resolution, prices) period.
+    """
+    series = []
+    for number, (start, resolution, prices) in enumerate(periods, start=1):
+        points = ''.join(
+            f'<Point><position>{position}</position><price.amount>{price}</price.amount></Point>'
+            for position, price in enumerate(prices, start=1)
+        )
+        series.append(
+            f'<TimeSeries><mRID>{number}</mRID><businessType>A62</businessType>'
+            '<in_Domain.mRID codingScheme="A01">10YNO-1--------2</in_Domain.mRID>'
+            '<out_Domain.mRID codingScheme="A01">10YNO-1--------2</out_Domain.mRID>'
+            '<currency_Unit.name>EUR</currency_Unit.name><curveType>A01</curveType>'
+            f'<Period><timeInterval><start>{start}</start><end>{start}</end></timeInterval>'
+            f'<resolution>{resolution}</resolution>{points}</Period></TimeSeries>'
+        )
+    xml_file = tmp_path / file_name
+    xml_file.write_text(
+        f'<?xml version="1.0" encoding="UTF-8"?><Publication_MarketDocument xmlns="{NAMESPACE}">'
+        '<period.timeInterval><start>2023-11-29T23:00Z</start><end>2023-12-02T23:00Z</end></period.timeInterval>'
+        + ''.join(series) + '</Publication_MarketDocument>'
+    )
+    return str(xml_file)
+
+def test_parse_xml_to_df_matches_legacy_parser(tmp_path):
+    # The first and last periods lie partly outside the date range in the file name
+    xml_file = write_xml(tmp_path, [
+        ('2023-11-30T22:00Z', 'PT60M', [10.5, 11.0, 12.25]),
+        ('2023-11-30T23:00Z', 'PT60M', [float(i) for i in range(24)]),
+        ('2023-12-01T22:00Z', 'PT60M', [1.0, 2.0, 3.0]),
+    ])
+
+    df = parse_xml_to_df(xml_file)
+
+    # The periods are hourly, where the legacy parser's fixed one-hour period_end is right
+    pd.testing.assert_frame_equal(df, apply_schema(parse_xml_to_df_legacy(xml_file)))
+    assert len(df) == 27
+    assert df['period_start'].iloc[0] == pd.Timestamp('2023-12-01T00:00+01:00')
+
+def test_parse_xml_to_df_uses_period_resolution(tmp_path):
+    xml_file = write_xml(tmp_path, [('2023-11-30T23:00Z', 'PT15M', [1.0, 2.0, 3.0, 4.0])])
+
+    df = parse_xml_to_df(xml_file)
+
+    assert list(df['period_start'].dt.minute) == [0, 15, 30, 45]
+    assert (df['period_end'] - df['period_start']).eq(pd.Timedelta(minutes=15)).all()
+
+def test_parse_xml_to_df_without_points_returns_typed_empty_frame(tmp_path):
+    xml_file = write_xml(tmp_path, [])
+
+    df = parse_xml_to_df(xml_file)
+
+    assert df.empty
+    assert list(df.columns) == ['price', 'business_type', 'in_domain', 'out_domain', 'currency', 'period_start', 'period_end']
+    assert isinstance(df['period_start'].dtype, pd.DatetimeTZDtype)
+
+def test_process_files_parallel_merges_each_partition_once(tmp_path, monkeypatch):
+    import config
+    from data_preprocessor import process_files
+
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed'))
+    # Two overlapping files spanning New Year, the second repeats 2023-12-31 with other prices
+    first = write_xml(tmp_path, [('2023-12-30T23:00Z', 'PT60M', [1.0] * 24)],
+                      'NO1_2023_12_31_to_2023_12_31_day_ahead_prices.xml')
+    second = write_xml(tmp_path, [('2023-12-30T23:00Z', 'PT60M', [2.0] * 48)],
+                       'NO1_2023_12_31_to_2024_01_01_day_ahead_prices.xml')
+
+    process_files([first, second], workers=2)
+
+    df_2023 = pd.read_csv(tmp_path / 'preprocessed' / 'NO1' / 'NO1_2023.csv')
+    df_2024 = pd.read_csv(tmp_path / 'preprocessed' / 'NO1' / 'NO1_2024.csv')
+    assert len(df_2023) == 24 and (df_2023['price'] == 1.0).all()
+    assert len(df_2024) == 24 and df_2024['period_start'].is_monotonic_increasing
@@ -0,0 +1,47 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import pandas as pd
+from data_processing_tracker import check_processing_stage, get_file_metadata, update_file_metadata
+
+def test_update_file_metadata_records_stage_and_provenance(tmp_path):
+    file_path = tmp_path / 'cleaned' / 'NO1' / 'NO1_2023.csv'
+    file_path.parent.mkdir(parents=True)
+    df = pd.DataFrame({'price': [1.0, 2.0], 'period_start': pd.to_datetime(['2023-01-01T00:00+01:00', '2023-01-01T01:00+01:00'])})
+    df.to_csv(file_path, index=False)
+
+    update_file_metadata(str(file_path), 'cleaned', df=df, source_files=['data/processed/preprocessed/NO1/NO1_2023.csv'])
+
+    entry = get_file_metadata(str(file_path))
+    assert entry['stages'] == ['cleaned']
+    assert entry['rows'] == 2
+    assert entry['end'] == '2023-01-01T01:00:00+01:00'
+    assert entry['source_files'] == ['NO1_2023.csv']
+    assert entry['content_hash'].startswith('sha256:')
+    assert check_processing_stage(str(file_path), 'cleaned')
+    assert not check_processing_stage(str(file_path), 'normalized')
+    # The data file itself is left untouched
+    assert file_path.read_text().splitlines()[0] == 'price,period_start'
+
+def test_legacy_in_file_tags_are_migrated_once(tmp_path):
+    folder = tmp_path / 'cleaned' / 'NO1'
+    folder.mkdir(parents=True)
+    # Header with the tags the old update_file_metadata appended to it
+    (folder / 'NO1_2022.csv').write_text(
+        'price,period_start,preprocessed,NO1,cleaned\n'
+        '1.0,2022-01-01 00:00:00+01:00,\n'
+    )
+
+    assert check_processing_stage(str(folder / 'NO1_2022.csv'), 'cleaned')
+    assert check_processing_stage(str(folder / 'NO1_2022.csv'), 'preprocessed')
+    assert (folder / 'NO1_2022.csv').read_text().splitlines()[0] == 'price,period_start'
+    assert (folder / 'manifest.json').exists()
+
+def test_migrated_parquet_files_get_the_stage_of_their_directory(tmp_path):
+    folder = tmp_path / 'normalized' / 'NO1'
+    folder.mkdir(parents=True)
+    pd.DataFrame({'price': [0.5], 'period_start': pd.to_datetime(['2022-01-01T00:00+01:00'])}).to_parquet(folder / 'NO1_2022.parquet')
+
+    assert check_processing_stage(str(folder / 'NO1_2022.parquet'), 'normalized')
+    assert get_file_metadata(str(folder / 'NO1_2022.parquet'))['stages'] == ['normalized']
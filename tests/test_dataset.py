@@ -0,0 +1,67 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+import pandas as pd
+import config
+from data_normalizer import FEATURE_COLUMNS
+from dataset import build_dataset, build_multi_zone_dataset
+from windowing import make_sequences
+
+def write_normalized_file(folder, area_code, year, offset):
+    folder.mkdir(parents=True, exist_ok=True)
+    data = np.arange(100 * len(FEATURE_COLUMNS), dtype=float).reshape(100, -1) + offset
+    period_start = pd.date_range(f'{year}-01-01', periods=100, freq='h', tz='+01:00')
+    # The calendar columns hold real dates, they are read back as small ints (see schema.SCHEMA)
+    data[:, -3:] = np.column_stack([period_start.day, period_start.month, period_start.year])
+    df = pd.DataFrame(data, columns=FEATURE_COLUMNS)
+    df['period_start'] = period_start
+    df.to_csv(folder / f'{area_code}_{year}.csv', index=False)
+    return data
+
+def test_build_dataset_streams_all_windows_of_all_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(config, 'FEATURE_STORE_DIR', str(tmp_path / 'features') + '/')
+    # Fewer files read at a time than there are files
+    monkeypatch.setattr(config, 'INTERLEAVE_CYCLE_LENGTH', 2)
+    files = [write_normalized_file(tmp_path / area_code, area_code, year, offset)
+             for offset, (area_code, year) in enumerate([('NO1', 2021), ('NO1', 2022), ('NO2', 2021)])]
+
+    dataset = build_dataset([2021, 2022, 2023], ['NO1', 'NO2'], horizon=24, batch_size=16, chunk_size=10, seed=0)
+    batches = list(dataset.as_numpy_iterator())
+    inputs = np.concatenate([batch_inputs for batch_inputs, _ in batches])
+    targets = np.concatenate([batch_targets for _, batch_targets in batches])
+
+    expected_inputs, expected_targets = zip(*(make_sequences(data, horizon=24) for data in files))
+    expected_inputs, expected_targets = np.concatenate(expected_inputs), np.concatenate(expected_targets)
+
+    # Every window appears exactly once, and windows of different files are mixed
+    assert inputs.shape == expected_inputs.shape and targets.shape == expected_targets.shape
+    order = np.lexsort(inputs.reshape(len(inputs), -1).T)
+    expected_order = np.lexsort(expected_inputs.reshape(len(expected_inputs), -1).T)
+    np.testing.assert_array_equal(inputs[order], expected_inputs[expected_order])
+    np.testing.assert_array_equal(targets[order], expected_targets[expected_order])
+    assert not np.array_equal(inputs, expected_inputs)
+
+    assert build_dataset([2019], ['NO1']) is None
+
+def test_build_multi_zone_dataset_aligns_zones_by_hour(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(config, 'FEATURE_STORE_DIR', str(tmp_path / 'features') + '/')
+    no1 = write_normalized_file(tmp_path / 'NO1', 'NO1', 2022, offset=0)
+    no2 = write_normalized_file(tmp_path / 'NO2', 'NO2', 2022, offset=1000)
+    # NO2 misses its first hour, so the zones are aligned from the second hour
+    df = pd.read_csv(tmp_path / 'NO2' / 'NO2_2022.csv').iloc[1:]
+    df.to_csv(tmp_path / 'NO2' / 'NO2_2022.csv', index=False)
+    write_normalized_file(tmp_path / 'NO1', 'NO1', 2021, offset=0)
+
+    dataset = build_multi_zone_dataset([2021, 2022], ['NO1', 'NO2'], horizon=24, batch_size=16, shuffle=False)
+    inputs = np.concatenate([batch_inputs for batch_inputs, _ in dataset.as_numpy_iterator()])
+    targets = np.concatenate([batch_targets for _, batch_targets in dataset.as_numpy_iterator()])
+
+    expected_inputs, expected_targets = make_sequences(np.stack([no1[1:], no2[1:]], axis=1), horizon=24)
+    assert inputs.shape == (99 - 24 - 24 + 1, 24, 2, len(FEATURE_COLUMNS) - 1) and targets.shape == (52, 2, 24)
+    np.testing.assert_array_equal(inputs, expected_inputs)
+    np.testing.assert_array_equal(targets, expected_targets)
+    np.testing.assert_array_equal(targets[0, 1], no2[25:49, 0])
@@ -0,0 +1,44 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import config
+from feature_store import export_area, export_features, is_exported, load_features, load_timestamps
+from tests.test_dataset import write_normalized_file
+
+def test_features_are_exported_once_and_memory_mapped(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path / 'normalized') + '/')
+    monkeypatch.setattr(config, 'FEATURE_STORE_DIR', str(tmp_path / 'features') + '/')
+    data = write_normalized_file(tmp_path / 'normalized' / 'NO1', 'NO1', 2022, offset=0)
+    file_path = str(tmp_path / 'normalized' / 'NO1' / 'NO1_2022.csv')
+
+    assert load_features(file_path, export=False) is None
+    assert export_area('NO1') == [file_path]
+    assert is_exported(file_path) and export_area('NO1') == []
+
+    features = load_features(file_path, export=False)
+    assert isinstance(features, np.memmap) and features.dtype == np.float32 and not features.flags.writeable
+    np.testing.assert_array_equal(features, data.astype(np.float32))
+    expected_starts = pd.date_range('2022-01-01', periods=100, freq='h', tz='+01:00').asi8
+    np.testing.assert_array_equal(load_timestamps(file_path), expected_starts)
+
+    # A rewritten normalized file is exported again
+    data = write_normalized_file(tmp_path / 'normalized' / 'NO1', 'NO1', 2022, offset=1000)
+    assert not is_exported(file_path)
+    np.testing.assert_array_equal(load_features(file_path), data.astype(np.float32))
+
+def test_concurrent_exports_of_a_file_all_succeed(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'FEATURE_STORE_DIR', str(tmp_path / 'features') + '/')
+    data = write_normalized_file(tmp_path / 'normalized' / 'NO1', 'NO1', 2022, offset=0)
+    file_path = str(tmp_path / 'normalized' / 'NO1' / 'NO1_2022.csv')
+
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(export_features, [file_path] * 8))
+
+    assert is_exported(file_path)
+    np.testing.assert_array_equal(load_features(file_path, export=False), data.astype(np.float32))
+    assert not [name for name in os.listdir(tmp_path / 'features' / 'NO1') if name.endswith('.tmp')]
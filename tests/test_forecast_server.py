@@ -0,0 +1,82 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import asyncio
+import urllib.error
+import numpy as np
+import pandas as pd
+import pytest
+import config
+import forecast_server
+from model import create_model
+from forecast_server import ForecastServer, fetch_forecast, fetch_stats
+from tests.test_dataset import write_normalized_file
+
+def test_forecast_server_batches_concurrent_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path / 'normalized') + '/')
+    monkeypatch.setattr(config, 'FORECAST_MODEL_PATH', str(tmp_path / 'model.keras'))
+    for area_code in ('NO1', 'NO2'):
+        write_normalized_file(tmp_path / 'normalized' / area_code, area_code, 2023, 0)
+    create_model(input_shape=(24, 7), num_outputs=24, units=4).save(config.FORECAST_MODEL_PATH)
+
+    async def run():
+        server = ForecastServer(port=0, batch_wait_ms=50)
+        server.warm_up(['NO1', 'NO2'])
+        await server.start()
+        try:
+            responses = await asyncio.gather(*(
+                asyncio.to_thread(fetch_forecast, area_code, port=server.port)
+                for area_code in ['NO1', 'NO2'] * 4
+            ))
+            with pytest.raises(urllib.error.HTTPError):
+                await asyncio.to_thread(fetch_forecast, 'NO3', port=server.port)
+            stats = await asyncio.to_thread(fetch_stats, port=server.port)
+        finally:
+            await server.stop()
+        return responses, stats
+
+    responses, stats = asyncio.run(run())
+
+    assert [response['area_code'] for response in responses] == ['NO1', 'NO2'] * 4
+    assert all(len(response['normalized_prices']) == 24 for response in responses)
+    assert responses[0]['start'] == '2023-01-05T04:00:00+01:00'
+    # The same window can land in batches of different sizes, which round float32 differently
+    np.testing.assert_allclose(responses[0]['normalized_prices'], responses[2]['normalized_prices'], rtol=1e-5, atol=1e-6)
+
+    # The eight concurrent requests share fewer predict calls than there are requests
+    assert stats['requests'] == 9 and stats['batches'] < 8
+    assert {'p50_ms', 'p90_ms', 'p99_ms'} <= stats.keys()
+
+def test_failed_requests_are_answered_and_the_server_keeps_serving(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path / 'normalized') + '/')
+    monkeypatch.setattr(config, 'FORECAST_MODEL_PATH', str(tmp_path / 'model.keras'))
+    for area_code in ('NO1', 'NO2', 'NO3'):
+        write_normalized_file(tmp_path / 'normalized' / area_code, area_code, 2023, 0)
+    create_model(input_shape=(24, 7), num_outputs=24, units=4).save(config.FORECAST_MODEL_PATH)
+
+    # NO2 has a file that cannot be read, and the prices of NO3 cannot be mapped back
+    get_window = forecast_server.WindowCache.get
+    monkeypatch.setattr(forecast_server.WindowCache, 'get', lambda cache, area_code: (
+        get_window(cache, area_code) if area_code != 'NO2' else pd.read_csv(tmp_path / 'missing.csv')))
+    inverse_transform_prices = forecast_server.inverse_transform_prices
+    monkeypatch.setattr(forecast_server, 'inverse_transform_prices', lambda area_code, prices: (
+        inverse_transform_prices(area_code, prices) if area_code != 'NO3' else 1 / 0))
+
+    async def request(area_code, port):
+        try:
+            return (await asyncio.to_thread(fetch_forecast, area_code, port=port))['area_code']
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    async def run():
+        server = ForecastServer(port=0, batch_wait_ms=50)
+        await server.start()
+        try:
+            first = await asyncio.gather(*(request(area_code, server.port) for area_code in ['NO1', 'NO2', 'NO3']))
+            second = await asyncio.wait_for(request('NO1', server.port), timeout=30)
+        finally:
+            await server.stop()
+        return first, second
+
+    assert asyncio.run(run()) == (['NO1', 500, 500], 'NO1')
@@ -0,0 +1,75 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+from model import create_model, create_multi_zone_model, get_model_zones, save_model
+from inference import forecast, load_cached_model
+from predict_and_visualize import predict_next_24_hours
+
+def loop_forecast(model, window, steps=24):
+    """
+    The original predict_next_24_hours loop for a single window, calling the model
+    directly instead of through model.predict to keep the test fast.
+    """
+    predictions = []
+    current_input = window[None].copy()
+    for _ in range(steps):
+        next_hour_prediction = model(current_input, training=False).numpy()
+        predictions.append(next_hour_prediction[0, 0])
+        current_input = np.roll(current_input, -1, axis=1)
+        current_input[0, -1, 0] = next_hour_prediction[0, 0]
+    return np.array(predictions)
+
+def test_forecast_matches_loop_for_a_batch_of_windows():
+    model = create_model(input_shape=(24, 7), units=4)
+    windows = np.random.default_rng(0).random((3, 24, 7)).astype(np.float32)
+
+    forecasts = forecast(model, windows, steps=6)
+
+    assert forecasts.shape == (3, 6)
+    for window, window_forecast in zip(windows, forecasts):
+        np.testing.assert_allclose(window_forecast, loop_forecast(model, window, steps=6), rtol=1e-4, atol=1e-5)
+
+def test_predict_next_24_hours_uses_the_most_recent_window():
+    model = create_model(input_shape=(24, 7), units=4)
+    windows = np.random.default_rng(0).random((3, 24, 7)).astype(np.float32)
+
+    predictions = predict_next_24_hours(model, windows)
+
+    assert predictions.shape == (24,)
+    np.testing.assert_allclose(predictions, loop_forecast(model, windows[-1]), rtol=1e-4, atol=1e-5)
+    assert not np.allclose(predictions, loop_forecast(model, windows[0]))
+
+def test_direct_head_and_model_cache(tmp_path):
+    model = create_model(input_shape=(24, 7), num_outputs=24, units=4)
+    windows = np.random.default_rng(0).random((5, 24, 7)).astype(np.float32)
+    np.testing.assert_allclose(forecast(model, windows), model.predict(windows, verbose=0), rtol=1e-5, atol=1e-6)
+
+    model_path = str(tmp_path / 'model.keras')
+    model.save(model_path)
+    assert load_cached_model(model_path) is load_cached_model(model_path)
+    np.testing.assert_allclose(forecast(model_path, windows), forecast(model, windows), rtol=1e-5, atol=1e-6)
+
+def test_multi_zone_forecast_matches_loop_and_direct_head(tmp_path):
+    windows = np.random.default_rng(0).random((2, 24, 3, 7)).astype(np.float32)
+
+    model = create_multi_zone_model(input_shape=(24, 3, 7), units=4, area_codes=['NO1', 'NO2', 'NO3'])
+    # The zones are saved next to the model and come back when it is loaded
+    model_path = str(tmp_path / 'multi_zone.keras')
+    save_model(model, model_path)
+    assert get_model_zones(load_cached_model(model_path)) == ['NO1', 'NO2', 'NO3']
+    forecasts = forecast(model, windows, steps=4)
+    assert forecasts.shape == (2, 3, 4)
+    current_input = windows.copy()
+    for step in range(4):
+        prediction = model(current_input, training=False).numpy()
+        np.testing.assert_allclose(forecasts[:, :, step], prediction, rtol=1e-4, atol=1e-5)
+        current_input = np.roll(current_input, -1, axis=1)
+        current_input[:, -1, :, 0] = prediction
+
+    model = create_multi_zone_model(input_shape=(24, 3, 7), num_outputs=24, units=4)
+    np.testing.assert_allclose(forecast(model, windows), model.predict(windows, verbose=0), rtol=1e-5, atol=1e-6)
+    assert get_model_zones(model) is None
+    save_model(model, model_path)
+    assert not (tmp_path / 'multi_zone.keras.zones.json').exists()
@@ -0,0 +1,82 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import numpy as np
+import pytest
+import config
+import instrumentation
+from instrumentation import track_stage, read_report, format_prometheus, write_prometheus
+
+def test_track_stage_records_rows_bytes_and_times(tmp_path, monkeypatch):
+    report_path = str(tmp_path / 'report.jsonl')
+    monkeypatch.setattr(config, 'RUN_REPORT_PATH', report_path)
+    input_file = tmp_path / 'input.bin'
+    input_file.write_bytes(b'x' * 100)
+    output_file = tmp_path / 'output.bin'
+
+    with track_stage('clean', 'NO1', 2023, rows_in=10) as record:
+        record.read(str(input_file))
+        output_file.write_bytes(b'y' * 40)
+        record.add_rows(rows_out=8)
+        record.wrote(str(output_file))
+
+    entry = read_report(report_path, instrumentation.RUN_ID)[-1]
+    assert entry['stage'] == 'clean' and entry['area_code'] == 'NO1' and entry['year'] == 2023
+    assert (entry['rows_in'], entry['rows_out'], entry['bytes_read'], entry['bytes_written']) == (10, 8, 100, 40)
+    assert entry['status'] == 'ok' and entry['wall_seconds'] >= 0 and entry['cpu_seconds'] >= 0
+    assert (entry['peak_rss_bytes'] or entry['process_peak_rss_bytes']) > 0
+    assert instrumentation.records[-1] == entry
+
+@pytest.mark.skipif(not instrumentation.reset_peak_rss(), reason="needs /proc/self/clear_refs")
+def test_peak_rss_is_measured_per_stage():
+    allocation = 200 * 2**20
+    with track_stage('normalize', 'NO1', 2023):
+        with track_stage('clean', 'NO1', 2023):
+            np.ones(allocation, dtype=np.uint8).sum()
+    with track_stage('clean', 'NO2', 2023):
+        pass
+
+    inner, outer, later = list(instrumentation.records)[-3:]
+    assert inner['peak_rss_bytes'] >= allocation and outer['peak_rss_bytes'] >= inner['peak_rss_bytes']
+    assert later['peak_rss_bytes'] < inner['peak_rss_bytes'] - allocation // 2
+    assert later['rss_delta_bytes'] is not None and later['process_peak_rss_bytes'] is None
+
+def test_failed_stage_records_only_the_error_type(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'RUN_REPORT_PATH', str(tmp_path / 'report.jsonl'))
+    with pytest.raises(ValueError):
+        with track_stage('fetch', 'NO1', 2023):
+            raise ValueError("https://example.com/?securityToken=secret")
+    entry = read_report(config.RUN_REPORT_PATH)[-1]
+    assert entry['status'] == 'failed: ValueError'
+
+def test_prometheus_totals_per_stage_and_zone_year(tmp_path):
+    entries = [
+        {'run_id': 'a', 'stage': 'clean', 'area_code': 'NO1', 'year': 2023, 'status': 'ok',
+         'wall_seconds': 1.5, 'rows_in': 10, 'rows_out': 9, 'peak_rss_bytes': 100},
+        {'run_id': 'a', 'stage': 'clean', 'area_code': 'NO1', 'year': 2023, 'status': 'failed: OSError',
+         'wall_seconds': 0.5, 'rows_in': 5, 'rows_out': None, 'peak_rss_bytes': 300},
+    ]
+    text = format_prometheus(entries)
+    labels = '{stage="clean",area_code="NO1",year="2023"}'
+    assert f'nepp_stage_wall_seconds{labels} 2\n' in text
+    assert f'nepp_stage_rows_in{labels} 15\n' in text
+    assert f'nepp_stage_peak_rss_bytes{labels} 300\n' in text
+    assert f'nepp_stage_runs{labels} 2\n' in text and f'nepp_stage_failures{labels} 1\n' in text
+    assert '# TYPE nepp_stage_wall_seconds gauge' in text
+
+    prometheus_path = tmp_path / 'metrics' / 'nepp.prom'
+    write_prometheus(str(prometheus_path), entries)
+    assert prometheus_path.read_text() == text
+
+def test_profiled_stage_writes_statistics(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'PROFILE_STAGES', ['normalize'])
+    monkeypatch.setattr(config, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    with track_stage('clean', 'NO1', 2023):
+        pass
+    assert not os.path.exists(config.PROFILE_DIR)
+    with track_stage('normalize', 'NO1', 2023):
+        sum(range(1000))
+    profiles = os.listdir(config.PROFILE_DIR)
+    assert len(profiles) == 1 and profiles[0].startswith('normalize_NO1_2023_')
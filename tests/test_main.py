@@ -0,0 +1,88 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+
+os.environ.setdefault('ENTSOE_API_KEY', 'test-key')
+
+import sys
+import json
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import config
+import main
+import instrumentation
+from instrumentation import read_report
+from main import run_cli, EXIT_OK, EXIT_STAGE_FAILED, EXIT_USAGE
+from storage import read_df, stage_file_path
+from tests.test_pipeline import use_data_dir, write_day_ahead_xml
+
+def test_batch_run_processes_zones_and_reports_failures(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    use_data_dir(monkeypatch, tmp_path / 'processed')
+    for area_code in ('NO1', 'NO2'):
+        write_day_ahead_xml(str(tmp_path / 'raw' / area_code), area_code, '20230101', '20230110')
+    # A broken raw file makes NO3 fail to preprocess
+    (tmp_path / 'raw' / 'NO3').mkdir()
+    (tmp_path / 'raw' / 'NO3' / 'NO3_2023_01_01_to_2023_01_10_day_ahead_prices.xml').write_text('<broken')
+
+    config_file = tmp_path / 'batch.json'
+    config_file.write_text(json.dumps({'zones': ['NO1', 'NO2'], 'start': '20230101', 'end': '20230110',
+                                       'stages': ['preprocess', 'clean', 'normalize']}))
+    monkeypatch.setattr(config, 'RUN_REPORT_PATH', None)
+    monkeypatch.setattr(config, 'PROMETHEUS_REPORT_PATH', None)
+    prometheus_path = tmp_path / 'metrics' / 'nepp.prom'
+    assert run_cli(['--config', str(config_file), '--prometheus', str(prometheus_path)]) == EXIT_OK
+    for area_code in ('NO1', 'NO2'):
+        assert os.path.exists(stage_file_path(config.DATA_NORMALIZED_DIR, area_code, 2023))
+    # The records of the zone processes are collected through the run report next to the metrics
+    metrics = prometheus_path.read_text()
+    assert 'nepp_stage_rows_out{stage="normalize",area_code="NO2",year="2023"}' in metrics
+    assert (tmp_path / 'metrics' / 'nepp.jsonl').exists()
+
+    assert run_cli(['--config', str(config_file), '--zones', 'NO1,NO3']) == EXIT_STAGE_FAILED
+    summary = capsys.readouterr().out
+    assert 'NO1 normalize: ok' in summary and 'NO3 preprocess: failed' in summary and 'NO3 clean: skipped' in summary
+
+    assert run_cli(['--zones', 'NO1']) == EXIT_USAGE
+    assert run_cli(['--start', '20230101', '--stages', 'unknown']) == EXIT_USAGE
+
+def test_zone_processes_take_over_the_settings_of_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    use_data_dir(monkeypatch, tmp_path / 'processed')
+    write_day_ahead_xml(str(tmp_path / 'raw' / 'NO1'), 'NO1', '20230101', '20230103')
+    monkeypatch.setattr(config, 'RUN_REPORT_PATH', None)
+    monkeypatch.setattr(config, 'PROMETHEUS_REPORT_PATH', None)
+    monkeypatch.setattr(config, 'PROFILE_STAGES', [])
+    monkeypatch.setattr(config, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    # Spawned processes start from a fresh config module, unlike forked ones
+    monkeypatch.setattr(main, 'ProcessPoolExecutor', partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn')))
+
+    report_path = str(tmp_path / 'report.jsonl')
+    assert run_cli(['--zones', 'NO1', '--start', '20230101', '--end', '20230103', '--stages', 'preprocess,clean',
+                    '--report', report_path, '--profile', 'clean']) == EXIT_OK
+    stages = {entry['stage'] for entry in read_report(report_path, instrumentation.RUN_ID)}
+    assert {'preprocess', 'clean'} <= stages
+    assert any(name.startswith('clean_NO1_2023_') for name in os.listdir(config.PROFILE_DIR))
+
+def test_zone_stages_only_preprocess_raw_files_in_the_date_range(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    use_data_dir(monkeypatch, tmp_path / 'processed')
+    for start_date, end_date in (('20230101', '20230131'), ('20230601', '20230630'), ('20230701', '20230731')):
+        write_day_ahead_xml(str(tmp_path / 'raw' / 'NO1'), 'NO1', start_date, end_date)
+
+    assert main.run_zone_stages('NO1', ['preprocess'], '20230615', '20230630') == {'preprocess': 'ok'}
+
+    months = read_df(stage_file_path(config.DATA_PREPROCESSED_DIR, 'NO1', 2023))['period_start'].dt.month
+    assert set(months) == {6}
+
+def test_data_only_runs_start_without_heavy_libraries():
+    src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    script = (f"import sys; sys.path.insert(0, {src_dir!r}); import main, data_cleaner, data_normalizer; "
+              "print(*[name for name in ('tensorflow', 'keras', 'sklearn', 'matplotlib', 'entsoe', 'requests') "
+              "if name in sys.modules])")
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    assert output.split() == []
@@ -0,0 +1,110 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import re
+import sys
+import pandas as pd
+import pytest
+import config
+from data_preprocessor import process_files, process_files_incremental, filter_xml_files_by_year
+from data_cleaner import clean_file, clean_incremental
+from data_normalizer import normalize_area, normalize_incremental
+from pipeline import run_pipeline
+from storage import read_df, stage_file_path, list_stage_files
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from synthetic import write_day_ahead_xml
+
+def use_data_dir(monkeypatch, data_dir):
+    monkeypatch.setattr(config, 'DATA_PROCESSED_DIR', str(data_dir) + '/')
+    for name, stage in [('DATA_PREPROCESSED_DIR', 'preprocessed'), ('DATA_CLEANED_DIR', 'cleaned'), ('DATA_NORMALIZED_DIR', 'normalized')]:
+        monkeypatch.setattr(config, name, str(data_dir / stage) + '/')
+    monkeypatch.setattr(config, 'SCALER_REGISTRY_PATH', str(data_dir / 'scalers.json'))
+    monkeypatch.setattr(config, 'GAP_REPORT_DIR', str(data_dir / 'gaps') + '/')
+
+def test_fused_pipeline_matches_staged_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    write_day_ahead_xml(str(tmp_path / 'raw' / 'NO1'), 'NO1', '20221220', '20230110')
+    xml_files = filter_xml_files_by_year('NO1', 2022, 2023)
+
+    use_data_dir(monkeypatch, tmp_path / 'staged')
+    process_files(xml_files)
+    os.makedirs(os.path.join(config.DATA_CLEANED_DIR, 'NO1'))
+    for file_path in list_stage_files(os.path.join(config.DATA_PREPROCESSED_DIR, 'NO1')):
+        clean_file(file_path, os.path.join(config.DATA_CLEANED_DIR, 'NO1'))
+    normalize_area('NO1')
+    staged = [read_df(stage_file_path(config.DATA_NORMALIZED_DIR, 'NO1', year)) for year in (2022, 2023)]
+
+    use_data_dir(monkeypatch, tmp_path / 'fused')
+    written = run_pipeline(xml_files)
+    fused = [read_df(written[('NO1', year)]) for year in (2022, 2023)]
+
+    for staged_df, fused_df in zip(staged, fused):
+        pd.testing.assert_frame_equal(fused_df, staged_df)
+    # Only the normalized stage is written by default
+    assert not os.path.exists(config.DATA_PREPROCESSED_DIR) and not os.path.exists(config.DATA_CLEANED_DIR)
+
+def run_staged(xml_files):
+    process_files(xml_files)
+    os.makedirs(os.path.join(config.DATA_CLEANED_DIR, 'NO1'), exist_ok=True)
+    for file_path in list_stage_files(os.path.join(config.DATA_PREPROCESSED_DIR, 'NO1')):
+        clean_file(file_path, os.path.join(config.DATA_CLEANED_DIR, 'NO1'))
+    normalize_area('NO1')
+
+def test_incremental_append_matches_staged_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    folder = str(tmp_path / 'raw' / 'NO1')
+    first_file = write_day_ahead_xml(folder, 'NO1', '20221215', '20221229', seed=1)
+    # The update crosses into 2023 and misses its first two hours, which are filled from the last hour before it
+    second_file = write_day_ahead_xml(folder, 'NO1', '20221230', '20230105', seed=2)
+    with open(second_file, 'r') as file:
+        document = file.read()
+    with open(second_file, 'w') as file:
+        file.write(re.sub(r'\s*<Point>\s*<position>[12]</position>.*?</Point>', '', document, count=2, flags=re.S))
+
+    use_data_dir(monkeypatch, tmp_path / 'staged')
+    run_staged([first_file, second_file])
+    staged = {year: read_df(stage_file_path(config.DATA_CLEANED_DIR, 'NO1', year)) for year in (2022, 2023)}
+
+    use_data_dir(monkeypatch, tmp_path / 'incremental')
+    run_staged([first_file])
+    new_rows = process_files_incremental([first_file, second_file])
+    new_cleaned = clean_incremental('NO1', {year: df for (_, year), df in new_rows.items()})
+    normalize_incremental('NO1', new_cleaned)
+    assert sorted(new_cleaned) == [2022, 2023]
+
+    for year, staged_df in staged.items():
+        cleaned = read_df(stage_file_path(config.DATA_CLEANED_DIR, 'NO1', year))
+        normalized = read_df(stage_file_path(config.DATA_NORMALIZED_DIR, 'NO1', year))
+        pd.testing.assert_frame_equal(cleaned, staged_df)
+        for df in (cleaned, normalized):
+            assert df['period_start'].is_unique and df['period_start'].is_monotonic_increasing
+        pd.testing.assert_series_equal(normalized['period_start'], cleaned['period_start'])
+
+    boundary = pd.Timestamp('2022-12-30', tz='+01:00')
+    prices = staged[2022].set_index('period_start')['price']
+    assert prices[boundary] == prices[boundary + pd.Timedelta(hours=1)] == prices[boundary - pd.Timedelta(hours=1)]
+
+def test_fused_run_on_part_of_a_year_keeps_the_rest(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_RAW_DIR', str(tmp_path / 'raw') + '/')
+    use_data_dir(monkeypatch, tmp_path / 'processed')
+    folder = str(tmp_path / 'raw' / 'NO1')
+    first_file = write_day_ahead_xml(folder, 'NO1', '20221201', '20221215', seed=1)
+    second_file = write_day_ahead_xml(folder, 'NO1', '20221216', '20221231', seed=2)
+
+    written = run_pipeline([first_file, second_file])
+    full_year = read_df(written[('NO1', 2022)])
+    # Without the preprocessed stage, the rows of the other raw file are kept from the normalized file
+    run_pipeline([second_file])
+    pd.testing.assert_frame_equal(read_df(written[('NO1', 2022)]), full_year)
+
+    # Rows scaled with a refitted scaler cannot be merged with the old ones
+    scalers = open(config.SCALER_REGISTRY_PATH).read()
+    with pytest.raises(ValueError):
+        run_pipeline([second_file], refit_scaler=True)
+    pd.testing.assert_frame_equal(read_df(written[('NO1', 2022)]), full_year)
+    assert open(config.SCALER_REGISTRY_PATH).read() == scalers
+    # A refit on the whole year replaces the file
+    run_pipeline([first_file, second_file], refit_scaler=True)
@@ -0,0 +1,71 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import config
+import scaler_registry
+from scaler_registry import update_scaler, get_scaler, inverse_transform_prices
+from data_normalizer import normalize_area
+from data_loader import load_data
+
+def test_partial_fit_over_chunks_is_saved_and_reloaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'SCALER_REGISTRY_PATH', str(tmp_path / 'models' / 'scalers.json'))
+    prices = np.random.default_rng(0).normal(50, 20, 1000)
+
+    update_scaler('NO1', (pd.DataFrame({'price': chunk}) for chunk in np.array_split(prices, 7)))
+    scaler_registry.registry_cache.clear()
+    scaler = get_scaler('NO1')
+
+    assert scaler.data_min_[0] == prices.min() and scaler.data_max_[0] == prices.max()
+    assert get_scaler('NO2') is None and inverse_transform_prices('NO2', [0.5]) is None
+    normalized = scaler.transform(pd.DataFrame({'price': prices[:24]}))[:, 0]
+    np.testing.assert_allclose(inverse_transform_prices('NO1', normalized), prices[:24])
+
+def test_normalize_area_scales_every_year_alike(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_PROCESSED_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(config, 'DATA_CLEANED_DIR', str(tmp_path / 'cleaned') + '/')
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path / 'normalized') + '/')
+    monkeypatch.setattr(config, 'SCALER_REGISTRY_PATH', str(tmp_path / 'scalers.json'))
+    (tmp_path / 'cleaned' / 'NO1').mkdir(parents=True)
+    for year, prices in [(2021, [10.0, 20.0]), (2022, [30.0, 50.0])]:
+        period_start = pd.date_range(f'{year}-01-01', periods=2, freq='h', tz='+01:00')
+        pd.DataFrame({'price': prices, 'period_start': period_start, 'period_end': period_start + pd.Timedelta(hours=1)}) \
+            .to_csv(tmp_path / 'cleaned' / 'NO1' / f'NO1_{year}.csv', index=False)
+
+    assert normalize_area('NO1') == 2
+
+    assert load_data(2021, 'NO1')['price'].tolist() == [0.0, 0.25]
+    assert load_data(2022, 'NO1')['price'].tolist() == [0.5, 1.0]
+    np.testing.assert_allclose(inverse_transform_prices('NO1', [0.25, 1.0]), [20.0, 50.0])
+
+def fit_area(registry_path, area_code):
+    for offset in range(20):
+        update_scaler(area_code, [np.arange(10.0) + offset], registry_path=registry_path)
+
+def test_concurrent_updates_from_processes_are_all_kept(tmp_path):
+    registry_path = str(tmp_path / 'scalers.json')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(fit_area, [registry_path] * 4, ['NO1', 'NO2', 'NO3', 'NO4']))
+
+    scalers = scaler_registry.load_registry(registry_path)['scalers']
+    assert sorted(scalers) == ['NO1', 'NO2', 'NO3', 'NO4']
+    assert all(scalers[area_code]['price']['data_max'] == 28.0 for area_code in scalers)
+
+def test_update_reads_the_registry_past_a_stale_cache(tmp_path):
+    registry_path = str(tmp_path / 'scalers.json')
+    update_scaler('NO1', [np.array([0.0, 10.0])], registry_path=registry_path)
+    mtime = os.stat(registry_path).st_mtime_ns
+    # Another process widens the range, and the file keeps the mtime of the cached registry
+    registry = json.loads(open(registry_path).read())
+    registry['scalers']['NO1']['price']['data_max'] = 100.0
+    with open(registry_path, 'w') as file:
+        json.dump(registry, file)
+    os.utime(registry_path, ns=(mtime, mtime))
+
+    scaler = update_scaler('NO1', [np.array([5.0])], registry_path=registry_path)
+    assert scaler.data_max_[0] == 100.0 and scaler.n_samples_seen_ == 3
@@ -0,0 +1,61 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+import pandas as pd
+import pytest
+import config
+from data_cleaner import clean_data
+from data_normalizer import normalize_data
+from data_preprocessor import parse_xml_to_df, combine_partition
+from schema import SCHEMA, apply_schema
+from storage import read_df, write_df, stage_file_path
+from tests.test_data_preprocessor import write_xml
+
+def assert_schema(df):
+    for column in df.columns:
+        if column in SCHEMA:
+            assert df[column].dtype == SCHEMA[column], column
+
+@pytest.mark.parametrize('storage_format', ['csv', 'parquet', 'feather'])
+def test_every_stage_writes_and_reads_the_compact_schema(tmp_path, monkeypatch, storage_format):
+    monkeypatch.setattr(config, 'STORAGE_FORMAT', storage_format)
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed') + '/')
+    xml_file = write_xml(tmp_path, [('2023-11-30T23:00Z', 'PT60M', [float(i) + 0.25 for i in range(24)])])
+
+    parsed = parse_xml_to_df(xml_file)
+    assert_schema(parsed)
+    assert parsed['currency'].cat.categories.tolist() == ['EUR']
+
+    preprocessed = combine_partition('NO1', 2023, [parsed])
+    cleaned = clean_data(preprocessed)
+    normalized = normalize_data(cleaned.copy())
+    for df in (preprocessed, cleaned, normalized):
+        assert_schema(df)
+    assert normalized['month'].dtype == np.int8 and normalized['year'].dtype == np.int16
+
+    for name, df in (('preprocessed', preprocessed), ('normalized', normalized)):
+        file_path = stage_file_path(str(tmp_path / name), 'NO1', 2023)
+        (tmp_path / name / 'NO1').mkdir(parents=True)
+        write_df(df, file_path)
+        pd.testing.assert_frame_equal(read_df(file_path), df.reset_index(drop=True))
+
+def test_merged_partitions_keep_categoricals(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_PREPROCESSED_DIR', str(tmp_path / 'preprocessed') + '/')
+    first = parse_xml_to_df(write_xml(tmp_path, [('2023-11-30T23:00Z', 'PT60M', [1.0, 2.0])]))
+    second = first.copy()
+    second['currency'] = pd.Categorical(['NOK'] * len(second))
+    second['period_start'] += pd.Timedelta(hours=2)
+
+    combined = combine_partition('NO1', 2023, [first, second])
+    assert combined['currency'].dtype == 'category'
+    assert sorted(combined['currency'].cat.categories) == ['EUR', 'NOK']
+
+def test_apply_schema_rejects_values_that_do_not_fit():
+    df = pd.DataFrame({'price': [1.5, 2.5], 'month': [1.0, 12.0], 'other': ['a', 'b']})
+    assert apply_schema(df) is df
+    assert df['price'].dtype == np.float32 and df['month'].dtype == np.int8 and df['other'].dtype == object
+
+    with pytest.raises(ValueError):
+        apply_schema(pd.DataFrame({'month': [1, 300]}))
@@ -0,0 +1,22 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import os
+import pandas as pd
+from storage import ChunkWriter, read_df
+
+def test_chunk_writer_keeps_its_temporary_file_to_its_process(tmp_path):
+    file_path = str(tmp_path / 'NO1_2023.parquet')
+    # Temporary file of a writer in another process, which must be left alone
+    other_temp_path = tmp_path / 'NO1_2023.parquet.1.tmp'
+    other_temp_path.write_bytes(b'partial')
+
+    with ChunkWriter(file_path) as writer:
+        assert writer.temp_path == f"{file_path}.{os.getpid()}.tmp"
+        writer.write(pd.DataFrame({'price': [1.0, 2.0]}))
+        writer.write(pd.DataFrame({'price': [3.0]}))
+
+    assert list(read_df(file_path)['price']) == [1.0, 2.0, 3.0]
+    assert other_temp_path.read_bytes() == b'partial'
+    assert not os.path.exists(writer.temp_path)
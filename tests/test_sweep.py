@@ -0,0 +1,50 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import config
+from sweep import grid_trials, random_trials, run_sweep, PruneCallback
+from tests.test_dataset import write_normalized_file
+
+def test_grid_and_random_trials():
+    grid = {'units': [8, 16], 'dropout_rate': [0.0, 0.1, 0.2]}
+    trials = grid_trials(grid)
+    assert len(trials) == 6 and {'units': 16, 'dropout_rate': 0.1} in trials
+    sampled = random_trials(grid, 4, seed=0)
+    assert len(sampled) == 4 and all(trial in trials for trial in sampled)
+    assert random_trials(grid, 4, seed=0) == sampled and len(random_trials(grid, 10)) == 6
+
+def test_prune_callback_stops_trials_worse_than_the_median():
+    class Model:
+        stop_training = False
+
+    prune = PruneCallback([0.5, 0.4, 0.3], min_epochs=2)
+    prune.set_model(Model())
+    prune.on_epoch_end(0, {'val_mae': 0.9})
+    assert not prune.pruned
+    prune.on_epoch_end(1, {'val_mae': 0.35})
+    assert not prune.pruned
+    prune.on_epoch_end(2, {'val_mae': 0.31})
+    assert prune.pruned and prune.model.stop_training
+
+def test_sweep_runs_trials_in_worker_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DATA_NORMALIZED_DIR', str(tmp_path) + '/')
+    monkeypatch.setattr(config, 'FEATURE_STORE_DIR', str(tmp_path / 'features') + '/')
+    write_normalized_file(tmp_path / 'NO1', 'NO1', 2021, offset=0)
+    write_normalized_file(tmp_path / 'NO1', 'NO1', 2022, offset=0)
+
+    # The spawned workers take the epochs and batch size over from the config
+    monkeypatch.setattr(config, 'TRAINING_EPOCHS', 2)
+    monkeypatch.setattr(config, 'BATCH_SIZE', 64)
+    trials = grid_trials({'units': [4, 8]})
+    table = run_sweep(trials, [2021], ['NO1'], validation_years=[2022], workers=2, threads_per_worker=1,
+                      results_path=str(tmp_path / 'results.csv'))
+
+    assert sorted(table['units']) == [4, 8] and set(table['status']) == {'ok'}
+    assert (table['epochs_run'] == 2).all() and (table['wall_time'] > 0).all()
+    assert table['val_mae'].is_monotonic_increasing
+    assert (tmp_path / 'results.csv').exists()
+
+def test_sweep_without_trials_returns_an_empty_table(tmp_path):
+    table = run_sweep([], [2021], ['NO1'], results_path=str(tmp_path / 'results.csv'))
+    assert table.empty and not (tmp_path / 'results.csv').exists()
@@ -0,0 +1,47 @@
+# Copyright (C) 2023 Haakon Vollheim Webb
+# This file is part of NEPP which is released under GNU GPLv3.
+# See file LICENSE or go to https://www.gnu.org/licenses/gpl-3.0.html for full license details.
+
+import numpy as np
+from windowing import make_sequences, make_prediction_windows
+
+def loop_sequences(data, look_back, horizon):
+    """
+    The original loop-based window builder, extended to several target hours.
+    """
+    input_sequences, target_prices = [], []
+    for i in range(len(data) - look_back - horizon + 1):
+        input_sequences.append(data[i:i + look_back, 1:].astype(np.float32))
+        target_prices.append(data[i + look_back:i + look_back + horizon, 0].astype(np.float32))
+    return np.array(input_sequences), np.array(target_prices)
+
+def test_make_sequences_matches_loop():
+    data = np.random.default_rng(0).random((100, 8))
+
+    for horizon in (1, 24):
+        expected_inputs, expected_targets = loop_sequences(data, 24, horizon)
+        inputs, targets = make_sequences(data, look_back=24, horizon=horizon)
+
+        assert inputs.dtype == np.float32
+        np.testing.assert_array_equal(inputs, expected_inputs)
+        np.testing.assert_array_equal(targets, expected_targets[:, 0] if horizon == 1 else expected_targets)
+
+    # A stride keeps every n-th window
+    inputs, targets = make_sequences(data, look_back=24, horizon=24, stride=5)
+    np.testing.assert_array_equal(inputs, expected_inputs[::5])
+    np.testing.assert_array_equal(targets, expected_targets[::5])
+
+def test_windows_are_views():
+    data = np.random.default_rng(0).random((50, 8)).astype(np.float32)
+
+    inputs, targets = make_sequences(data, look_back=24, horizon=24)
+    assert np.shares_memory(inputs, data) and np.shares_memory(targets, data)
+    assert inputs.shape == (3, 24, 7) and targets.shape == (3, 24)
+
+    windows = make_prediction_windows(data)
+    assert np.shares_memory(windows, data)
+    np.testing.assert_array_equal(windows[-1], data[-24:, 1:])
+
+    # Too little data gives no windows instead of an error
+    inputs, targets = make_sequences(data[:30], look_back=24, horizon=24)
+    assert inputs.shape == (0, 24, 7) and targets.shape == (0, 24)